@@ -0,0 +1,164 @@
+# SPDX-FileCopyrightText: © 2025 Tiny Tapeout
+# SPDX-License-Identifier: Apache-2.0
+
+# Cached instruction encoding for the test harness.
+#
+# Building a riscvmodel instruction and encoding it is slow, and the harness
+# encodes the same few instructions over and over.  encode() looks the
+# instruction up in tables of the common forms, precomputed when a peripheral's
+# register window is first used, and falls back to a bounded LRU cache.
+
+from functools import lru_cache
+
+from riscvmodel.insn import *
+from riscvmodel.regnames import x0, tp, a0, a1, a2, a3, a4, a5
+
+CACHE_SIZE = 4096
+
+NOP = InstructionADDI(x0, x0, 0).encode()
+
+_table = {(InstructionADDI, x0, x0, 0): NOP}
+_table_windows = set()
+_table_hits = 0
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _encode(insn, *args):
+    return insn(*args).encode()
+
+# Encode insn(*args), e.g. encode(InstructionSW, tp, a1, 0x100)
+def encode(insn, *args):
+    global _table_hits
+    code = _table.get((insn, *args))
+    if code is not None:
+        _table_hits += 1
+        return code
+    return _encode(insn, *args)
+
+# Precompute the loads into a1 and the stores from a0-a5 relative to tp used
+# to access the registers of the peripheral at base_address.
+def add_register_window(base_address, size=0x40):
+    if base_address in _table_windows:
+        return
+    _table_windows.add(base_address)
+    for addr in range(base_address, base_address + size):
+        for insn in (InstructionSB, InstructionSH, InstructionSW):
+            for reg in (a0, a1, a2, a3, a4, a5):
+                _table[(insn, tp, reg, addr)] = insn(tp, reg, addr).encode()
+        for insn in (InstructionLBU, InstructionLHU, InstructionLW):
+            _table[(insn, a1, tp, addr)] = insn(a1, tp, addr).encode()
+
+# The instructions to load a 32-bit constant into rd: a single ADDI if the value
+# fits in 12 bits, otherwise LUI followed by ADDI if the bottom 12 bits are non-zero.
+# The instructions are encoded directly rather than through encode(), so that each
+# load_imm lookup is counted once in stats(), as a hit or a miss of its own cache.
+@lru_cache(maxsize=CACHE_SIZE)
+def load_imm(rd, value):
+    value &= 0xFFFFFFFF
+    if value >= 0x80000000:
+        value -= 0x100000000
+    if -0x800 <= value < 0x800:
+        return (InstructionADDI(rd, x0, value).encode(),)
+
+    value_upper = ((value + 0x800) >> 12) & 0xfffff
+    value_lower = value & 0xfff
+    if value_lower >= 0x800:
+        value_lower -= 0x1000
+    if value_lower == 0:
+        return (InstructionLUI(rd, value_upper).encode(),)
+    return (InstructionLUI(rd, value_upper).encode(), InstructionADDI(rd, rd, value_lower).encode())
+
+def _encode_ci(reg, imm, opcode):
+    return opcode | ((imm & 0x20) << 7) | (reg << 7) | ((imm & 0x1f) << 2)
+
+def encode_cli(reg, imm):
+    return _encode_ci(reg, imm, 0x4001)
+
+def encode_caddi(reg, imm):
+    return _encode_ci(reg, imm, 0x0001)
+
+def encode_cmv(dest_reg, src_reg):
+    return 0x8002 | (dest_reg << 7) | (src_reg << 2)
+
+# Tracks the values known to be in a0-a5, so constants can be reused or built
+# with the shortest sequence instead of always loading them from scratch.
+# invalidate() must be called whenever the registers may have been changed
+# behind its back: reset, code run from the simulated flash, or loads into them.
+class ConstantCache:
+    REGS = (a0, a1, a2, a3, a4, a5)
+
+    def __init__(self):
+        self.invalidate()
+
+    def invalidate(self, reg=None):
+        if reg is None:
+            self.values = {}
+            self.lru = list(self.REGS)
+        else:
+            self.values.pop(reg, None)
+
+    def _use(self, reg):
+        self.lru.remove(reg)
+        self.lru.append(reg)
+
+    # Returns (reg, instrs): instrs leave value in reg.  If rd is given the value
+    # is placed in rd, otherwise a register is chosen.
+    def materialize(self, value, rd=None):
+        value &= 0xFFFFFFFF
+        signed = value - 0x100000000 if value >= 0x80000000 else value
+        holders = [reg for reg, known in self.values.items() if known == value]
+
+        if rd is None and holders:
+            reg = holders[0]
+            self._use(reg)
+            return reg, ()
+        if rd is not None and rd in holders:
+            self._use(rd)
+            return rd, ()
+
+        if rd is not None and holders:
+            instrs = (encode_cmv(rd, holders[0]),)
+        elif -32 <= signed < 32:
+            rd = rd if rd is not None else self.lru[0]
+            instrs = (encode_cli(rd, signed),)
+        else:
+            target = rd if rd is not None else self.lru[0]
+            deltas = []
+            for reg, known in self.values.items():
+                delta = (value - known) & 0xFFFFFFFF
+                deltas.append((reg, delta - 0x100000000 if delta >= 0x80000000 else delta))
+
+            # A small adjustment in place of a register holding a nearby value
+            instrs = None
+            for reg, delta in deltas:
+                if -32 <= delta < 32 and (rd is None or rd == reg):
+                    target, instrs = reg, (encode_caddi(reg, delta),)
+                    break
+            if instrs is None and not -0x800 <= signed < 0x800:
+                for reg, delta in deltas:
+                    if -0x800 <= delta < 0x800:
+                        instrs = (encode(InstructionADDI, target, reg, delta),)
+                        break
+            if instrs is None:
+                instrs = load_imm(target, value)
+            rd = target
+
+        self.values[rd] = value
+        self._use(rd)
+        return rd, instrs
+
+def stats():
+    cache = _encode.cache_info()
+    imm_cache = load_imm.cache_info()
+    hits = _table_hits + cache.hits + imm_cache.hits
+    misses = cache.misses + imm_cache.misses
+    return {
+        "table_hits": _table_hits,
+        "cache_hits": cache.hits + imm_cache.hits,
+        "misses": misses,
+        "hit_rate": hits / (hits + misses) if hits + misses else 0.,
+    }
+
+def log_stats(log):
+    s = stats()
+    log.info(f"Instruction encoding: {s['table_hits']} table hits, {s['cache_hits']} cache hits, "
+             f"{s['misses']} misses ({s['hit_rate']:.1%} hit rate)")
@@ -0,0 +1,143 @@
+# SPDX-FileCopyrightText: © 2025 Tiny Tapeout
+# SPDX-License-Identifier: Apache-2.0
+
+from array import array
+from collections import deque
+
+from tqv_model import TinyQVModel, operands, memory_access, written_regs, ADDR_MASK, RAM_A_ADDR, M
+
+# Functional coverage of the random instruction tests.  Each instruction generated
+# falls in one bin for its op, operand class and hazard distance:
+#
+# The operand class is the sign of the value it works on, and whether its other
+# operand is an edge case.  The value is the first source register, or the data
+# stored or loaded for a store or load.  The edge cases are shift amounts of 0 and 31,
+# a second operand of 0 or -1, and PSRAM accesses within EDGE_BYTES of the start or
+# end of a chip.
+#
+# The hazard distance is how many instructions back the closest source register was
+# written, with a load written by the instruction before kept apart as a load-use.
+# The random tests set the base register of each load and store just before it, so
+# loads and stores only fall in the distance 1 bins.
+VALUE_CLASSES = ("zero", "negative", "positive")
+OPERAND_CLASSES = VALUE_CLASSES + tuple(name + " edge" for name in VALUE_CLASSES)
+HAZARDS = ("load-use", "1", "2", "3", "none")
+LOAD_USE = 0
+NO_HAZARD = len(HAZARDS) - 1
+
+PSRAM_END = 0x2000000
+PSRAM_CHIP_SIZE = 0x800000
+EDGE_BYTES = 8
+
+def _value_class(value, bits=32):
+    value &= (1 << bits) - 1
+    if value == 0:
+        return 0
+    return 1 if value >> (bits - 1) else 2
+
+def near_psram_edge(addr):
+    if not RAM_A_ADDR <= addr < PSRAM_END:
+        return False
+    offset = (addr - RAM_A_ADDR) % PSRAM_CHIP_SIZE
+    return offset < EDGE_BYTES or offset >= PSRAM_CHIP_SIZE - EDGE_BYTES
+
+# Counts the instructions a random test generates in each bin, in one array indexed
+# by bin so that sampling costs a few integer operations.
+#
+#   coverage = CoverageCollector([op.name for op in ops])
+#   coverage.executed(setup_instr)
+#   coverage.record(op_index, instr, model.regs, load_value)
+#   ...
+#   coverage.log_report(dut._log)
+#
+# The random tests bias each instruction towards the bins least hit so far, so keep
+# one collector per seed, for the program of a seed to depend on that seed alone,
+# and merge them into one for the report.
+class CoverageCollector:
+
+    def __init__(self, op_names):
+        self.op_names = list(op_names)
+        self.bins_per_op = len(OPERAND_CLASSES) * len(HAZARDS)
+        self.hits = array("L", [0]) * (len(self.op_names) * self.bins_per_op)
+        self.instructions = 0
+        # The registers written by the last few instructions, most recent first,
+        # with whether each was a load
+        self.recent = deque(maxlen=NO_HAZARD - 1)
+        self._scratch = TinyQVModel()
+
+    def __len__(self):
+        return len(self.hits)
+
+    def covered(self):
+        return len(self.hits) - self.hits.count(0)
+
+    # The bin of op index op for instr, executed with registers regs after the setup
+    # instructions.  load_value is the data returned if instr is a load.
+    def bin(self, op, instr, regs, load_value=None, setup=()):
+        recent = self.recent
+        if setup:
+            scratch = self._scratch
+            scratch.regs[:] = regs
+            for setup_instr in setup:
+                scratch.execute(setup_instr)
+            regs = scratch.regs
+            recent = [(written_regs(setup_instr), False) for setup_instr in reversed(setup)] + list(recent)
+
+        operand = 0
+        hazard = NO_HAZARD
+        decoded = operands(instr)
+        if decoded is not None:
+            kind, sources, imm = decoded
+            if kind == "load" or kind == "store":
+                addr = (regs[sources[0]] + imm) & ADDR_MASK
+                bits = 8 * memory_access(instr)[1]
+                data = load_value if kind == "load" else regs[sources[1]]
+                operand = _value_class(data or 0, bits)
+                edge = near_psram_edge(addr)
+            else:
+                operand = _value_class(regs[sources[0]] if sources else imm)
+                second = imm if len(sources) < 2 else regs[sources[1]]
+                if kind == "shift":
+                    edge = (second & 31) in (0, 31)
+                else:
+                    edge = second is not None and second & M in (0, M)
+            operand += len(VALUE_CLASSES) * edge
+
+            for distance, (written, is_load) in enumerate(recent):
+                if any(reg in written for reg in sources):
+                    hazard = LOAD_USE if distance == 0 and is_load else distance + 1
+                    break
+
+        return (op * len(OPERAND_CLASSES) + operand) * len(HAZARDS) + hazard
+
+    # Add the hits and instructions of another collector for the same ops
+    def merge(self, other):
+        assert other.op_names == self.op_names
+        for i, hits in enumerate(other.hits):
+            self.hits[i] += hits
+        self.instructions += other.instructions
+
+    # Record op index op generating instr, to be executed with registers regs
+    def record(self, op, instr, regs, load_value=None):
+        self.hits[self.bin(op, instr, regs, load_value)] += 1
+        self.executed(instr)
+
+    # Follow an instruction executed outside the coverage, such as one setting up a
+    # base register, for the hazard distances
+    def executed(self, instr):
+        decoded = operands(instr)
+        self.recent.appendleft((written_regs(instr), decoded is not None and decoded[0] == "load"))
+        self.instructions += 1
+
+    # Log the bins covered in total and for each op, with the operand classes and
+    # hazards seen for each op
+    def log_report(self, log):
+        log.info(f"Coverage: {self.covered()} of {len(self)} bins ({self.covered() / len(self):.1%}) "
+                 f"in {self.instructions} instructions")
+        for op, name in enumerate(self.op_names):
+            hits = self.hits[op * self.bins_per_op:(op + 1) * self.bins_per_op]
+            operand_seen = [operand for i, operand in enumerate(OPERAND_CLASSES)
+                            if any(hits[i * len(HAZARDS):(i + 1) * len(HAZARDS)])]
+            hazard_seen = [hazard for i, hazard in enumerate(HAZARDS) if any(hits[i::len(HAZARDS)])]
+            log.info(f"  {name:8} {len(hits) - hits.count(0):3} bins, {sum(hits):5} hits, "
+                     f"operands: {', '.join(operand_seen) or '-'}; hazards: {', '.join(hazard_seen) or '-'}")
@@ -0,0 +1,137 @@
+# SPDX-FileCopyrightText: © 2025 Tiny Tapeout
+# SPDX-License-Identifier: Apache-2.0
+
+import cocotb
+from cocotb.triggers import Edge, RisingEdge, First
+
+# Memory is allocated in pages as it is written, so large sparse images are cheap.
+PAGE_BITS = 12
+PAGE_SIZE = 1 << PAGE_BITS
+
+FLASH_CMD_NIBBLES = 0
+RAM_CMD_NIBBLES = 2
+ADDR_NIBBLES = 6
+FLASH_DUMMY_NIBBLES = 2
+TURNAROUND_CYCLES = 4
+
+# Python model of the QSPI PMOD: the flash and both PSRAMs, addressed the same
+# way as the core sees them, so flash is at 0, RAM A at 0x1000000 and RAM B at 0x1800000.
+#
+# Once started it serves every QSPI transaction in the background, continuous reads
+# and writes of any length, until stopped.  The data goes through the latency buffer
+# in tb.v, so it is returned with the latency_cfg given to reset.
+#
+#   mem = QspiMemory(dut)
+#   mem.write(0, program)
+#   await reset(dut, latency)
+#   mem.start()
+#   await ClockCycles(dut.clk, 1000)
+#   assert mem.read_word(0x1000000) == expected
+class QspiMemory:
+
+    def __init__(self, dut):
+        self.dut = dut
+        self.pages = {}
+        self.task = None
+
+    def _page(self, addr):
+        page = self.pages.get(addr >> PAGE_BITS)
+        if page is None:
+            page = self.pages[addr >> PAGE_BITS] = bytearray(PAGE_SIZE)
+        return page
+
+    # Write bytes to memory at addr
+    def write(self, addr, data):
+        data = memoryview(bytes(data))
+        i = 0
+        while i < len(data):
+            offset = (addr + i) & (PAGE_SIZE - 1)
+            n = min(PAGE_SIZE - offset, len(data) - i)
+            self._page(addr + i)[offset:offset + n] = data[i:i + n]
+            i += n
+
+    # Read length bytes from addr, memory that has never been written reads as zero
+    def read(self, addr, length):
+        data = bytearray(length)
+        i = 0
+        while i < length:
+            offset = (addr + i) & (PAGE_SIZE - 1)
+            n = min(PAGE_SIZE - offset, length - i)
+            page = self.pages.get((addr + i) >> PAGE_BITS)
+            if page is not None:
+                data[i:i + n] = page[offset:offset + n]
+            i += n
+        return bytes(data)
+
+    def write_word(self, addr, value):
+        self.write(addr, (value & 0xFFFFFFFF).to_bytes(4, "little"))
+
+    def read_word(self, addr):
+        return int.from_bytes(self.read(addr, 4), "little")
+
+    def start(self):
+        assert self.task is None
+        self.dut.qspi_model_data.value = 0
+        self.dut.qspi_model_enable.value = 1
+        self.task = cocotb.start_soon(self._run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.kill()
+            self.task = None
+        self.dut.qspi_model_enable.value = 0
+
+    # Commands and addresses are sampled on the rising edge of the QSPI clock,
+    # read data is changed on the falling edge.
+    async def _run(self):
+        dut = self.dut
+        clk_out = dut.qspi_clk_out
+        data_out = dut.qspi_data_out
+        model_data = dut.qspi_model_data
+        flash_select = dut.qspi_flash_select
+        clk_edge = Edge(clk_out)
+        deselect = RisingEdge(dut.qspi_deselected)
+
+        count = 0
+        while True:
+            trigger = await First(clk_edge, deselect)
+            if trigger is deselect:
+                count = 0
+                continue
+
+            if clk_out.value == 1:
+                if count == 0:
+                    is_flash = flash_select.value == 0
+                    cmd_end = FLASH_CMD_NIBBLES if is_flash else RAM_CMD_NIBBLES
+                    addr_end = cmd_end + ADDR_NIBBLES
+                    dummy_end = addr_end + (FLASH_DUMMY_NIBBLES if is_flash else 0)
+                    data_start = dummy_end + TURNAROUND_CYCLES
+                    cmd = 0x0B if is_flash else 0
+                    addr = 0x0 if is_flash else 0x1000000
+
+                count += 1
+                if count <= cmd_end:
+                    cmd = (cmd << 4) | data_out.value.integer
+                elif count <= addr_end:
+                    addr |= data_out.value.integer << (4 * (addr_end - count))
+                    if count == addr_end:
+                        assert cmd in (0x02, 0x0B), f"Unknown PSRAM command {cmd:02x}"
+                        if cmd == 0x02:
+                            data_start = addr_end + 1
+                elif count <= dummy_end:
+                    assert data_out.value.integer == 0xA
+                elif cmd == 0x02:
+                    n = count - data_start
+                    byte_addr = addr + (n >> 1)
+                    page = self._page(byte_addr)
+                    offset = byte_addr & (PAGE_SIZE - 1)
+                    if n & 1:
+                        page[offset] = (page[offset] & 0xF0) | data_out.value.integer
+                    else:
+                        page[offset] = (page[offset] & 0x0F) | (data_out.value.integer << 4)
+            elif count >= data_start and cmd == 0x0B:
+                n = count - data_start
+                byte_addr = addr + (n >> 1)
+                page = self.pages.get(byte_addr >> PAGE_BITS)
+                byte = page[byte_addr & (PAGE_SIZE - 1)] if page is not None else 0
+                model_data.value = byte & 0xF if n & 1 else byte >> 4
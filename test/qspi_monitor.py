@@ -0,0 +1,174 @@
+# SPDX-FileCopyrightText: © 2025 Tiny Tapeout
+# SPDX-License-Identifier: Apache-2.0
+
+from array import array
+
+import cocotb
+from cocotb.triggers import RisingEdge, FallingEdge, First
+from cocotb.utils import get_sim_time
+
+ADDR_NIBBLES = 6
+FLASH_DUMMY_NIBBLES = 2
+RAM_CMD_NIBBLES = 2
+TURNAROUND_NIBBLES = 4
+
+FLASH = 0
+RAM_A = 1
+RAM_B = 2
+CHIP_NAMES = ("flash", "RAM A", "RAM B")
+
+# The flash is always read in continuous read mode, so sends no command
+FLASH_READ = 0x0B
+RAM_READ = 0x0B
+RAM_WRITE = 0x02
+
+# Passive monitor of the QSPI traffic between the core and the PMOD.
+# It only watches the bus, so it can run alongside the harness drivers, the NOP
+# feeder, the simulated PMOD or a QspiMemory.
+#
+# Every transaction is decoded into the log: the chip, command, address, data bytes,
+# start time and busy cycles, kept in arrays so that long runs stay compact.
+# The start of each transaction is captured by tb.v, so this costs two wakeups
+# per transaction.  stats() totals the log for each chip.
+#
+# One transaction in check_every is also followed clock by clock and checked: only
+# one chip selected, the data lines driven by the core for the command, address and
+# dummy nibbles and for write data, released for the turnaround and read data, a
+# known PSRAM command and the flash dummy nibbles 0xA.  check_every of 0 checks nothing.
+#
+#   monitor = QspiMonitor(dut)
+#   monitor.start()
+#   ...
+#   monitor.log_stats(dut._log)
+class QspiMonitor:
+
+    def __init__(self, dut, check_every=0):
+        self.dut = dut
+        self.check_every = check_every
+        self.task = None
+        self.checked = 0
+        self.clear()
+
+    def clear(self):
+        self.chips = array("B")
+        self.cmds = array("B")
+        self.addrs = array("L")
+        self.nbytes = array("L")
+        self.start_times = array("Q")
+        self.cycles = array("L")
+
+    def __len__(self):
+        return len(self.chips)
+
+    # Returns transaction i in the log as (chip, cmd, addr, nbytes, start_time, cycles)
+    def __getitem__(self, i):
+        return (self.chips[i], self.cmds[i], self.addrs[i], self.nbytes[i],
+                self.start_times[i], self.cycles[i])
+
+    def start(self):
+        assert self.task is None
+        self.task = cocotb.start_soon(self._run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.kill()
+            self.task = None
+
+    # Transactions, data bytes and busy cycles for each chip, keyed by chip name
+    def stats(self):
+        stats = {name: {"transactions": 0, "bytes": 0, "busy_cycles": 0} for name in CHIP_NAMES}
+        for chip, nbytes, cycles in zip(self.chips, self.nbytes, self.cycles):
+            chip_stats = stats[CHIP_NAMES[chip]]
+            chip_stats["transactions"] += 1
+            chip_stats["bytes"] += nbytes
+            chip_stats["busy_cycles"] += cycles
+        return stats
+
+    # Log the stats, with the fraction of the cycles since elapsed_from each chip was busy
+    def log_stats(self, log, elapsed_from=0):
+        elapsed = max(1, (get_sim_time() - elapsed_from) // self.dut._clk_period)
+        for name, chip_stats in self.stats().items():
+            if chip_stats["transactions"]:
+                log.info(f"QSPI {name}: {chip_stats['transactions']} transactions, {chip_stats['bytes']} bytes, "
+                         f"{chip_stats['busy_cycles']} busy cycles ({chip_stats['busy_cycles'] / elapsed:.1%})")
+
+    async def _run(self):
+        dut = self.dut
+        deselected = dut.qspi_deselected
+        selects = (dut.qspi_flash_select, dut.qspi_ram_a_select, dut.qspi_ram_b_select)
+        header = dut.qspi_txn_header
+        clocks = dut.qspi_txn_clocks
+        select_fall = FallingEdge(deselected)
+        select_rise = RisingEdge(deselected)
+        transactions = 0
+
+        # Don't start part way through a transaction
+        if deselected.value != 1:
+            await select_rise
+
+        while True:
+            await select_fall
+            start_time = get_sim_time()
+            selected = [chip for chip, select in enumerate(selects) if select.value == 0]
+            assert len(selected) == 1, "More than one QSPI chip selected"
+            chip = selected[0]
+
+            if self.check_every and transactions % self.check_every == 0:
+                await self._check(selects[chip], chip == FLASH)
+                self.checked += 1
+            else:
+                await select_rise
+            transactions += 1
+
+            self._record(chip, header.value.integer, clocks.value.integer, start_time)
+
+    def _record(self, chip, header, clocks, start_time):
+        # header holds the first min(clocks, 8) nibbles, the last in the bottom bits
+        header <<= 4 * max(0, 8 - clocks)
+        if chip == FLASH:
+            cmd = FLASH_READ
+            addr = header >> 8
+            data_start = ADDR_NIBBLES + FLASH_DUMMY_NIBBLES + TURNAROUND_NIBBLES
+        else:
+            cmd = header >> 24
+            addr = (header & 0xFFFFFF) | (0x1800000 if chip == RAM_B else 0x1000000)
+            data_start = RAM_CMD_NIBBLES + ADDR_NIBBLES
+            if cmd != RAM_WRITE:
+                data_start += TURNAROUND_NIBBLES
+
+        self.chips.append(chip)
+        self.cmds.append(cmd)
+        self.addrs.append(addr)
+        self.nbytes.append(max(0, clocks - data_start) // 2)
+        self.start_times.append(start_time)
+        self.cycles.append((get_sim_time() - start_time) // self.dut._clk_period)
+
+    async def _check(self, select, is_flash):
+        dut = self.dut
+        data_out = dut.qspi_data_out
+        data_oe = dut.qspi_data_oe
+        clk_rise = RisingEdge(dut.qspi_clk_out)
+        select_rise = RisingEdge(dut.qspi_deselected)
+
+        cmd_end = 0 if is_flash else RAM_CMD_NIBBLES
+        addr_end = cmd_end + ADDR_NIBBLES
+        dummy_end = addr_end + (FLASH_DUMMY_NIBBLES if is_flash else 0)
+        cmd = FLASH_READ if is_flash else 0
+
+        n = 0
+        while await First(clk_rise, select_rise) is clk_rise:
+            assert select.value == 0 and dut.qspi_deselected.value == 0
+            oe = data_oe.value.integer
+            if n < addr_end:
+                assert oe == 0xF, f"Data lines not driven for QSPI nibble {n}"
+                if n < cmd_end:
+                    cmd = (cmd << 4) | data_out.value.integer
+                elif n == cmd_end:
+                    assert cmd in (RAM_READ, RAM_WRITE), f"Unknown PSRAM command {cmd:02x}"
+            elif n < dummy_end:
+                assert oe == 0xF and data_out.value.integer == 0xA, "Bad flash dummy nibble"
+            elif cmd == RAM_WRITE:
+                assert oe == 0xF, "Data lines not driven for PSRAM write data"
+            else:
+                assert oe == 0, "Data lines driven during turnaround or read data"
+            n += 1
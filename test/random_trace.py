@@ -0,0 +1,258 @@
+# SPDX-FileCopyrightText: © 2025 Tiny Tapeout
+# SPDX-License-Identifier: Apache-2.0
+
+import json
+import os
+import re
+import traceback
+
+from cocotb.triggers import ClockCycles
+
+from test_util import reset, start_read, send_instr, expect_load, expect_store, preload_regs, dump_regs
+from tqv_model import TinyQVModel, memory_access, ADDR_MASK, RAM_A_ADDR
+from retire_monitor import RetireMonitor
+
+# Loads and stores below this go to the PSRAM and are checked on the QSPI bus, those
+# above to the latch RAM inside the core.
+PSRAM_LIMIT = 0x4000000
+PSRAM_END = 0x2000000
+
+# Set TQV_SHRINK=1 to shrink the program of a failing random test before it fails.
+# TQV_SHRINK_RUNS limits the number of candidate programs simulated.
+SHRINK = os.environ.get("TQV_SHRINK", "0") == "1"
+SHRINK_RUNS = int(os.environ.get("TQV_SHRINK_RUNS", "500"))
+
+# The program a random test fed the core: the registers preloaded before it starts,
+# and each instruction with the value returned if it is a load, None otherwise.
+# Everything else a run depends on is made by the trace itself: the base registers
+# of loads and stores are set by instructions in the trace, and PSRAM contents are
+# never read back other than through loads, whose values are part of the trace.
+class Trace:
+
+    def __init__(self, regs, steps=None):
+        self.regs = list(regs)
+        self.steps = list(steps or [])
+
+    def __len__(self):
+        return len(self.steps)
+
+    def save(self, filename):
+        with open(filename, "w") as f:
+            json.dump({"regs": self.regs, "steps": self.steps}, f, indent=1)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename) as f:
+            data = json.load(f)
+        return cls(data["regs"], [tuple(step) for step in data["steps"]])
+
+    def log(self, log):
+        for i, value in enumerate(self.regs):
+            if i not in (0, 3, 4):
+                log.info(f"  x{i} = {value & 0xFFFFFFFF:08x}")
+        for instr, load_value in self.steps:
+            if load_value is None:
+                log.info(f"  {instr:08x}")
+            else:
+                log.info(f"  {instr:08x}  loads {load_value & 0xFFFFFFFF:08x}")
+
+    # Whether the trace can be run on its own: each load and store must go to the
+    # PSRAM.  Shrinking drops the instructions that set up base registers, so the
+    # candidates are run on the model first, which is far cheaper than simulating.
+    def is_valid(self):
+        model = TinyQVModel()
+        model.set_regs(self.regs)
+        for instr, load_value in self.steps:
+            access = memory_access(instr)
+            if access is not None:
+                is_store, nbytes, base_reg, imm = access
+                addr = (model.regs[base_reg] + imm) & ADDR_MASK
+                if not RAM_A_ADDR <= addr <= PSRAM_END - nbytes or (load_value is None) != is_store:
+                    return False
+                if not is_store:
+                    model.write(addr, (load_value & 0xFFFFFFFF).to_bytes(4, "little")[:nbytes])
+            model.execute(instr)
+        return True
+
+# Runs a program on the model alone and records it as a Trace, to see what a random
+# test feeds the core without simulating it.  TraceRunner runs it on the core too.
+class ModelRunner:
+
+    def __init__(self, model, regs):
+        self.model = model
+        self.trace = Trace(regs)
+
+    async def start(self):
+        self.model.set_regs(self.trace.regs)
+
+    def stop(self):
+        pass
+
+    # Execute one instruction, load_value is the data returned if it is a load
+    async def step(self, instr, load_value=None):
+        self._execute(instr, load_value)
+
+    # Execute instr on the model, returning the load or store it makes as
+    # (is_store, nbytes, addr), or None
+    def _execute(self, instr, load_value):
+        model = self.model
+        access = memory_access(instr)
+        if access is not None:
+            is_store, nbytes, base_reg, imm = access
+            addr = (model.regs[base_reg] + imm) & ADDR_MASK
+            if not is_store:
+                model.write(addr, (load_value & 0xFFFFFFFF).to_bytes(4, "little")[:nbytes])
+            access = (is_store, nbytes, addr)
+
+        self.trace.steps.append((instr, load_value))
+        model.execute(instr)
+        return access
+
+# Runs a program on the core and the model in step, checking each register write
+# with a RetireMonitor and the data of each PSRAM load and store, and records it
+# as a Trace.
+#
+#   runner = TraceRunner(dut, model, values)
+#   await runner.start()
+#   await runner.step(instr)
+#   ...
+#   await runner.finish()
+class TraceRunner(ModelRunner):
+
+    def __init__(self, dut, model, regs):
+        super().__init__(model, regs)
+        self.dut = dut
+        self.retire = RetireMonitor(dut, model)
+
+    # Preload the registers and start checking write-backs
+    async def start(self):
+        await super().start()
+        await preload_regs(self.dut, self.trace.regs)
+        self.retire.start()
+
+    def stop(self):
+        self.retire.stop()
+
+    async def step(self, instr, load_value=None):
+        access = self._execute(instr, load_value)
+        await send_instr(self.dut, instr)
+
+        if access is not None and access[2] < PSRAM_LIMIT:
+            is_store, nbytes, addr = access
+            assert RAM_A_ADDR <= addr < PSRAM_END, f"Access to {addr:07x} outside PSRAM"
+            if is_store:
+                assert await expect_store(self.dut, addr, nbytes) == int.from_bytes(self.model.read(addr, nbytes), "little")
+            else:
+                await expect_load(self.dut, addr, load_value, nbytes)
+        self.retire.check()
+
+    # Wait for the last write-backs, then check every register against the model
+    async def finish(self):
+        await self.retire.finish()
+        self.dut._log.info(f"{self.retire.retired} register writes matched the model")
+
+        values = await dump_regs(self.dut)
+        for i in range(16):
+            assert values[i] & 0xFFFFFFFF == self.model.regs[i], \
+                f"x{i} is {values[i] & 0xFFFFFFFF:08x}, model has {self.model.regs[i]:08x}"
+
+# Reset the core and run a trace from the start, on a model of its own.
+# Raises AssertionError if the core and the model disagree.
+async def run_trace(dut, trace):
+    await reset(dut, 1, 0x83)
+    await ClockCycles(dut.clk, 1)
+    await start_read(dut, 0)
+
+    runner = TraceRunner(dut, TinyQVModel(), trace.regs)
+    try:
+        await runner.start()
+        for instr, load_value in trace.steps:
+            await runner.step(instr, load_value)
+        await runner.finish()
+    finally:
+        runner.stop()
+
+# What a failure is, to tell whether a smaller program fails the same way: where the
+# assertion was raised, and its message without the numbers in it, which keeps the
+# registers it names but not the values.
+_NUMBERS = re.compile(r"\b(?:[0-9a-fA-F]{7,8}|[0-9]+)\b")
+
+def failure_signature(e):
+    frame = traceback.extract_tb(e.__traceback__)[-1]
+    return frame.filename, frame.lineno, _NUMBERS.sub("#", str(e))
+
+# Delta debugging (Zeller's ddmin) over the steps of a failing trace: try each chunk
+# of the steps on its own, then the steps without each chunk, keeping any candidate
+# that still fails, and split more finely when none does.  The result fails, and
+# removing any one chunk at the finest split makes it pass.
+async def _ddmin(steps, fails):
+    n = 2
+    while len(steps) >= 2:
+        size = -(-len(steps) // n)
+        chunks = [steps[i:i + size] for i in range(0, len(steps), size)]
+        for chunk in chunks:
+            if await fails(chunk):
+                steps, n = chunk, 2
+                break
+        else:
+            for i in range(len(chunks)):
+                complement = [step for chunk in chunks[:i] + chunks[i + 1:] for step in chunk]
+                if await fails(complement):
+                    steps, n = complement, max(n - 1, 2)
+                    break
+            else:
+                if n >= len(steps):
+                    break
+                n = min(2 * n, len(steps))
+    return steps
+
+# Shrink a failing trace to a small program that still fails, by rerunning ever
+# smaller parts of it, then clearing the preloaded registers it doesn't need.
+# A candidate only counts as failing if it fails the same way as failure, the
+# AssertionError the trace raised, or as the trace itself does when replayed if
+# that isn't given.  The core is reset for each run.  At most max_runs candidates
+# are simulated.
+async def shrink(dut, trace, failure=None, max_runs=SHRINK_RUNS):
+    runs = 0
+    target = failure_signature(failure) if failure is not None else None
+
+    async def fails(regs, steps):
+        nonlocal runs, target
+        candidate = Trace(regs, steps)
+        if runs >= max_runs or not candidate.is_valid():
+            return False
+        runs += 1
+        try:
+            await run_trace(dut, candidate)
+        except AssertionError as e:
+            if target is None:
+                target = failure_signature(e)
+            return failure_signature(e) == target
+        return False
+
+    if not trace.is_valid() or not await fails(trace.regs, trace.steps):
+        dut._log.warning("Failing trace can't be replayed on its own or doesn't fail the same way, not shrunk")
+        return trace
+
+    steps = await _ddmin(trace.steps, lambda steps: fails(trace.regs, steps))
+    regs = list(trace.regs)
+    for i in range(1, 16):
+        if i not in (3, 4) and regs[i] != 0:
+            cleared = regs[:i] + [0] + regs[i + 1:]
+            if await fails(cleared, steps):
+                regs = cleared
+
+    dut._log.info(f"Shrunk {len(trace)} instructions to {len(steps)} in {runs} runs")
+    return Trace(regs, steps)
+
+# Called by the random tests as a seed fails with failure: with TQV_SHRINK=1, shrink the
+# trace, log the minimal program and save it to shrink-<seed>.json for test_random_replay.
+async def shrink_failure(dut, trace, seed, failure):
+    if not SHRINK:
+        return
+    dut._log.info(f"Shrinking the failing program of seed {seed}")
+    minimal = await shrink(dut, trace, failure)
+    filename = f"shrink-{seed}.json"
+    minimal.save(filename)
+    dut._log.info(f"Failing program, replay with TQV_REPLAY_TRACE={filename}:")
+    minimal.log(dut._log)
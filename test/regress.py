@@ -0,0 +1,176 @@
+# SPDX-FileCopyrightText: © 2025 Tiny Tapeout
+# SPDX-License-Identifier: Apache-2.0
+
+# Runs the random instruction tests over a range of seeds, split into shards run in
+# parallel, one simulator per worker.
+#
+# The testbench is compiled once, without waves, into its own sim_build that all the
+# workers share.  Each shard runs one random test for a few consecutive seeds, set
+# through TQV_RANDOM_SEED and TQV_RANDOM_SEEDS, and writes its own results file and
+# log to the output directory.  When all the shards are done their results are merged
+# into results.xml, with the seeds each test case ran in its name, and the failing
+# seeds are written to replay.json with the command to run each on its own.
+#
+#   python regress.py --seeds 1000 --jobs 16
+#   python regress.py --replay regress/replay.json
+#
+# Extra arguments are passed to make, e.g. GATES=yes.
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+MAKEFILE = "test_basic.mk"
+TESTS = ("test_random", "test_random_alu")
+
+SEED_LOG = re.compile(r"Running test with seed (\d+)")
+
+class Shard:
+    def __init__(self, test, seed, count, out_dir):
+        self.test = test
+        self.seed = seed
+        self.count = count
+        self.name = f"{test}-{seed}"
+        self.results_file = os.path.join(out_dir, self.name + ".xml")
+        self.log_file = os.path.join(out_dir, self.name + ".log")
+        self.elapsed = 0.
+
+    def env(self):
+        env = dict(os.environ, PWD=TEST_DIR, TQV_RANDOM_SEED=str(self.seed), TQV_RANDOM_SEEDS=str(self.count))
+        env.pop("MAKEFLAGS", None)
+        return env
+
+# RTL and gate level builds are kept apart
+def sim_build(make_args):
+    return "sim_build/regress_gl" if "GATES=yes" in make_args else "sim_build/regress"
+
+def make_command(make_args, *targets):
+    return ["make", "-f", MAKEFILE, f"SIM_BUILD={sim_build(make_args)}", "WAVES=0", *make_args, *targets]
+
+# The shell command to rerun one seed of a test on its own, with waves
+def replay_command(test, seed, make_args):
+    return " ".join([f"TQV_RANDOM_SEED={seed}", "TQV_RANDOM_SEEDS=1", "make", "-B", "-f", MAKEFILE,
+                     f"TESTCASE={test}", *make_args])
+
+def build(make_args):
+    env = dict(os.environ, PWD=TEST_DIR)
+    subprocess.run(make_command(make_args, f"{sim_build(make_args)}/sim.vvp"), cwd=TEST_DIR, env=env, check=True)
+
+def run_shard(shard, make_args):
+    if os.path.exists(shard.results_file):
+        os.remove(shard.results_file)
+    start = time.monotonic()
+    with open(shard.log_file, "w") as log:
+        subprocess.run(make_command(make_args, f"TESTCASE={shard.test}",
+                                    f"COCOTB_RESULTS_FILE={shard.results_file}", "regression"),
+                       cwd=TEST_DIR, env=shard.env(), stdout=log, stderr=subprocess.STDOUT)
+    shard.elapsed = time.monotonic() - start
+    return shard
+
+# The test cases in the shard's results, or a failed case if the simulator crashed
+def shard_cases(shard):
+    try:
+        cases = ET.parse(shard.results_file).getroot().iter("testcase")
+    except (OSError, ET.ParseError):
+        case = ET.Element("testcase", name=shard.test, classname="test")
+        ET.SubElement(case, "failure", message="Simulation crashed, see " + shard.log_file)
+        cases = [case]
+    return [case for case in cases if case.get("name") == shard.test]
+
+# The seed the failing test was running, the last one it logged
+def failing_seed(shard):
+    try:
+        with open(shard.log_file) as f:
+            seeds = SEED_LOG.findall(f.read())
+    except OSError:
+        seeds = []
+    return int(seeds[-1]) if seeds else shard.seed
+
+def merge(shards, results_file):
+    suite = ET.Element("testsuite", name="all", package="all")
+    failures = []
+    for shard in shards:
+        for case in shard_cases(shard):
+            case.set("name", f"{shard.test}[{shard.seed}+{shard.count}]")
+            suite.append(case)
+            if case.find("failure") is not None or case.find("error") is not None:
+                failures.append(shard)
+    root = ET.Element("testsuites", name="results")
+    root.append(suite)
+    ET.ElementTree(root).write(results_file, encoding="UTF-8", xml_declaration=True)
+    return failures
+
+def write_manifest(failures, make_args, manifest_file):
+    entries = []
+    for shard in failures:
+        seed = failing_seed(shard)
+        entries.append({
+            "test": shard.test,
+            "seed": seed,
+            "shard_seed": shard.seed,
+            "shard_seeds": shard.count,
+            "log": shard.log_file,
+            "command": replay_command(shard.test, seed, make_args),
+        })
+    with open(manifest_file, "w") as f:
+        json.dump({"make_args": make_args, "failures": entries}, f, indent=2)
+    return entries
+
+def main():
+    parser = argparse.ArgumentParser(description="Parallel random instruction regression")
+    parser.add_argument("--seeds", type=int, default=64, help="number of seeds for each test")
+    parser.add_argument("--first-seed", type=int, default=None, help="first seed, random by default")
+    parser.add_argument("--shard-size", type=int, default=4, help="seeds run by each simulator")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="simulators run at once")
+    parser.add_argument("--tests", default=",".join(TESTS), help="comma separated random tests to run")
+    parser.add_argument("--out", default="regress", help="directory for the results, logs and manifest")
+    parser.add_argument("--replay", default=None, help="rerun the failing seeds in a replay manifest")
+    parser.add_argument("make_args", nargs="*", help="variables passed to make, e.g. GATES=yes")
+    args = parser.parse_args()
+
+    out_dir = os.path.abspath(args.out)
+    os.makedirs(out_dir, exist_ok=True)
+    make_args = args.make_args
+
+    if args.replay:
+        with open(args.replay) as f:
+            manifest = json.load(f)
+        make_args = make_args or manifest["make_args"]
+        shards = [Shard(entry["test"], entry["seed"], 1, out_dir) for entry in manifest["failures"]]
+    else:
+        first_seed = args.first_seed
+        if first_seed is None:
+            first_seed = int.from_bytes(os.urandom(4), "little")
+        shards = [Shard(test, seed, min(args.shard_size, first_seed + args.seeds - seed), out_dir)
+                  for test in args.tests.split(",")
+                  for seed in range(first_seed, first_seed + args.seeds, args.shard_size)]
+
+    build(make_args)
+
+    start = time.monotonic()
+    # The workers are threads, each waiting on its own simulator process
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        futures = [pool.submit(run_shard, shard, make_args) for shard in shards]
+        for done, future in enumerate(as_completed(futures), 1):
+            shard = future.result()
+            print(f"[{done}/{len(shards)}] {shard.name} +{shard.count} seeds, {shard.elapsed:.1f}s", flush=True)
+    elapsed = time.monotonic() - start
+
+    failures = merge(shards, os.path.join(TEST_DIR, "results.xml"))
+    entries = write_manifest(failures, make_args, os.path.join(out_dir, "replay.json"))
+
+    sim_time = sum(shard.elapsed for shard in shards)
+    print(f"{len(shards)} shards in {elapsed:.1f}s, {sim_time / max(elapsed, 1e-9):.1f}x parallel speedup")
+    for entry in entries:
+        print(f"FAIL {entry['test']} seed {entry['seed']}: {entry['command']}")
+    return 1 if entries else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
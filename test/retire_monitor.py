@@ -0,0 +1,127 @@
+# SPDX-FileCopyrightText: © 2025 Tiny Tapeout
+# SPDX-License-Identifier: Apache-2.0
+
+from collections import deque
+
+import cocotb
+from cocotb.triggers import RisingEdge, ClockCycles
+
+from test_util import handles, start_nops, stop_nops, assert_debug_signal_output, DEBUG_SIGNAL_SELECT
+from tqv_model import written_regs
+
+# Compares each register write-back of the core against the reference model as it
+# happens, so a random test fails at the first instruction that goes wrong rather
+# than at the register dump at the end.
+#
+# Every instruction the model executes queues the values it writes, and the monitor
+# captures the values the core writes back, in the same way as dump_regs: when debug
+# signal 13 goes high the value follows a nibble a cycle on the debug register port.
+# In RTL simulations these are read from the project's debug_signal and debug_rd_r,
+# so the debug register data need not be enabled on uo_out.  Otherwise uo_out is used,
+# which needs debug register data enabled and the debug signal on uo_out[7], by ui_in
+# being 0x83 at reset and uo_out[7] not claimed by a peripheral since, like dump_regs.
+# start() checks uo_out[7] where that can be seen.  ui_in[6:3] is changed while the
+# monitor runs.
+#
+# A divergence stops the monitor and is raised by the next check() or finish(), in the
+# test's own coroutine, so a test can catch it and carry on, e.g. to shrink the program.
+#
+#   retire = RetireMonitor(dut, model)
+#   retire.start()
+#   model.execute(instr)
+#   await send_instr(dut, instr)
+#   retire.check()
+#   ...
+#   await retire.finish()
+class RetireMonitor:
+
+    def __init__(self, dut, model):
+        self.dut = dut
+        self.model = model
+        self.task = None
+        self.expected = deque()
+        self.retired = 0
+        self.ui_in = None
+        self.error = None
+
+    def start(self):
+        assert self.task is None
+        h = handles(self.dut)
+        assert_debug_signal_output(h)
+        self.ui_in = h.ui_in_base.value.integer
+        h.ui_in_base.value = (self.ui_in & 0x87) | DEBUG_SIGNAL_SELECT
+        self.model.on_execute = self._expect
+        self.task = cocotb.start_soon(self._run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.kill()
+            self.task = None
+            self.model.on_execute = None
+            handles(self.dut).ui_in_base.value = self.ui_in
+
+    # Raise the divergence the monitor found, if any
+    def check(self):
+        if self.error is not None:
+            raise self.error
+
+    # Feed NOPs until the core has written back everything the model has executed,
+    # then stop.  The core is left ready for send_instr.
+    async def finish(self, timeout_cycles=1000):
+        clk = handles(self.dut).clk
+        await start_nops(self.dut)
+        for _ in range(timeout_cycles // 8):
+            if not self.expected or self.error is not None:
+                break
+            await ClockCycles(clk, 8)
+        await stop_nops(self.dut)
+        self.stop()
+        self.check()
+        assert not self.expected, f"{len(self.expected)} register writes not seen, next {self._describe(self.expected[0])}"
+
+    def _expect(self, instr):
+        regs = self.model.regs
+        for reg in written_regs(instr):
+            self.expected.append((instr, reg, regs[reg]))
+
+    def _describe(self, entry):
+        instr, reg, value = entry
+        return f"x{reg} = {value:08x} from instruction {instr:08x}"
+
+    def _retire(self, value):
+        assert self.expected, f"Unexpected register write {value:08x} after {self.retired} write-backs"
+        entry = self.expected.popleft()
+        assert value == entry[2], f"Write-back {self.retired} diverged: core wrote {value:08x}, model has {self._describe(entry)}"
+        self.retired += 1
+
+    async def _run(self):
+        h = handles(self.dut)
+        if h.core_debug_signal is not None:
+            signal = h.core_debug_signal
+            data = h.core_debug_rd
+            shift = 0
+        else:
+            signal = h.debug_signal
+            data = h.uo_out
+            shift = 2
+        signal_rise = RisingEdge(signal)
+        clk_fall = h.clk_fall
+
+        # Sampled mid-cycle: the signal is high for the cycle before each nibble
+        while True:
+            await signal_rise
+            await clk_fall
+
+            # Writes back to back keep the signal high
+            while True:
+                value = 0
+                for j in range(8):
+                    await clk_fall
+                    value |= ((data.value.integer >> shift) & 0xF) << (4 * j)
+                try:
+                    self._retire(value)
+                except AssertionError as e:
+                    self.error = e
+                    return
+                if signal.value != 1:
+                    break
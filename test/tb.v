@@ -17,8 +17,9 @@ module tb ();
   wire [7:0] uio_oe;
 
   wire [3:0] qspi_data_in;
+  wire [3:0] qspi_data_to_core;
   reg [2:0] latency_cfg;
-  assign {uio_in[5:4], uio_in[2:1]} = rst_n ? qspi_data_in : {1'b0, latency_cfg};
+  assign {uio_in[5:4], uio_in[2:1]} = rst_n ? qspi_data_to_core : {1'b0, latency_cfg};
 
   wire [3:0] qspi_data_out = {uio_out[5:4], uio_out[2:1]};
   wire [3:0] qspi_data_oe  = {uio_oe[5:4],  uio_oe[2:1]};
@@ -68,4 +69,143 @@ module tb ();
       .rst_n  (rst_n)     // not reset
   );
 
+  // Nibble handshake.  A nibble driven to the core has been consumed at the falling
+  // edge of clk where qspi_clk_out is first seen low after being high, that is when
+  // send_instr in test_util.py and the NOP feeder move on to the next nibble.
+  // qspi_nibble_strobe toggles at each of those edges, and qspi_nibble_oe holds
+  // qspi_data_oe from while the QSPI clock was high, for the harness to check.
+  reg qspi_clk_seen;
+  reg qspi_nibble_strobe;
+  reg [3:0] qspi_nibble_oe;
+  initial begin
+    qspi_clk_seen = 0;
+    qspi_nibble_strobe = 0;
+  end
+  wire qspi_nibble_done = qspi_clk_seen && !qspi_clk_out;
+
+  always @(negedge clk) begin
+    if (qspi_clk_out) begin
+      qspi_clk_seen <= 1;
+      qspi_nibble_oe <= qspi_data_oe;
+    end else if (qspi_clk_seen) begin
+      qspi_clk_seen <= 0;
+      qspi_nibble_strobe <= !qspi_nibble_strobe;
+    end
+  end
+
+  // NOP feeder.  While nop_feed_en is set it answers the core's instruction fetches
+  // with "addi x0, x0, 0", with the same timing as send_instr.  Clearing nop_feed_en
+  // stops it at the end of the current instruction, nop_feed_busy falls when the
+  // harness may take over again.
+  reg nop_feed_en;
+  reg nop_feed_busy;
+  reg [2:0] nop_feed_nibble;
+  initial begin
+    nop_feed_en = 0;
+    nop_feed_busy = 0;
+    nop_feed_nibble = 0;
+  end
+
+  always @(negedge clk) begin
+    if (!rst_n) begin
+      nop_feed_busy <= 0;
+      nop_feed_nibble <= 0;
+    end else if (!nop_feed_busy) begin
+      if (nop_feed_en) nop_feed_busy <= 1;
+    end else if (qspi_nibble_done) begin
+      nop_feed_nibble <= nop_feed_nibble + 1;
+      if (nop_feed_nibble == 7 && !nop_feed_en) nop_feed_busy <= 0;
+    end
+  end
+
+  localparam NOP_INSTR = 32'h00000013;
+  wire nop_feed_active = nop_feed_en || nop_feed_busy;
+  wire [3:0] nop_feed_data = NOP_INSTR[{nop_feed_nibble ^ 3'd1, 2'b00} +:4];
+
+  // Simulated QSPI PMOD.  It observes all QSPI traffic, and while sim_qspi_enable
+  // is set it serves the reads instead of the cocotb harness.  This allows code
+  // placed in its flash by the harness to run on the core at full speed.
+  reg sim_qspi_enable;
+  initial sim_qspi_enable = 0;
+
+  // The Python QspiMemory model in qspi_memory.py drives qspi_model_data in place
+  // of the simulated PMOD while qspi_model_enable is set, with the same latency.
+  reg qspi_model_enable;
+  reg [3:0] qspi_model_data;
+  initial qspi_model_enable = 0;
+  wire qspi_deselected = qspi_flash_select && qspi_ram_a_select && qspi_ram_b_select;
+
+  wire [3:0] sim_qspi_data;
+  wire [3:0] sim_qspi_source = qspi_model_enable ? qspi_model_data : sim_qspi_data;
+  reg [19:0] sim_qspi_buffer;
+  always @(posedge clk) begin
+    sim_qspi_buffer <= {sim_qspi_buffer[15:0], sim_qspi_source};
+  end
+  wire [3:0] sim_qspi_data_delayed = (latency_cfg < 1) ? sim_qspi_source :
+                                     sim_qspi_buffer[(latency_cfg - 1) * 4 +:4];
+
+  assign qspi_data_to_core = (sim_qspi_enable || qspi_model_enable) ? sim_qspi_data_delayed :
+                             nop_feed_active ? nop_feed_data : qspi_data_in;
+
+  sim_qspi_pmod qspi (
+    .qspi_data_in(qspi_data_out & qspi_data_oe),
+    .qspi_data_out(sim_qspi_data),
+    .qspi_clk(qspi_clk_out),
+
+    .qspi_flash_select(qspi_flash_select),
+    .qspi_ram_a_select(qspi_ram_a_select),
+    .qspi_ram_b_select(qspi_ram_b_select)
+  );
+
+  // Start address of the most recent flash read, so the harness can tell
+  // when code running from the simulated flash has finished.
+  reg [23:0] flash_read_addr;
+  reg [2:0] flash_read_addr_nibbles;
+  always @(posedge qspi_clk_out or posedge qspi_flash_select) begin
+    if (qspi_flash_select) begin
+      flash_read_addr_nibbles <= 0;
+    end else if (flash_read_addr_nibbles != 6) begin
+      flash_read_addr <= {flash_read_addr[19:0], qspi_data_out};
+      flash_read_addr_nibbles <= flash_read_addr_nibbles + 1;
+    end
+  end
+
+  // The start of each QSPI transaction for QspiMonitor in qspi_monitor.py: the
+  // first 8 nibbles driven by the core and the number of QSPI clocks so far.
+  // Cleared as a chip is selected, so they are stable when it is deselected.
+  reg [31:0] qspi_txn_header;
+  reg [15:0] qspi_txn_clocks;
+  initial begin
+    qspi_txn_header = 0;
+    qspi_txn_clocks = 0;
+  end
+  always @(posedge qspi_clk_out or negedge qspi_deselected) begin
+    if (!qspi_deselected && !qspi_clk_out) begin
+      qspi_txn_clocks <= 0;
+    end else begin
+      if (qspi_txn_clocks < 8) qspi_txn_header <= {qspi_txn_header[27:0], qspi_data_out};
+      qspi_txn_clocks <= qspi_txn_clocks + 1;
+    end
+  end
+
+`ifndef GL_TEST
+  // Number of writes the core has made on the peripheral bus, the harness
+  // waits on this to know a store has completed without reading anything back.
+  // write_n stays active for the cycles a write takes, so each write is counted
+  // on the cycle it becomes active.
+  reg [31:0] peri_write_count;
+  reg peri_write_active;
+  wire peri_write = user_project.write_n != 2'b11 && user_project.addr[27];
+  always @(posedge clk) begin
+    if (!rst_n) begin
+      peri_write_count <= 0;
+      peri_write_active <= 0;
+    end else begin
+      if (peri_write && !peri_write_active)
+        peri_write_count <= peri_write_count + 1;
+      peri_write_active <= peri_write;
+    end
+  end
+`endif
+
 endmodule
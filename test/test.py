@@ -1,7 +1,11 @@
 # SPDX-FileCopyrightText: © 2024 Michael Bell
 # SPDX-License-Identifier: MIT
 
+import os
 import random
+import time
+
+import numpy as np
 
 import cocotb
 from cocotb.clock import Clock
@@ -14,7 +18,14 @@ from riscvmodel.regnames import x0, x1, sp, gp, tp, a0, a1, a2, a3, a4
 from riscvmodel import csrnames
 from riscvmodel.variant import RV32E
 
-from test_util import reset, start_read, send_instr, start_nops, stop_nops, read_byte, read_reg, load_reg, expect_load, expect_store
+from test_util import reset, start_read, send_instr, start_nops, stop_nops, read_byte, read_reg, expect_load
+from test_util import send_instr_polled, handles, expect_store_words, read_sim_ram
+from qspi_memory import QspiMemory
+from qspi_monitor import QspiMonitor
+from tqv import TinyQV
+from tqv_model import TinyQVModel
+from random_trace import Trace, ModelRunner, TraceRunner, run_trace, shrink_failure
+from instr_coverage import CoverageCollector
 
 @cocotb.test()
 async def test_start(dut):
@@ -83,7 +94,7 @@ async def test_start(dut):
     await Timer(bit_time, "ns")
     assert dut.uart_rts.value == 1
 
-    await stop_nops()
+    await stop_nops(dut)
 
     await send_instr(dut, InstructionLW(x1, tp, 0x84).encode())
     await read_byte(dut, x1, 0x2)
@@ -152,7 +163,7 @@ async def test_timer(dut):
 
     await start_nops(dut)
     await Timer(5, "us")
-    await stop_nops()
+    await stop_nops(dut)
 
     # Read time
     await send_instr(dut, InstructionLW(x1, x0, -0x100).encode())
@@ -208,7 +219,7 @@ async def test_time_limit(dut):
 
     await start_nops(dut)
     await Timer(5, "us")
-    await stop_nops()
+    await stop_nops(dut)
 
     # Read time
     await send_instr(dut, InstructionLW(x1, x0, -0x100).encode())
@@ -224,7 +235,7 @@ async def test_time_limit(dut):
 
     await start_nops(dut)
     await Timer(9, "us")
-    await stop_nops()
+    await stop_nops(dut)
 
     # Read time
     await send_instr(dut, InstructionLW(x1, x0, -0x100).encode())
@@ -284,7 +295,7 @@ async def test_debug_reg(dut):
     for j in range(8):
         assert ((dut.uo_out.value >> 2) & 0xF) == ((val >> (4 * j)) & 0xF)
         await ClockCycles(dut.clk, 1)
-    await stop_nops()
+    await stop_nops(dut)
 
 async def test_pwm(dut, pwm_value, pwm_strobe):
     
@@ -329,7 +340,7 @@ async def test_audio(dut):
 
         await test_pwm(dut, pwm, 1)
 
-        await stop_nops()
+        await stop_nops(dut)
 
 
 @cocotb.test()
@@ -397,6 +408,10 @@ async def test_load_throughput(dut):
         else:
             return 0xE002 | scrambled | (reg << 2)
 
+    monitor = QspiMonitor(dut)
+    monitor.start()
+    start_time = get_sim_time()
+
     # Should start reading flash after 1 cycle
     await ClockCycles(dut.clk, 1)
     await start_read(dut, 0)
@@ -409,6 +424,262 @@ async def test_load_throughput(dut):
         await send_instr(dut, encode_cswsp(tp, a2, 0x3c0))
         await expect_load(dut, 0x1001000 + i*4, i)
 
+    monitor.stop()
+    monitor.log_stats(dut._log, start_time)
+    assert monitor.stats()["RAM A"]["transactions"] == 32
+
+@cocotb.test()
+async def test_send_instr_wakeups(dut):
+    dut._log.info("Start")
+
+    clock = Clock(dut.clk, 15.624, units="ns")
+    cocotb.start_soon(clock.start())
+
+    # Reset
+    await reset(dut)
+
+    # Should start reading flash after 1 cycle
+    await ClockCycles(dut.clk, 1)
+    await start_read(dut, 0)
+
+    # Compare the number of times Python is woken per instruction fetched by the
+    # edge driven send_instr and the original polling implementation.
+    q = handles(dut)
+    for name, driver in (("polled", send_instr_polled), ("edge driven", send_instr)):
+        wakeups = q.wakeups
+        start_time = get_sim_time("ns")
+        for i in range(32):
+            await driver(dut, InstructionADDI(a0, a0, i).encode())
+            await driver(dut, 0x0001)
+        per_instr = (q.wakeups - wakeups) / 64
+        dut._log.info(f"send_instr {name}: {per_instr:.2f} wakeups per instruction, {(get_sim_time('ns') - start_time) / 64:.1f}ns per instruction")
+
+    assert await read_reg(dut, a0) == sum(range(32)) * 2
+
+@cocotb.test()
+async def test_handle_cache(dut):
+    dut._log.info("Start")
+
+    clock = Clock(dut.clk, 15.624, units="ns")
+    cocotb.start_soon(clock.start())
+
+    # Reset
+    await reset(dut)
+    await ClockCycles(dut.clk, 1)
+    await start_read(dut, 0)
+    await start_nops(dut)
+
+    # Compare the Python time spent reading the signals the QSPI drivers check on
+    # every half clock, looked up through the hierarchy and from the cached handles.
+    # The timings depend on the machine, so are only logged.
+    cycles = 256
+    h = handles(dut)
+    lookup_time = 0.
+    cached_time = 0.
+    for i in range(cycles):
+        await FallingEdge(dut.clk)
+        start = time.perf_counter()
+        dut.qspi_flash_select.value, dut.qspi_clk_out.value, dut.qspi_data_oe.value, dut.qspi_data_out.value
+        lookup_time += time.perf_counter() - start
+        start = time.perf_counter()
+        h.flash_select.value, h.clk_out.value, h.data_oe.value, h.data_out.value
+        cached_time += time.perf_counter() - start
+
+    await stop_nops(dut)
+    dut._log.info(f"Signal reads: {lookup_time / cycles * 1e6:.2f}us per cycle by lookup, "
+                  f"{cached_time / cycles * 1e6:.2f}us per cycle cached, "
+                  f"saving {(lookup_time - cached_time) / cycles * 1e6:.2f}us per simulated cycle")
+
+@cocotb.test()
+async def test_qspi_memory(dut):
+    dut._log.info("Start")
+
+    clock = Clock(dut.clk, 15.624, units="ns")
+    cocotb.start_soon(clock.start())
+
+    program = [
+        InstructionLW(a0, gp, 0),
+        InstructionLW(a1, gp, 4),
+        InstructionADD(a2, a0, a1),
+        InstructionSW(gp, a2, 8),
+        InstructionLUI(a3, 0x1800),
+        InstructionSH(a3, a2, 2),
+        InstructionJAL(x0, 0),
+    ]
+
+    for latency in range(1, 5):
+        mem = QspiMemory(dut)
+        mem.write(0, b"".join(instr.encode().to_bytes(4, "little") for instr in program))
+        val_a = random.randint(0, 0xFFFFFFFF)
+        val_b = random.randint(0, 0xFFFFFFFF)
+        mem.write_word(0x1000400, val_a)
+        mem.write_word(0x1000404, val_b)
+
+        await reset(dut, latency)
+        mem.start()
+        await ClockCycles(dut.clk, 1000)
+        mem.stop()
+
+        expected = (val_a + val_b) & 0xFFFFFFFF
+        assert mem.read_word(0x1000408) == expected
+        assert mem.read(0x1800000, 6) == b"\0\0" + (expected & 0xFFFF).to_bytes(2, "little") + b"\0\0"
+
+@cocotb.test()
+async def test_shared_core(dut):
+    dut._log.info("Start")
+
+    clock = Clock(dut.clk, 15.624, units="ns")
+    cocotb.start_soon(clock.start())
+
+    # The GPIO and PWM peripherals are tested at the same time through one core
+    gpio = TinyQV(dut, 1)
+    pwm = TinyQV(dut, 21)
+    assert gpio.harness is pwm.harness
+    await gpio.reset()
+
+    async def exercise(tqv, regs):
+        for i in range(20):
+            reg = random.choice(regs)
+            val = random.randint(0, 255)
+            await tqv.write_reg(reg, val, sync=random.choice((True, False)))
+            assert await tqv.read_reg(reg) == val
+
+    gpio_task = cocotb.start_soon(exercise(gpio, [0]))
+    pwm_task = cocotb.start_soon(exercise(pwm, [0, 1]))
+    await gpio_task
+    await pwm_task
+
+@cocotb.test()
+async def test_batch_access(dut):
+    dut._log.info("Start")
+
+    clock = Clock(dut.clk, 15.624, units="ns")
+    cocotb.start_soon(clock.start())
+
+    # The frequency synthesizer's first four registers read back any word written,
+    # narrower reads return the low bits
+    synth = TinyQV(dut, 5)
+    await synth.reset()
+
+    values = [0x12345678, 0x9ABCDEF0, 0x0F1E2D3C, 0x80000001]
+    await synth.write_regs([(32, 4 * i, value) for i, value in enumerate(values)])
+
+    reads = [(8, 4), (32, 0), (16, 12), (32, 8), (8, 0), (16, 4), (32, 12)]
+    expected = [values[reg // 4] & ((1 << width) - 1) for width, reg in reads]
+    assert await synth.read_regs(reads) == expected
+
+    # Reads see the writes before them in the same batch, results are in request order
+    results = await synth.access_regs([
+        (32, 0, 0x11223344),
+        (16, 0, None),
+        (32, 4, None),
+        (32, 4, 0x55667788),
+        (8, 4, None),
+        (32, 0, None),
+    ])
+    assert results == [None, 0x3344, values[1], None, 0x88, 0x11223344]
+
+@cocotb.test()
+async def test_backdoor_isolated(dut):
+    dut._log.info("Start")
+
+    clock = Clock(dut.clk, 15.624, units="ns")
+    cocotb.start_soon(clock.start())
+
+    synth = TinyQV(dut, 5)
+    if not synth.backdoor_available:
+        dut._log.info("Needs the RTL hierarchy, skipped in gate level simulations")
+        return
+    await synth.reset()
+
+    # A front door write first, which leaves the core's address on the peripheral
+    await synth.write_word_reg(0, 0x12345678)
+    h = synth.harness.handles
+    count = h.peri_write_count.value.integer
+    bus_writes = synth.harness.bus_writes
+    gpio_out_sel = h.gpio_out_sel.value.integer
+
+    # The core's own bus must stay idle while the backdoor runs
+    bus_active = []
+    async def watch_bus():
+        up = dut.user_project
+        while True:
+            await FallingEdge(dut.clk)
+            if up.write_n.value.integer != 3 or up.read_n.value.integer != 3:
+                bus_active.append(get_sim_time("ns"))
+    watcher = cocotb.start_soon(watch_bus())
+
+    await synth.write_word_reg(4, 0x9ABCDEF0, backdoor=True)
+    assert await synth.read_word_reg(4, backdoor=True) == 0x9ABCDEF0
+    assert await synth.read_hword_reg(0, backdoor=True) == 0x5678
+    watcher.kill()
+
+    assert not bus_active, f"Core's peripheral bus active at {bus_active[0]} ns"
+    assert h.peri_write_count.value.integer == count
+    assert synth.harness.bus_writes == bus_writes
+    assert h.gpio_out_sel.value.integer == gpio_out_sel
+
+    # The core sees the backdoor write, and synced writes fence as before
+    assert await synth.read_word_reg(4) == 0x9ABCDEF0
+    await synth.write_word_reg(0, 0x0F0F0F0F)
+    assert await synth.read_word_reg(0) == 0x0F0F0F0F
+
+@cocotb.test()
+async def test_write_combining(dut):
+    dut._log.info("Start")
+
+    clock = Clock(dut.clk, 15.624, units="ns")
+    cocotb.start_soon(clock.start())
+
+    # The VGA peripheral's colour registers at 0x30-0x33 take byte, half word and
+    # word writes alike, but can't be read back, so the writes are watched on the
+    # peripheral bus and the registers checked in the RTL hierarchy.
+    vga = TinyQV(dut, 12)
+    if vga.harness.handles.peripherals is None:
+        dut._log.info("Needs the RTL hierarchy, skipped in gate level simulations")
+        return
+    await vga.reset()
+    colours = vga.harness.handles.peripherals.i_rejunity_vga12
+
+    # Each write as (reg, width, value), recorded as write_n becomes active
+    writes = []
+    async def record_writes():
+        up = dut.user_project
+        active = False
+        while True:
+            await FallingEdge(dut.clk)
+            write_n = up.write_n.value.integer
+            if write_n != 3 and not active and up.addr.value.integer & 0x8000000:
+                width = (8, 16, 32)[write_n]
+                writes.append(((up.addr.value.integer & 0x7FF) - vga.base_address, width,
+                               up.data_to_write.value.integer & ((1 << width) - 1)))
+            active = write_n != 3
+    recorder = cocotb.start_soon(record_writes())
+
+    # A complete word is written at once
+    vga.enable_write_combining()
+    for reg, value in ((0x31, 0x12), (0x30, 0x05), (0x33, 0x3F), (0x32, 0x20)):
+        await vga.write_reg(reg, value, sync=False)
+    assert not vga.pending
+
+    # Without word writes, the pairs that fill a half word are written as one,
+    # lowest address first
+    vga.enable_write_combining((16,))
+    for reg, value in ((0x33, 0x01), (0x32, 0x02), (0x30, 0x03)):
+        await vga.write_reg(reg, value, sync=False)
+    assert sorted(vga.pending) == [0x30, 0x32, 0x33]
+    await vga.flush()
+
+    # Writing a byte again flushes the first write
+    await vga.write_reg(0x31, 0x04, sync=False)
+    await vga.write_reg(0x31, 0x06)
+    await vga.flush()
+    recorder.kill()
+
+    assert writes == [(0x30, 32, 0x3F201205), (0x30, 8, 0x03), (0x32, 16, 0x0102), (0x31, 8, 0x04), (0x31, 8, 0x06)]
+    assert [colours.bg_color.value.integer, colours.fg_color.value.integer,
+            colours.f2_color.value.integer, colours.f3_color.value.integer] == [0x03, 0x06, 0x02, 0x01]
+
 @cocotb.test()
 async def test_multistore_interrupt(dut):
     dut._log.info("Start")
@@ -426,6 +697,10 @@ async def test_multistore_interrupt(dut):
         instr = InstructionSW(base_reg, reg, imm).encode()
         return instr | (7 << 12)
 
+    monitor = QspiMonitor(dut)
+    monitor.start()
+    start_time = get_sim_time()
+
     # Should start reading flash after 1 cycle
     await ClockCycles(dut.clk, 1)
     await start_read(dut, 0)
@@ -440,23 +715,39 @@ async def test_multistore_interrupt(dut):
     await send_instr(dut, InstructionADDI(a3, x0, 0x12).encode())
     await send_instr(dut, InstructionADDI(a4, x0, 0x13).encode())
 
+    # Each store writes a1-a4
+    expected = np.array([0x10, 0x11, 0x12, 0x13], dtype=np.uint32)
     for i in range(100):
         await send_instr(dut, encode_sw4(gp, a1, i*16))
-        await expect_store(dut, 0x1000400 + i*16, 16)
+        assert np.array_equal(await expect_store_words(dut, 0x1000400 + i*16, 4), expected)
+
+    # The whole buffer in the simulated PMOD's RAM
+    stored = np.frombuffer(read_sim_ram(dut, 0x1000400, 100 * 16), dtype="<u4")
+    assert np.array_equal(stored, np.tile(expected, 100))
 
     # Interrupt should be pending
     await send_instr(dut, InstructionCSRRS(a0, x0, csrnames.mip).encode())
     assert (await read_reg(dut, a0, False) & 0x80000) == 0x80000
 
+    # The 100 multi-word stores and the read of mip
+    monitor.stop()
+    monitor.log_stats(dut._log, start_time)
+    assert monitor.stats()["RAM A"]["transactions"] == 101
+    assert monitor.stats()["RAM A"]["bytes"] == 100 * 16 + 4
+
 ### Random operation testing ###
-reg = [0] * 16
+# The ops generate random instructions, their results come from the reference model
+model = TinyQVModel()
+
+# The first seed and number of seeds for a random test.  The first seed is random unless
+# TQV_RANDOM_SEED is set, and TQV_RANDOM_SEEDS overrides the count, see regress.py.
+def random_seeds(default_count):
+    seed = int(os.environ.get("TQV_RANDOM_SEED", random.randint(0, 0xFFFFFFFF)))
+    return seed, int(os.environ.get("TQV_RANDOM_SEEDS", default_count))
 
-# Each Op does reg[d] = fn(a, b)
-# fn will access reg global array
 class SimpleOp:
-    def __init__(self, rvm_insn, fn, name):
+    def __init__(self, rvm_insn, name):
         self.rvm_insn = rvm_insn
-        self.fn = fn
         self.name = name
         self.is_mem_op = False
 
@@ -464,12 +755,6 @@ class SimpleOp:
         self.rvm_insn_inst = self.rvm_insn()
         self.rvm_insn_inst.randomize(variant=RV32E)
     
-    def execute_fn(self, rd, rs1, arg2):
-        if rd != 0 and rd != 3 and rd != 4:
-            reg[rd] = self.fn(rs1, arg2)
-            while reg[rd] < -0x80000000: reg[rd] += 0x100000000
-            while reg[rd] > 0x7FFFFFFF:  reg[rd] -= 0x100000000
-
     def encode(self, rd, rs1, arg2):
         return self.rvm_insn(rd, rs1, arg2).encode()
     
@@ -547,9 +832,8 @@ def encode_cand(dest_reg, src_reg):
     return encode_ca(dest_reg, src_reg, 0x8C61)
 
 class CIOp:
-    def __init__(self, encoder, min_rs1, min_imm, fn, name):
+    def __init__(self, encoder, min_rs1, min_imm, name):
         self.encoder = encoder
-        self.fn = fn
         self.name = name
         self.min_rs1 = min_rs1
         self.min_imm = min_imm
@@ -559,12 +843,6 @@ class CIOp:
         self.rs1 = random.randint(self.min_rs1, 15)
         self.imm = random.randint(self.min_imm, 31)
     
-    def execute_fn(self, rd, rs1, arg2):
-        if rd != 0 and rd != 3 and rd != 4:
-            reg[rd] = self.fn(rs1, arg2)
-            while reg[rd] < -0x80000000: reg[rd] += 0x100000000
-            while reg[rd] > 0x7FFFFFFF:  reg[rd] -= 0x100000000
-
     def encode(self, rd, rs1, arg2):
         return self.encoder(rs1, arg2)
     
@@ -578,9 +856,8 @@ class CIOp:
         return self.imm
 
 class CROp:
-    def __init__(self, encoder, min_reg, fn, name):
+    def __init__(self, encoder, min_reg, name):
         self.encoder = encoder
-        self.fn = fn
         self.name = name
         self.min_reg = min_reg
         self.is_mem_op = False
@@ -589,12 +866,6 @@ class CROp:
         self.rs1 = random.randint(self.min_reg, 15)
         self.rs2 = random.randint(self.min_reg, 15)
     
-    def execute_fn(self, rd, rs1, arg2):
-        if rd != 0 and rd != 3 and rd != 4:
-            reg[rd] = self.fn(rs1, arg2)
-            while reg[rd] < -0x80000000: reg[rd] += 0x100000000
-            while reg[rd] > 0x7FFFFFFF:  reg[rd] -= 0x100000000
-
     def encode(self, rd, rs1, arg2):
         return self.encoder(rs1, arg2)
     
@@ -634,43 +905,43 @@ class InstructionCZERO_NEZ(InstructionRType):
         return (0b0000111 << 25) | (self.rs2 << 20) | (self.rs1 << 15) | (self.op << 12) | (self.rd << 7) | 0b0110011
 
 ops_alu = [
-    SimpleOp(InstructionADDI, lambda rs1, imm: reg[rs1] + imm, "+i"),
-    SimpleOp(InstructionADD, lambda rs1, rs2: reg[rs1] + reg[rs2], "+"),
-    SimpleOp(InstructionSUB, lambda rs1, rs2: reg[rs1] - reg[rs2], "-"),
-    SimpleOp(InstructionANDI, lambda rs1, imm: reg[rs1] & imm, "&i"),
-    SimpleOp(InstructionAND, lambda rs1, rs2: reg[rs1] & reg[rs2], "&"),
-    SimpleOp(InstructionORI, lambda rs1, imm: reg[rs1] | imm, "|i"),
-    SimpleOp(InstructionOR, lambda rs1, rs2: reg[rs1] | reg[rs2], "|"),
-    SimpleOp(InstructionXORI, lambda rs1, imm: reg[rs1] ^ imm, "^i"),
-    SimpleOp(InstructionXOR, lambda rs1, rs2: reg[rs1] ^ reg[rs2], "^"),
-    SimpleOp(InstructionSLTI, lambda rs1, imm: 1 if reg[rs1] < imm else 0, "<i"),
-    SimpleOp(InstructionSLT, lambda rs1, rs2: 1 if reg[rs1] < reg[rs2] else 0, "<"),
-    SimpleOp(InstructionSLTIU, lambda rs1, imm: 1 if (reg[rs1] & 0xFFFFFFFF) < (imm & 0xFFFFFFFF) else 0, "<iu"),
-    SimpleOp(InstructionSLTU, lambda rs1, rs2: 1 if (reg[rs1] & 0xFFFFFFFF) < (reg[rs2] & 0xFFFFFFFF) else 0, "<u"),
-    SimpleOp(InstructionSLLI, lambda rs1, imm: reg[rs1] << imm, "<<i"),
-    SimpleOp(InstructionSLL, lambda rs1, rs2: reg[rs1] << (reg[rs2] & 0x1F), "<<"),
-    SimpleOp(InstructionSRLI, lambda rs1, imm: (reg[rs1] & 0xFFFFFFFF) >> imm, ">>li"),
-    SimpleOp(InstructionSRL, lambda rs1, rs2: (reg[rs1] & 0xFFFFFFFF) >> (reg[rs2] & 0x1F), ">>l"),
-    SimpleOp(InstructionSRAI, lambda rs1, imm: reg[rs1] >> imm, ">>i"),
-    SimpleOp(InstructionSRA, lambda rs1, rs2: reg[rs1] >> (reg[rs2] & 0x1F), ">>"),
-    SimpleOp(InstructionCZERO_EQZ, lambda rs1, rs2: 0 if reg[rs2] == 0 else reg[rs1], "?0"),
-    SimpleOp(InstructionCZERO_NEZ, lambda rs1, rs2: 0 if reg[rs2] != 0 else reg[rs1], "?!0"),
-    CIOp(encode_cli, 1, -32, lambda rs1, imm: imm, "=i(c)"),
-    CIOp(encode_caddi, 1, -32, lambda rs1, imm: reg[rs1] + imm, "+i(c)"),
-    CIOp(encode_cslli, 1, 0, lambda rs1, imm: reg[rs1] << imm, "<<i(c)"),
-    CIOp(encode_csrli, 8, 0, lambda rs1, imm: (reg[rs1] & 0xFFFFFFFF) >> imm, ">>li(c)"),
-    CIOp(encode_csrai, 8, 0, lambda rs1, imm: reg[rs1] >> imm, ">>li(c)"),
-    CIOp(encode_candi, 8, -32, lambda rs1, imm: reg[rs1] & imm, "&i(c)"),
-    CIOp(encode_cnot, 8, 0, lambda rs1, imm: ~(reg[rs1] & 0xFFFFFFFF), "~(c)"),
-    CIOp(encode_czext_b, 8, 0, lambda rs1, imm: reg[rs1] & 0xFF, "zb(c)"),
-    CIOp(encode_czext_h, 8, 0, lambda rs1, imm: reg[rs1] & 0xFFFF, "zh(c)"),
-    CROp(encode_cmv, 1, lambda rs1, rs2: reg[rs2], "=(c)"),
-    CROp(encode_cadd, 1, lambda rs1, rs2: reg[rs1] + reg[rs2], "+(c)"),
-    CROp(encode_cmul16, 1, lambda rs1, rs2: reg[rs1] * (reg[rs2] & 0xFFFF), "*(c)"),
-    CROp(encode_csub, 8, lambda rs1, rs2: reg[rs1] - reg[rs2], "-(c)"),
-    CROp(encode_cxor, 8, lambda rs1, rs2: reg[rs1] ^ reg[rs2], "^(c)"),
-    CROp(encode_cor, 8, lambda rs1, rs2: reg[rs1] | reg[rs2], "|(c)"),
-    CROp(encode_cand, 8, lambda rs1, rs2: reg[rs1] & reg[rs2], "&(c)"),
+    SimpleOp(InstructionADDI, "+i"),
+    SimpleOp(InstructionADD, "+"),
+    SimpleOp(InstructionSUB, "-"),
+    SimpleOp(InstructionANDI, "&i"),
+    SimpleOp(InstructionAND, "&"),
+    SimpleOp(InstructionORI, "|i"),
+    SimpleOp(InstructionOR, "|"),
+    SimpleOp(InstructionXORI, "^i"),
+    SimpleOp(InstructionXOR, "^"),
+    SimpleOp(InstructionSLTI, "<i"),
+    SimpleOp(InstructionSLT, "<"),
+    SimpleOp(InstructionSLTIU, "<iu"),
+    SimpleOp(InstructionSLTU, "<u"),
+    SimpleOp(InstructionSLLI, "<<i"),
+    SimpleOp(InstructionSLL, "<<"),
+    SimpleOp(InstructionSRLI, ">>li"),
+    SimpleOp(InstructionSRL, ">>l"),
+    SimpleOp(InstructionSRAI, ">>i"),
+    SimpleOp(InstructionSRA, ">>"),
+    SimpleOp(InstructionCZERO_EQZ, "?0"),
+    SimpleOp(InstructionCZERO_NEZ, "?!0"),
+    CIOp(encode_cli, 1, -32, "=i(c)"),
+    CIOp(encode_caddi, 1, -32, "+i(c)"),
+    CIOp(encode_cslli, 1, 0, "<<i(c)"),
+    CIOp(encode_csrli, 8, 0, ">>li(c)"),
+    CIOp(encode_csrai, 8, 0, ">>i(c)"),
+    CIOp(encode_candi, 8, -32, "&i(c)"),
+    CIOp(encode_cnot, 8, 0, "~(c)"),
+    CIOp(encode_czext_b, 8, 0, "zb(c)"),
+    CIOp(encode_czext_h, 8, 0, "zh(c)"),
+    CROp(encode_cmv, 1, "=(c)"),
+    CROp(encode_cadd, 1, "+(c)"),
+    CROp(encode_cmul16, 1, "*(c)"),
+    CROp(encode_csub, 8, "-(c)"),
+    CROp(encode_cxor, 8, "^(c)"),
+    CROp(encode_cor, 8, "|(c)"),
+    CROp(encode_cand, 8, "&(c)"),
 ]
 
 @cocotb.test()
@@ -680,57 +951,38 @@ async def test_random_alu(dut):
     clock = Clock(dut.clk, 15.624, units="ns")
     cocotb.start_soon(clock.start())
 
-    # Reset
-    await reset(dut)
+    # Reset, with debug register data enabled and uo_out[7] left on the debug signal for dump_regs
+    await reset(dut, 1, 0x83)
 
     # Should start reading flash after 1 cycle
     await ClockCycles(dut.clk, 1)
     await start_read(dut, 0)
     
-    seed = random.randint(0, 0xFFFFFFFF)
+    seed, seeds = random_seeds(20)
     #seed = 1508125843
     debug = False
-    for test in range(20):
+    total = CoverageCollector([op.name for op in ops_alu])
+    for test in range(seeds):
         random.seed(seed + test)
         dut._log.info("Running test with seed {}".format(seed + test))
-        for i in range(1, 16):
-            if i == 3: reg[i] = 0x1000400
-            elif i == 4: reg[i] = 0x8000000
-            else:
-                reg[i] = random.randint(-0x80000000, 0x7FFFFFFF)
-                if debug: print("Set reg {} to {}".format(i, reg[i]))
-                await load_reg(dut, i, reg[i])
-
-        if False:
-            for i in range(16):
-                reg_value = (await read_reg(dut, i)).signed_integer
-                if debug: print("Reg {} is {}".format(i, reg_value))
-                assert reg_value == reg[i]
-
-        last_instr = ops_alu[0]
-        for i in range(200):
-            while True:
-                try:
-                    instr = random.choice(ops_alu)
-                    instr.randomize()
-                    rd = instr.get_valid_rd()
-                    rs1 = instr.get_valid_rs1()
-                    arg2 = instr.get_valid_arg2()
-
-                    instr.execute_fn(rd, rs1, arg2)
-                    break
-                except ValueError:
-                    pass
-
-            if debug: print("x{} = x{} {} {}, now {} {:08x}".format(rd, rs1, arg2, instr.name, reg[rd], instr.encode(rd, rs1, arg2)))
-            await send_instr(dut, instr.encode(rd, rs1, arg2))
-            #if debug:
-            #    assert await read_reg(dut, rd) == reg[rd] & 0xFFFFFFFF
-
-        for i in range(16):
-            reg_value = (await read_reg(dut, i))
-            if debug: print("Reg x{} = {} should be {}".format(i, reg_value, reg[i]))
-            assert reg_value & 0xFFFFFFFF == reg[i] & 0xFFFFFFFF
+        values = random_regs()
+        if debug: print("Set regs to {}".format(values))
+
+        # Check each register write as the core makes it, the dump at the end
+        # then only checks that nothing was missed
+        runner = TraceRunner(dut, model, values)
+        try:
+            await runner.start()
+            coverage = await run_random_seed(runner, ops_alu, 200, debug=debug)
+            await runner.finish()
+        except AssertionError as e:
+            runner.stop()
+            await shrink_failure(dut, runner.trace, seed + test, e)
+            raise
+        total.merge(coverage)
+        dut._log.info(f"{total.covered()} coverage bins hit after {total.instructions} instructions")
+
+    total.log_report(dut._log)
 
 def encode_clw(reg, base_reg, imm):
     scrambled = (((imm << (10 - 3)) & 0b1110000000000) |
@@ -751,15 +1003,13 @@ def encode_lbu(reg, base_reg, imm):
                     ((imm << (6 - 0)) & 0b1000000))
     return 0x8000 | scrambled | ((base_reg - 8) << 7) | ((reg - 8) << 2)
 
-async def set_reg(dut, rd, value):
-    await send_instr(dut, InstructionLUI(rd, (value + 0x800) >> 12).encode())
-    await send_instr(dut, InstructionADDI(rd, rd, ((value + 0x800) & 0xFFF) - 0x800).encode())
-    reg[rd] = value
+def set_reg_instrs(rd, value):
+    return (InstructionLUI(rd, (value + 0x800) >> 12).encode(),
+            InstructionADDI(rd, rd, ((value + 0x800) & 0xFFF) - 0x800).encode())
 
 class CLoadOp:
-    def __init__(self, encoder, min_imm, max_imm, imm_mul, bytes, fn, name):
+    def __init__(self, encoder, min_imm, max_imm, imm_mul, bytes, name):
         self.encoder = encoder
-        self.fn = fn
         self.name = name
         self.is_mem_op = True
         self.min_imm = min_imm
@@ -773,10 +1023,6 @@ class CLoadOp:
         self.imm = random.randint(self.min_imm, self.max_imm) * self.imm_mul
         self.val = random.randint(-0x80000000, 0x7fffffff)
 
-    def execute_fn(self, rd, rs1, arg2):
-        if rd != 0 and rd != 3 and rd != 4:
-            reg[rd] = self.fn(self.val)
-
     def encode(self, rd, rs1, arg2):
         return self.encoder(rd, rs1, arg2)
     
@@ -788,15 +1034,10 @@ class CLoadOp:
 
     def get_valid_arg2(self):
         return self.imm
-    
-    async def do_mem_op(self, dut, addr):
-        #print("Load {} from addr {:08x}".format(self.val, addr))
-        await expect_load(dut, addr, self.val, abs(self.bytes))
 
 class LoadOp:
-    def __init__(self, instr, min_imm, max_imm, imm_mul, bytes, fn, name):
+    def __init__(self, instr, min_imm, max_imm, imm_mul, bytes, name):
         self.instr = instr
-        self.fn = fn
         self.name = name
         self.is_mem_op = True
         self.min_imm = min_imm
@@ -813,10 +1054,6 @@ class LoadOp:
         self.imm = random.randint(self.min_imm, self.max_imm) * self.imm_mul
         self.val = random.randint(-0x80000000, 0x7fffffff)
 
-    def execute_fn(self, rd, rs1, arg2):
-        if rd != 0 and rd != 3 and rd != 4:
-            reg[rd] = self.fn(self.val)
-
     def encode(self, rd, rs1, arg2):
         return self.instr(rd, rs1, arg2).encode()
     
@@ -828,10 +1065,6 @@ class LoadOp:
 
     def get_valid_arg2(self):
         return self.imm
-    
-    async def do_mem_op(self, dut, addr):
-        #print("Load {} from addr {:08x}".format(self.val, addr))
-        await expect_load(dut, addr, self.val, abs(self.bytes))
 
 def encode_csw(base_reg, reg, imm):
     scrambled = (((imm << (10 - 3)) & 0b1110000000000) |
@@ -840,9 +1073,8 @@ def encode_csw(base_reg, reg, imm):
     return 0xC000 | scrambled | ((base_reg - 8) << 7) | ((reg - 8) << 2)
 
 class CStoreOp:
-    def __init__(self, encoder, min_imm, max_imm, imm_mul, bytes, fn, name):
+    def __init__(self, encoder, min_imm, max_imm, imm_mul, bytes, name):
         self.encoder = encoder
-        self.fn = fn
         self.name = name
         self.is_mem_op = True
         self.min_imm = min_imm
@@ -858,9 +1090,6 @@ class CStoreOp:
                 break
         self.imm = random.randint(self.min_imm, self.max_imm) * self.imm_mul
 
-    def execute_fn(self, rd, rs1, arg2):
-        pass
-
     def encode(self, rd, rs1, arg2):
         return self.encoder(self.base_reg, self.rs1, arg2)
     
@@ -872,15 +1101,10 @@ class CStoreOp:
 
     def get_valid_arg2(self):
         return self.imm
-    
-    async def do_mem_op(self, dut, addr):
-        #print("Load {} from addr {:08x}".format(self.val, addr))
-        assert await expect_store(dut, addr, self.bytes) == self.fn(self.rs1)
 
 class StoreOp:
-    def __init__(self, instr, min_imm, max_imm, imm_mul, bytes, fn, name):
+    def __init__(self, instr, min_imm, max_imm, imm_mul, bytes, name):
         self.instr = instr
-        self.fn = fn
         self.name = name
         self.is_mem_op = True
         self.min_imm = min_imm
@@ -896,9 +1120,6 @@ class StoreOp:
                 break
         self.imm = random.randint(self.min_imm, self.max_imm) * self.imm_mul
 
-    def execute_fn(self, rd, rs1, arg2):
-        pass
-
     def encode(self, rd, rs1, arg2):
         return self.instr(self.base_reg, self.rs1, arg2).encode()
     
@@ -910,64 +1131,180 @@ class StoreOp:
 
     def get_valid_arg2(self):
         return self.imm
-    
-    async def do_mem_op(self, dut, addr):
-        #print("Load {} from addr {:08x}".format(self.val, addr))
-        assert await expect_store(dut, addr, self.bytes) == self.fn(self.rs1)
 
 ops = [
-    SimpleOp(InstructionADDI, lambda rs1, imm: reg[rs1] + imm, "+i"),
-    SimpleOp(InstructionADD, lambda rs1, rs2: reg[rs1] + reg[rs2], "+"),
-    SimpleOp(InstructionSUB, lambda rs1, rs2: reg[rs1] - reg[rs2], "-"),
-    SimpleOp(InstructionANDI, lambda rs1, imm: reg[rs1] & imm, "&i"),
-    SimpleOp(InstructionAND, lambda rs1, rs2: reg[rs1] & reg[rs2], "&"),
-    SimpleOp(InstructionORI, lambda rs1, imm: reg[rs1] | imm, "|i"),
-    SimpleOp(InstructionOR, lambda rs1, rs2: reg[rs1] | reg[rs2], "|"),
-    SimpleOp(InstructionXORI, lambda rs1, imm: reg[rs1] ^ imm, "^i"),
-    SimpleOp(InstructionXOR, lambda rs1, rs2: reg[rs1] ^ reg[rs2], "^"),
-    SimpleOp(InstructionSLTI, lambda rs1, imm: 1 if reg[rs1] < imm else 0, "<i"),
-    SimpleOp(InstructionSLT, lambda rs1, rs2: 1 if reg[rs1] < reg[rs2] else 0, "<"),
-    SimpleOp(InstructionSLTIU, lambda rs1, imm: 1 if (reg[rs1] & 0xFFFFFFFF) < (imm & 0xFFFFFFFF) else 0, "<iu"),
-    SimpleOp(InstructionSLTU, lambda rs1, rs2: 1 if (reg[rs1] & 0xFFFFFFFF) < (reg[rs2] & 0xFFFFFFFF) else 0, "<u"),
-    SimpleOp(InstructionSLLI, lambda rs1, imm: reg[rs1] << imm, "<<i"),
-    SimpleOp(InstructionSLL, lambda rs1, rs2: reg[rs1] << (reg[rs2] & 0x1F), "<<"),
-    SimpleOp(InstructionSRLI, lambda rs1, imm: (reg[rs1] & 0xFFFFFFFF) >> imm, ">>li"),
-    SimpleOp(InstructionSRL, lambda rs1, rs2: (reg[rs1] & 0xFFFFFFFF) >> (reg[rs2] & 0x1F), ">>l"),
-    SimpleOp(InstructionSRAI, lambda rs1, imm: reg[rs1] >> imm, ">>i"),
-    SimpleOp(InstructionSRA, lambda rs1, rs2: reg[rs1] >> (reg[rs2] & 0x1F), ">>"),
-    SimpleOp(InstructionCZERO_EQZ, lambda rs1, rs2: 0 if reg[rs2] == 0 else reg[rs1], "?0"),
-    SimpleOp(InstructionCZERO_NEZ, lambda rs1, rs2: 0 if reg[rs2] != 0 else reg[rs1], "?!0"),
-    CIOp(encode_cli, 1, -32, lambda rs1, imm: imm, "=i(c)"),
-    CIOp(encode_caddi, 1, -32, lambda rs1, imm: reg[rs1] + imm, "+i(c)"),
-    CIOp(encode_cslli, 1, 0, lambda rs1, imm: reg[rs1] << imm, "<<i(c)"),
-    CIOp(encode_csrli, 8, 0, lambda rs1, imm: (reg[rs1] & 0xFFFFFFFF) >> imm, ">>li(c)"),
-    CIOp(encode_csrai, 8, 0, lambda rs1, imm: reg[rs1] >> imm, ">>li(c)"),
-    CIOp(encode_candi, 8, -32, lambda rs1, imm: reg[rs1] & imm, "&i(c)"),
-    CIOp(encode_cnot, 8, 0, lambda rs1, imm: ~(reg[rs1] & 0xFFFFFFFF), "~(c)"),
-    CIOp(encode_czext_b, 8, 0, lambda rs1, imm: reg[rs1] & 0xFF, "zb(c)"),
-    CIOp(encode_czext_h, 8, 0, lambda rs1, imm: reg[rs1] & 0xFFFF, "zh(c)"),
-    CROp(encode_cmv, 1, lambda rs1, rs2: reg[rs2], "=(c)"),
-    CROp(encode_cadd, 1, lambda rs1, rs2: reg[rs1] + reg[rs2], "+(c)"),
-    CROp(encode_cmul16, 1, lambda rs1, rs2: reg[rs1] * (reg[rs2] & 0xFFFF), "*(c)"),
-    CROp(encode_csub, 8, lambda rs1, rs2: reg[rs1] - reg[rs2], "-(c)"),
-    CROp(encode_cxor, 8, lambda rs1, rs2: reg[rs1] ^ reg[rs2], "^(c)"),
-    CROp(encode_cor, 8, lambda rs1, rs2: reg[rs1] | reg[rs2], "|(c)"),
-    CROp(encode_cand, 8, lambda rs1, rs2: reg[rs1] & reg[rs2], "&(c)"),
-    CLoadOp(encode_clw, 0, 31, 4, 4, lambda val: val, "lw(c)"),
-    CLoadOp(encode_lh, 0, 1, 2, -2, lambda val: (val & 0xFFFF) - 0x10000 if (val & 0x8000) != 0 else val & 0xFFFF, "lh(c)"),
-    CLoadOp(encode_lhu, 0, 1, 2, 2, lambda val: val & 0xFFFF, "lhu(c)"),
-    CLoadOp(encode_lbu, 0, 3, 1, 1, lambda val: val & 0xFF, "lbu(c)"),
-    LoadOp(InstructionLW, -0x800, 0x7ff, 1, 4, lambda val: val, "lw"),
-    LoadOp(InstructionLH, -0x800, 0x7ff, 1, -2, lambda val: (val & 0xFFFF) - 0x10000 if (val & 0x8000) != 0 else val & 0xFFFF, "lh"),
-    LoadOp(InstructionLB, -0x800, 0x7ff, 1, -1, lambda val: (val & 0xFF) - 0x100 if (val & 0x80) != 0 else val & 0xFF, "lb"),
-    LoadOp(InstructionLHU, -0x800, 0x7ff, 1, 2, lambda val: val & 0xFFFF, "lhu"),
-    LoadOp(InstructionLBU, -0x800, 0x7ff, 1, 1, lambda val: val & 0xFF, "lbu"),
-    CStoreOp(encode_csw, 0, 31, 4, 4, lambda rs1: reg[rs1] & 0xFFFFFFFF, "sw(c)"),
-    StoreOp(InstructionSW, -0x800, 0x7ff, 1, 4, lambda rs1: reg[rs1] & 0xFFFFFFFF, "sw"),
-    StoreOp(InstructionSH, -0x800, 0x7ff, 1, 2, lambda rs1: reg[rs1] & 0xFFFF, "sh"),
-    StoreOp(InstructionSB, -0x800, 0x7ff, 1, 1, lambda rs1: reg[rs1] & 0xFF, "sb"),
+    SimpleOp(InstructionADDI, "+i"),
+    SimpleOp(InstructionADD, "+"),
+    SimpleOp(InstructionSUB, "-"),
+    SimpleOp(InstructionANDI, "&i"),
+    SimpleOp(InstructionAND, "&"),
+    SimpleOp(InstructionORI, "|i"),
+    SimpleOp(InstructionOR, "|"),
+    SimpleOp(InstructionXORI, "^i"),
+    SimpleOp(InstructionXOR, "^"),
+    SimpleOp(InstructionSLTI, "<i"),
+    SimpleOp(InstructionSLT, "<"),
+    SimpleOp(InstructionSLTIU, "<iu"),
+    SimpleOp(InstructionSLTU, "<u"),
+    SimpleOp(InstructionSLLI, "<<i"),
+    SimpleOp(InstructionSLL, "<<"),
+    SimpleOp(InstructionSRLI, ">>li"),
+    SimpleOp(InstructionSRL, ">>l"),
+    SimpleOp(InstructionSRAI, ">>i"),
+    SimpleOp(InstructionSRA, ">>"),
+    SimpleOp(InstructionCZERO_EQZ, "?0"),
+    SimpleOp(InstructionCZERO_NEZ, "?!0"),
+    CIOp(encode_cli, 1, -32, "=i(c)"),
+    CIOp(encode_caddi, 1, -32, "+i(c)"),
+    CIOp(encode_cslli, 1, 0, "<<i(c)"),
+    CIOp(encode_csrli, 8, 0, ">>li(c)"),
+    CIOp(encode_csrai, 8, 0, ">>i(c)"),
+    CIOp(encode_candi, 8, -32, "&i(c)"),
+    CIOp(encode_cnot, 8, 0, "~(c)"),
+    CIOp(encode_czext_b, 8, 0, "zb(c)"),
+    CIOp(encode_czext_h, 8, 0, "zh(c)"),
+    CROp(encode_cmv, 1, "=(c)"),
+    CROp(encode_cadd, 1, "+(c)"),
+    CROp(encode_cmul16, 1, "*(c)"),
+    CROp(encode_csub, 8, "-(c)"),
+    CROp(encode_cxor, 8, "^(c)"),
+    CROp(encode_cor, 8, "|(c)"),
+    CROp(encode_cand, 8, "&(c)"),
+    CLoadOp(encode_clw, 0, 31, 4, 4, "lw(c)"),
+    CLoadOp(encode_lh, 0, 1, 2, -2, "lh(c)"),
+    CLoadOp(encode_lhu, 0, 1, 2, 2, "lhu(c)"),
+    CLoadOp(encode_lbu, 0, 3, 1, 1, "lbu(c)"),
+    LoadOp(InstructionLW, -0x800, 0x7ff, 1, 4, "lw"),
+    LoadOp(InstructionLH, -0x800, 0x7ff, 1, -2, "lh"),
+    LoadOp(InstructionLB, -0x800, 0x7ff, 1, -1, "lb"),
+    LoadOp(InstructionLHU, -0x800, 0x7ff, 1, 2, "lhu"),
+    LoadOp(InstructionLBU, -0x800, 0x7ff, 1, 1, "lbu"),
+    CStoreOp(encode_csw, 0, 31, 4, 4, "sw(c)"),
+    StoreOp(InstructionSW, -0x800, 0x7ff, 1, 4, "sw"),
+    StoreOp(InstructionSH, -0x800, 0x7ff, 1, 2, "sh"),
+    StoreOp(InstructionSB, -0x800, 0x7ff, 1, 1, "sb"),
 ]
 
+# Set TQV_COVERAGE_BIAS=0 for uniformly random instructions.  Otherwise each instruction
+# is the one of TQV_COVERAGE_CANDIDATES random candidates in the least hit coverage bin,
+# and some loads and stores are placed next to the start or end of a PSRAM chip.
+COVERAGE_BIAS = os.environ.get("TQV_COVERAGE_BIAS", "1") == "1"
+COVERAGE_CANDIDATES = int(os.environ.get("TQV_COVERAGE_CANDIDATES", "16"))
+
+PSRAM_EDGES = (0x1000000, 0x1800000, 0x2000000)
+
+def psram_addr(nbytes, near_edge):
+    if near_edge and random.randint(0, 3) == 0:
+        edge = random.choice(PSRAM_EDGES)
+        offset = random.randint(0, 7)
+        if edge == PSRAM_EDGES[-1] or (edge != PSRAM_EDGES[0] and random.randint(0, 1)):
+            return edge - nbytes - offset
+        return edge + offset
+    return random.randint(0x1000000, 0x1fffffc)
+
+# A random instruction from op_list as (op index, instruction, setup, addr, load value).
+# For a load or store setup is the instructions setting its base register so that it
+# accesses addr, and load value the data a load returns.
+def random_instr(op_list, near_edge=False, latch_ram=None):
+    while True:
+        try:
+            instr = random.choice(op_list)
+            instr.randomize()
+            rd = instr.get_valid_rd()
+            rs1 = instr.get_valid_rs1()
+            arg2 = instr.get_valid_arg2()
+
+            addr = None
+            setup = ()
+            load_value = None
+            if instr.is_mem_op:
+                if latch_ram is not None and random.randint(0, 2) == 2:
+                    # Use latch RAM
+                    addr = random.randint(0x7ffff00-instr.imm, 0x7ffff3c-instr.imm) + instr.imm
+                    if instr.name[0] == 'l':
+                        val = 0
+                        for i in range(abs(instr.bytes)-1, -1, -1):
+                            val <<= 8
+                            val |= latch_ram[(addr + 0x1000 + i) % len(latch_ram)]
+                        instr.val = val
+                else:
+                    # Use PSRAM
+                    addr = psram_addr(abs(instr.bytes), near_edge)
+                setup = set_reg_instrs(instr.base_reg, addr - instr.imm)
+                if instr.name[0] == 'l':
+                    load_value = instr.val
+
+            encoded = instr.encode(rd, rs1, arg2)
+            return op_list.index(instr), encoded, setup, addr, load_value
+        except ValueError:
+            pass
+
+# The next instruction for a random test, as random_instr
+def next_instr(op_list, coverage, model, latch_ram=None):
+    if not COVERAGE_BIAS:
+        return random_instr(op_list, latch_ram=latch_ram)
+
+    best = None
+    for _ in range(COVERAGE_CANDIDATES):
+        candidate = random_instr(op_list, True, latch_ram)
+        op, encoded, setup, _, load_value = candidate
+        hits = coverage.hits[coverage.bin(op, encoded, model.regs, load_value, setup)]
+        if best is None or hits < best_hits:
+            best, best_hits = candidate, hits
+            if hits == 0:
+                break
+    return best
+
+# Run a random instruction on the core and the model, recording its coverage
+async def run_random_instr(runner, coverage, op_list, latch_ram=None):
+    op, encoded, setup, addr, load_value = next_instr(op_list, coverage, runner.model, latch_ram)
+    for setup_instr in setup:
+        coverage.executed(setup_instr)
+        await runner.step(setup_instr)
+    coverage.record(op, encoded, runner.model.regs, load_value)
+    await runner.step(encoded, load_value)
+    return op_list[op], addr
+
+# The registers a random test starts a seed from
+def random_regs():
+    values = [0] * 16
+    for i in range(1, 16):
+        if i == 3: values[i] = 0x1000400
+        elif i == 4: values[i] = 0x8000000
+        else: values[i] = random.randint(-0x80000000, 0x7FFFFFFF)
+    return values
+
+LATCH_RAM_SIZE = 32
+
+# Run count random instructions from op_list on a started runner, drawn from the
+# random module as seeded for the seed.  With latch_ram the latch RAM is filled
+# first, through the runner so that the model sees the stores, and some loads and
+# stores go to it.  Returns the coverage of the seed: the instructions are biased
+# by it, so it starts empty for each seed.
+async def run_random_seed(runner, op_list, count, latch_ram=False, debug=False):
+    model = runner.model
+    coverage = CoverageCollector([op.name for op in op_list])
+
+    RAM = None
+    if latch_ram:
+        RAM = bytearray()
+        for i in range(0, LATCH_RAM_SIZE, 4):
+            val = random.randint(0, 0xFFFFFFFF)
+            for instr in set_reg_instrs(x1, val):
+                await runner.step(instr)
+            await runner.step(InstructionSW(tp, x1, i-0x100).encode())
+            RAM += val.to_bytes(4, "little")
+        if debug: print("RAM: ", list(RAM))
+
+    for i in range(count):
+        instr, addr = await run_random_instr(runner, coverage, op_list, RAM)
+        if debug: print("{}, now {}".format(instr.name, model.signed_regs()))
+        if latch_ram and instr.is_mem_op and addr >= 0x4000000 and instr.name[0] == 's':
+            data = model.read(addr, instr.bytes)
+            for i in range(instr.bytes):
+                RAM[(addr + 0x1000 + i) % LATCH_RAM_SIZE] = data[i]
+    return coverage
+
 @cocotb.test()
 async def test_random(dut):
     dut._log.info("Start")
@@ -975,97 +1312,71 @@ async def test_random(dut):
     clock = Clock(dut.clk, 15.624, units="ns")
     cocotb.start_soon(clock.start())
 
-    # Reset
-    await reset(dut)
+    # Reset, with debug register data enabled and uo_out[7] left on the debug signal for dump_regs
+    await reset(dut, 1, 0x83)
 
     # Should start reading flash after 1 cycle
     await ClockCycles(dut.clk, 1)
     await start_read(dut, 0)
 
-    seed = random.randint(0, 0xFFFFFFFF)
+    seed, seeds = random_seeds(8)
     #seed = 3287254906
 
     latch_ram = False
-    if latch_ram:
-        RAM_SIZE = 32
-        RAM = []
-        for i in range(0, RAM_SIZE, 4):
-            val = random.randint(0, 0xFFFFFFFF)
-            await set_reg(dut, x1, val)
-            await send_instr(dut, InstructionSW(tp, x1, i-0x100).encode())
-            RAM.append(val & 0xFF)
-            RAM.append((val >> 8) & 0xFF)
-            RAM.append((val >> 16) & 0xFF)
-            RAM.append((val >> 24) & 0xFF)
-    
     debug = False
-    if debug and latch_ram: print("RAM: ", RAM)
+    total = CoverageCollector([op.name for op in ops])
 
-    for test in range(8):
+    for test in range(seeds):
         random.seed(seed + test)
         dut._log.info("Running test with seed {}".format(seed + test))
-        for i in range(1, 16):
-            if i == 3: reg[i] = 0x1000400
-            elif i == 4: reg[i] = 0x8000000
-            else:
-                reg[i] = random.randint(-0x80000000, 0x7FFFFFFF)
-                if debug: print("Set reg {} to {}".format(i, reg[i]))
-                await load_reg(dut, i, reg[i])
-
-        if False:
-            for i in range(16):
-                reg_value = (await read_reg(dut, i)).signed_integer
-                if debug: print("Reg {} is {}".format(i, reg_value))
-                assert reg_value == reg[i]
-
-        last_instr = ops[0]
-        for i in range(1000):
-            while True:
-                try:
-                    instr = random.choice(ops)
-                    instr.randomize()
-                    rd = instr.get_valid_rd()
-                    rs1 = instr.get_valid_rs1()
-                    arg2 = instr.get_valid_arg2()
-
-                    if instr.is_mem_op:
-                        if latch_ram and random.randint(0, 2) == 2:
-                            # Use latch RAM
-                            addr = random.randint(0x7ffff00-instr.imm, 0x7ffff3c-instr.imm)
-                            if instr.name[0] == 'l':
-                                val = 0
-                                for i in range(abs(instr.bytes)-1, -1, -1):
-                                    val <<= 8
-                                    val |= RAM[(addr + instr.imm + 0x1000 + i) % RAM_SIZE] 
-                                instr.val = val
-                                if debug: print(f"val {val} addr {addr + instr.imm:x}")
-                        else:
-                            # Use PSRAM
-                            addr = random.randint(0x1000000-instr.imm, 0x1fffffc-instr.imm)
-                            if debug: print(f"addr {addr + instr.imm:x}")
-                        await set_reg(dut, instr.base_reg, addr)
-
-                    instr.execute_fn(rd, rs1, arg2)
-                    break
-                except ValueError:
-                    pass
-
-            if debug: print("x{} = x{} {} {}, now {} {:08x}".format(rd, rs1, arg2, instr.name, reg[rd], instr.encode(rd, rs1, arg2)))
-            await send_instr(dut, instr.encode(rd, rs1, arg2))
-            if instr.is_mem_op:
-                if addr < 0x4000000:
-                    assert addr + instr.imm >= 0
-                    assert addr + instr.imm < 0x2000000
-                    await instr.do_mem_op(dut, addr + instr.imm)
-                elif instr.name[0] == 's':
-                    val = instr.fn(instr.rs1)
-                    for i in range(instr.bytes):
-                        RAM[(addr + instr.imm + 0x1000 + i) % RAM_SIZE] = val & 0xFF
-                        val >>= 8
-            #if True:
-            #    assert await read_reg(dut, rd) == reg[rd] & 0xFFFFFFFF
-
-        for i in range(16):
-            reg_value = (await read_reg(dut, i))
-            if debug: print("Reg x{} = {} should be {}".format(i, reg_value, reg[i]))
-            assert reg_value & 0xFFFFFFFF == reg[i] & 0xFFFFFFFF
+        values = random_regs()
+        if debug: print("Set regs to {}".format(values))
+
+        # Check each register write as the core makes it, the dump at the end
+        # then only checks that nothing was missed
+        runner = TraceRunner(dut, model, values)
+        try:
+            await runner.start()
+            coverage = await run_random_seed(runner, ops, 1000, latch_ram, debug)
+            await runner.finish()
+        except AssertionError as e:
+            runner.stop()
+            await shrink_failure(dut, runner.trace, seed + test, e)
+            raise
+        total.merge(coverage)
+        dut._log.info(f"{total.covered()} coverage bins hit after {total.instructions} instructions")
+
+    total.log_report(dut._log)
+
+# The program of a seed must not depend on the seeds run before it, so that a failing
+# seed can be rerun on its own with TQV_RANDOM_SEED and TQV_RANDOM_SEEDS=1.
+# Only generates the programs, on the model.
+@cocotb.test()
+async def test_random_seed_alone(dut):
+    seed, _ = random_seeds(1)
+
+    async def program(seeds):
+        seed_model = TinyQVModel()
+        for s in seeds:
+            random.seed(s)
+            runner = ModelRunner(seed_model, random_regs())
+            await runner.start()
+            await run_random_seed(runner, ops, 300)
+        return runner.trace
+
+    alone = await program([seed + 2])
+    after = await program([seed, seed + 1, seed + 2])
+    assert alone.regs == after.regs
+    assert alone.steps == after.steps, f"Program of seed {seed + 2} changed by running seeds {seed} and {seed + 1} first"
+
+# Replay a program saved by a shrinking random test, set TQV_REPLAY_TRACE to its file
+@cocotb.test(skip="TQV_REPLAY_TRACE" not in os.environ)
+async def test_random_replay(dut):
+    dut._log.info("Start")
+
+    clock = Clock(dut.clk, 15.624, units="ns")
+    cocotb.start_soon(clock.start())
+
+    trace = Trace.load(os.environ["TQV_REPLAY_TRACE"])
+    trace.log(dut._log)
+    await run_trace(dut, trace)
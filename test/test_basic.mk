@@ -57,6 +57,7 @@ VERILOG_SOURCES += $(PWD)/gate_level_netlist.v
 endif
 
 # Include the testbench sources:
+VERILOG_SOURCES += $(PWD)/sim_qspi.v
 VERILOG_SOURCES += $(PWD)/tb.v
 TOPLEVEL = tb
 
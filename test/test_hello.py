@@ -9,6 +9,7 @@ from cocotb.triggers import ClockCycles, Timer
 import cocotb.utils
 
 from test_util import reset
+from tqv_model import firmware_uart_output
 
 async def receive_string(dut, str):
     for char in str:
@@ -61,6 +62,9 @@ async def read_string(dut):
 @cocotb.test()
 async def test_hello(dut):
     dut._log.debug("Start")
+
+    # Check the image on the reference model first, simulating it takes much longer
+    assert firmware_uart_output("hello.hex").startswith(b"Hello, world!\r\nHello 3\r\nHello 36\r\n")
   
     # Our example module doesn't use clock and reset, but we show how to use them here anyway.
     clock = Clock(dut.clk, 15.624, units="ns")
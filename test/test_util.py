@@ -1,12 +1,27 @@
+import os
 import random
 
+import numpy as np
+
 import cocotb
-from cocotb.triggers import ClockCycles, Timer
+from cocotb.triggers import ClockCycles, Timer, RisingEdge, FallingEdge, Edge, First, Lock
+from cocotb.utils import get_sim_time
 
 from riscvmodel.insn import *
 
-from riscvmodel.regnames import x0, gp, tp, a0
+from riscvmodel.regnames import x0, sp, gp, tp, t0, a0
+
+from insn_cache import encode, load_imm, ConstantCache, NOP
+from qspi_monitor import QspiMonitor
 
+# How closely the QSPI drivers below check the protocol, set with TQV_ASSERT_LEVEL:
+#   full    - every half clock is checked inline, for core regressions
+#   sampled - only cheap checks inline, and a background QspiMonitor checks one
+#             transaction in TQV_ASSERT_SAMPLE (16 by default)
+#   off     - no protocol checks, only the data the tests look at
+ASSERT_LEVEL = os.environ.get("TQV_ASSERT_LEVEL", "full")
+ASSERT_SAMPLE = int(os.environ.get("TQV_ASSERT_SAMPLE", "16"))
+assert ASSERT_LEVEL in ("full", "sampled", "off")
 
 async def reset(dut, latency=1, ui_in=0x80):
     # Reset
@@ -20,183 +35,346 @@ async def reset(dut, latency=1, ui_in=0x80):
     dut.qspi_data_in.value = 0
     dut.rst_n.value = 1
     dut.uart_rx.value = 1
+
+    # Take back the QSPI data in from anything a failed test left answering the core
+    dut.nop_feed_en.value = 0
+    dut.sim_qspi_enable.value = 0
+    dut.qspi_model_enable.value = 0
     await ClockCycles(dut.clk, 2)
     dut.rst_n.value = 0
     dut.latency_cfg.value = latency
     await ClockCycles(dut.clk, 1)
     assert dut.uio_oe.value == 0
+    start_time = get_sim_time()
     await ClockCycles(dut.clk, 9)
+    dut._clk_period = (get_sim_time() - start_time) // 9
     dut.rst_n.value = 1
     await ClockCycles(dut.clk, 1)
     assert dut.uio_oe.value == 0b11001001
-
-select = None
+    harness(dut).reset()
+
+# Follow the opening phases of a transaction by the QSPI clocks tb.v counts since
+# select fell, without checking each nibble, so a change in the core's timing
+# fails here rather than leaving the drivers out of step.  Returns at the falling
+# edge of clk after the last of them, with the QSPI clock low, as the full checks do.
+async def _skip_qspi_clocks(h, select, clocks, check):
+    timeout = h.timeout[20]
+    if select.value != 0:
+        assert await First(FallingEdge(select), timeout) is not timeout, "Timed out waiting for the QSPI transaction to start"
+        h.wakeups += 1
+    while h.txn_clocks.value.integer < clocks:
+        assert await First(h.txn_clock, timeout) is not timeout, f"QSPI clock stopped after {h.txn_clocks.value.integer} of {clocks} clocks"
+        h.wakeups += 1
+        if check:
+            assert select.value == 0
+    await h.clk_fall
+    h.wakeups += 1
+    if check:
+        assert select.value == 0
+        assert h.clk_out.value == 0
+        assert h.txn_clocks.value.integer == clocks
 
 async def start_read(dut, addr):
-    global select
-
+    h = handles(dut)
     if addr is None:
-        select = dut.qspi_flash_select
+        select = h.flash_select
     elif addr >= 0x1800000:
-        select = dut.qspi_ram_b_select
+        select = h.ram_b_select
     elif addr >= 0x1000000:
-        select = dut.qspi_ram_a_select
+        select = h.ram_a_select
     else:
-        select = dut.qspi_flash_select
-    
-    assert select.value == 0
-    assert dut.qspi_flash_select.value == (0 if dut.qspi_flash_select == select else 1)
-    assert dut.qspi_ram_a_select.value == (0 if dut.qspi_ram_a_select == select else 1)
-    assert dut.qspi_ram_b_select.value == (0 if dut.qspi_ram_b_select == select else 1)
-    assert dut.qspi_clk_out.value == 0
-
-    if dut.qspi_flash_select != select:
+        select = h.flash_select
+
+    level = harness(dut).assert_level
+    if level != "off":
+        assert select.value == 0
+        assert h.flash_select.value == (0 if h.flash_select == select else 1)
+        assert h.ram_a_select.value == (0 if h.ram_a_select == select else 1)
+        assert h.ram_b_select.value == (0 if h.ram_b_select == select else 1)
+        assert h.clk_out.value == 0
+    if level != "full":
+        # Command and address, or address and dummy, and turnaround are 12 QSPI clocks
+        await _skip_qspi_clocks(h, select, 12, level != "off")
+        if level != "off":
+            assert h.data_oe.value == 0
+        return
+
+    if h.flash_select != select:
         # Command
         cmd = 0x0B
-        assert dut.qspi_data_oe.value == 0xF    # Command
+        assert h.data_oe.value == 0xF    # Command
         for i in range(2):
-            await ClockCycles(dut.clk, 1, False)
+            await h.clk_fall
             assert select.value == 0
-            assert dut.qspi_clk_out.value == 1
-            assert dut.qspi_data_out.value == (cmd & 0xF0) >> 4
-            assert dut.qspi_data_oe.value == 0xF
+            assert h.clk_out.value == 1
+            assert h.data_out.value == (cmd & 0xF0) >> 4
+            assert h.data_oe.value == 0xF
             cmd <<= 4
-            await ClockCycles(dut.clk, 1, False)
+            await h.clk_fall
             assert select.value == 0
-            assert dut.qspi_clk_out.value == 0
+            assert h.clk_out.value == 0
 
     # Address
-    assert dut.qspi_data_oe.value == 0xF
+    assert h.data_oe.value == 0xF
     for i in range(6):
-        await ClockCycles(dut.clk, 1, False)
+        await h.clk_fall
         assert select.value == 0
-        assert dut.qspi_clk_out.value == 1
+        assert h.clk_out.value == 1
         if addr is not None:
-            assert dut.qspi_data_out.value == (addr >> (20 - i * 4)) & 0xF
-        assert dut.qspi_data_oe.value == 0xF
-        await ClockCycles(dut.clk, 1, False)
+            assert h.data_out.value == (addr >> (20 - i * 4)) & 0xF
+        assert h.data_oe.value == 0xF
+        await h.clk_fall
         assert select.value == 0
-        assert dut.qspi_clk_out.value == 0
+        assert h.clk_out.value == 0
 
     # Dummy
-    if dut.qspi_flash_select == select:
+    if h.flash_select == select:
         for i in range(2):
-            await ClockCycles(dut.clk, 1, False)
+            await h.clk_fall
             assert select.value == 0
-            assert dut.qspi_clk_out.value == 1
-            assert dut.qspi_data_oe.value == 0xF
-            assert dut.qspi_data_out.value == 0xA
-            await ClockCycles(dut.clk, 1, False)
+            assert h.clk_out.value == 1
+            assert h.data_oe.value == 0xF
+            assert h.data_out.value == 0xA
+            await h.clk_fall
             assert select.value == 0
-            assert dut.qspi_clk_out.value == 0
+            assert h.clk_out.value == 0
 
     for i in range(4):
-        await ClockCycles(dut.clk, 1, False)
+        await h.clk_fall
         assert select.value == 0
-        assert dut.qspi_clk_out.value == 1
-        assert dut.qspi_data_oe.value == 0
-        await ClockCycles(dut.clk, 1, False)
+        assert h.clk_out.value == 1
+        assert h.data_oe.value == 0
+        await h.clk_fall
         assert select.value == 0
-        assert dut.qspi_clk_out.value == 0
+        assert h.clk_out.value == 0
 
 
 async def start_write(dut, addr):
-    global select
-
+    h = handles(dut)
     if addr >= 0x1800000:
-        select = dut.qspi_ram_b_select
+        select = h.ram_b_select
     else:
-        select = dut.qspi_ram_a_select
+        select = h.ram_a_select
 
-    assert select.value == 0
-    assert dut.qspi_flash_select.value == 1
-    assert dut.qspi_ram_a_select.value == (0 if dut.qspi_ram_a_select == select else 1)
-    assert dut.qspi_ram_b_select.value == (0 if dut.qspi_ram_b_select == select else 1)
-    assert dut.qspi_clk_out.value == 0
-    assert dut.qspi_data_oe.value == 0xF
+    level = harness(dut).assert_level
+    if level != "off":
+        assert select.value == 0
+        assert h.flash_select.value == 1
+        assert h.ram_a_select.value == (0 if h.ram_a_select == select else 1)
+        assert h.ram_b_select.value == (0 if h.ram_b_select == select else 1)
+        assert h.clk_out.value == 0
+        assert h.data_oe.value == 0xF
+    if level != "full":
+        # Command and address are 8 QSPI clocks
+        await _skip_qspi_clocks(h, select, 8, level != "off")
+        if level != "off":
+            assert h.data_oe.value == 0xF
+        return
 
     # Command
     cmd = 0x02
     for i in range(2):
-        await ClockCycles(dut.clk, 1, False)
+        await h.clk_fall
         assert select.value == 0
-        assert dut.qspi_clk_out.value == 1
-        assert dut.qspi_data_out.value == (cmd & 0xF0) >> 4
-        assert dut.qspi_data_oe.value == 0xF
+        assert h.clk_out.value == 1
+        assert h.data_out.value == (cmd & 0xF0) >> 4
+        assert h.data_oe.value == 0xF
         cmd <<= 4
-        await ClockCycles(dut.clk, 1, False)
+        await h.clk_fall
         assert select.value == 0
-        assert dut.qspi_clk_out.value == 0
+        assert h.clk_out.value == 0
 
     # Address
     for i in range(6):
-        await ClockCycles(dut.clk, 1, False)
+        await h.clk_fall
         assert select.value == 0
-        assert dut.qspi_clk_out.value == 1
-        assert dut.qspi_data_out.value == (addr >> (20 - i * 4)) & 0xF
-        assert dut.qspi_data_oe.value == 0xF
-        await ClockCycles(dut.clk, 1, False)
+        assert h.clk_out.value == 1
+        assert h.data_out.value == (addr >> (20 - i * 4)) & 0xF
+        assert h.data_oe.value == 0xF
+        await h.clk_fall
         assert select.value == 0
-        assert dut.qspi_clk_out.value == 0
+        assert h.clk_out.value == 0
+
+
+# The signal handles and triggers the harness uses, resolved once per dut rather
+# than looked up through the hierarchy on every use, see test_handle_cache.
+# Handles only present in RTL simulations are None in gate level simulations.
+# wakeups counts the times the drivers below resume, to measure their cost.
+# check is set for the full assertion level.
+class Handles:
+    def __init__(self, dut, check=True):
+        self.check = check
+        self.clk = dut.clk
+        self.clk_out = dut.qspi_clk_out
+        self.data_in = dut.qspi_data_in
+        self.data_out = dut.qspi_data_out
+        self.data_oe = dut.qspi_data_oe
+        self.flash_select = dut.qspi_flash_select
+        self.ram_a_select = dut.qspi_ram_a_select
+        self.ram_b_select = dut.qspi_ram_b_select
+        self.deselected = dut.qspi_deselected
+        self.nibble_oe = dut.qspi_nibble_oe
+        self.nop_feed_en = dut.nop_feed_en
+        self.nop_feed_busy = dut.nop_feed_busy
+        self.sim_qspi_enable = dut.sim_qspi_enable
+        self.flash_read_addr = dut.flash_read_addr
+        self.uo_out = dut.uo_out
+        self.debug_signal = dut.uo_out[7]
+        self.ui_in_base = dut.ui_in_base
+        self.debug_uart_tx = dut.debug_uart_tx
+        self.sim_rom = dut.qspi.rom
+        self.sim_ram_a = dut.qspi.ram_a
+        self.sim_ram_b = dut.qspi.ram_b
+
+        rtl = hasattr(dut.user_project, "i_tinyqv")
+        self.instr_addr = dut.user_project.i_tinyqv.instr_addr if rtl else None
+        self.core_debug_signal = dut.user_project.debug_signal if rtl else None
+        self.core_debug_rd = dut.user_project.debug_rd_r if rtl else None
+        self.peri_write_count = dut.peri_write_count if hasattr(dut, "peri_write_count") else None
+        self.peripherals = dut.user_project.i_peripherals if hasattr(dut.user_project, "i_peripherals") else None
+        self.peri_interrupts = dut.user_project.peri_interrupts if hasattr(dut.user_project, "peri_interrupts") else None
+        self.gpio_out_sel = dut.user_project.gpio_out_sel if hasattr(dut.user_project, "gpio_out_sel") else None
+
+        self.clk_fall = FallingEdge(dut.clk)
+        self.clk_rise = RisingEdge(dut.clk)
+        self.nibble_done = Edge(dut.qspi_nibble_strobe)
+        self.txn_clocks = dut.qspi_txn_clocks
+        self.txn_clock = Edge(dut.qspi_txn_clocks)
+        self.timeout = {limit: Timer(limit * dut._clk_period, "step") for limit in (20, 400)}
+        self.wakeups = 0
+
+def handles(dut):
+    return harness(dut).handles
+
+# Wait for the core to consume the nibble currently driven, checking that select
+# stays low and the data lines are not driven while the QSPI clock is high.
+# Returns at the falling edge of clk where the next nibble should be driven, or
+# returns False at the falling edge after select goes high if ok_to_exit is set.
+async def wait_nibble(q, select, ok_to_exit=False, allow_long_delay=False):
+    timeout = q.timeout[400 if allow_long_delay else 20]
+    select_rise = RisingEdge(select)
+    start_time = get_sim_time()
+    if select.value == 1:
+        trigger = select_rise
+    else:
+        while True:
+            trigger = await First(q.nibble_done, select_rise, timeout)
+            q.wakeups += 1
+
+            # A strobe at the start time finished the previous nibble
+            if trigger is not q.nibble_done or get_sim_time() != start_time:
+                break
 
+    if trigger is select_rise:
+        await q.clk_fall
+        q.wakeups += 1
+        assert ok_to_exit
+        return False
+    assert trigger is q.nibble_done, "Timed out waiting for the QSPI clock"
+    if q.check:
+        assert q.nibble_oe.value == 0
+    return True
 
 nibble_shift_order = [4, 0, 12, 8, 20, 16, 28, 24]
 
 async def send_instr(dut, data, ok_to_exit=False, allow_long_delay=False):
+    q = handles(dut)
+    instr_len = 8 if (data & 3) == 3 else 4
+    for i in range(instr_len):
+        q.data_in.value = (data >> (nibble_shift_order[i])) & 0xF
+        if not await wait_nibble(q, q.flash_select, ok_to_exit, allow_long_delay):
+            return
+        if i != instr_len - 1:
+            if ok_to_exit and q.flash_select.value == 1:
+                return
+            assert q.flash_select.value == 0
+
+# The original cycle by cycle polling implementation of send_instr, kept to
+# measure the edge driven version against in test_send_instr_wakeups.
+async def send_instr_polled(dut, data, ok_to_exit=False, allow_long_delay=False):
+    q = handles(dut)
     instr_len = 8 if (data & 3) == 3 else 4
     for i in range(instr_len):
         dut.qspi_data_in.value = (data >> (nibble_shift_order[i])) & 0xF
         await ClockCycles(dut.clk, 1, False)
+        q.wakeups += 1
         for _ in range(400 if allow_long_delay else 20):
             if ok_to_exit and dut.qspi_flash_select.value == 1:
                 return
             assert dut.qspi_flash_select.value == 0
             if dut.qspi_clk_out.value == 0:
                 await ClockCycles(dut.clk, 1, False)
+                q.wakeups += 1
             else:
                 break
         assert dut.qspi_clk_out.value == 1
         assert dut.qspi_data_oe.value == 0
         await ClockCycles(dut.clk, 1, False)
+        q.wakeups += 1
         assert dut.qspi_clk_out.value == 0
         if i != instr_len - 1:
             if ok_to_exit and dut.qspi_flash_select.value == 1:
                 return
             assert dut.qspi_flash_select.value == 0
 
+# Serve a load of val, bytes long, from PSRAM at addr
 async def expect_load(dut, addr, val, bytes=4):
+    await expect_load_burst(dut, addr, (val & ((1 << (bytes * 8)) - 1)).to_bytes(bytes, "little"))
+
+# Serve a load of the 32-bit words in words from sequential PSRAM addresses from addr,
+# and return them as a NumPy array.
+async def expect_load_words(dut, addr, words):
+    words = np.asarray(words, dtype=np.uint32)
+    await expect_load_burst(dut, addr, words.astype("<u4").tobytes())
+    return words
+
+# Serve a load of any length from PSRAM.  The data is placed in the simulated PMOD's
+# RAM and the PMOD serves the data phase of the transaction, so there are no Python
+# calls per word or nibble.  At the full assertion level the data phase is still
+# followed nibble by nibble to check the data lines are released.
+async def expect_load_burst(dut, addr, data):
+    h = handles(dut)
     if addr >= 0x1800000:
-        select = dut.qspi_ram_b_select
+        select = h.ram_b_select
     elif addr >= 0x1000000:
-        select = dut.qspi_ram_a_select
+        select = h.ram_a_select
     else:
         assert False # Load from flash not currently supported in this test
 
+    write_sim_ram(dut, addr, data)
     for i in range(12):
         if select.value == 0:
             await start_read(dut, addr)
-            dut.qspi_data_in.value = (val >> (nibble_shift_order[0])) & 0xF
-            for j in range(1,bytes*2):
-                await ClockCycles(dut.clk, 1, False)
-                assert select.value == 0
-                assert dut.qspi_clk_out.value == 1
-                assert dut.qspi_data_oe.value == 0
-                await ClockCycles(dut.clk, 1, False)
-                assert dut.qspi_clk_out.value == 0
-                dut.qspi_data_in.value = (val >> (nibble_shift_order[j])) & 0xF
+            h.sim_qspi_enable.value = 1
+            if h.check:
+                for j in range(1, len(data)*2):
+                    await wait_nibble(h, select)
+            if select.value == 0:
+                await _wait_deselect(h, select)
+            h.sim_qspi_enable.value = 0
             break
-        elif dut.qspi_flash_select.value == 0:
+        elif h.flash_select.value == 0:
             await send_instr(dut, 0x0001, True)
         else:
-            await ClockCycles(dut.clk, 1, False)
+            await h.clk_fall
     else:
         assert False
 
+    await _resume_flash(dut)
+
+# Wait for the core to finish the current transaction on select
+async def _wait_deselect(h, select):
+    timeout = h.timeout[400]
+    assert await First(RisingEdge(select), timeout) is not timeout, "Timed out waiting for the QSPI transaction to end"
+
+# Serve the instruction fetch the core makes after a load or store
+async def _resume_flash(dut):
+    h = handles(dut)
     for i in range(8):
-        await ClockCycles(dut.clk, 1)
-        if dut.qspi_flash_select.value == 0:
-            if hasattr(dut.user_project, "i_tinyqv"):
-                await start_read(dut, dut.user_project.i_tinyqv.instr_addr.value.integer * 2)
+        await h.clk_rise
+        if h.flash_select.value == 0:
+            if h.instr_addr is not None:
+                await start_read(dut, h.instr_addr.value.integer * 2)
             else:
                 await start_read(dut, None)
             break
@@ -205,115 +383,324 @@ async def expect_load(dut, addr, val, bytes=4):
 
 async def load_reg(dut, reg, value):
     offset = random.randint(-0x400, 0x3FF)
-    instr = InstructionLW(reg, gp, offset).encode()
+    instr = encode(InstructionLW, reg, gp, offset)
     await send_instr(dut, instr)
 
     await expect_load(dut, 0x1000400 + offset, value)
 
 
-send_nops = True
-nop_task = None
-
-async def nops_loop(dut):
-    while send_nops:
-        await send_instr(dut, InstructionADDI(x0, x0, 0).encode())
+# The state of the harness for one dut, shared by everything that drives its core:
+# the NOP feeder, the QSPI handles and what is known about the core's registers.
+# Code that sends instructions to the core from more than one coroutine, such as
+# several TinyQV objects testing different peripherals at once, must hold lock while
+# it does.  Nothing may hold it across a reset.
+class Harness:
+    def __init__(self, dut):
+        self.dut = dut
+        self.lock = Lock()
+        self.nops_started = False
+        self._handles = None
+
+        # See ASSERT_LEVEL.  monitor is the background checker for the sampled level.
+        self.assert_level = ASSERT_LEVEL
+        self.monitor = None
+
+        # Values known to be in a0-a5, see ConstantCache
+        self.consts = ConstantCache()
+
+        # The peripheral bus write count in tb.v once all the stores sent have
+        # completed, or None if it isn't known.  Used by TinyQV's sync fence.
+        self.bus_writes = None
+
+    # The handles include timeouts based on the clock period, so are resolved after reset
+    @property
+    def handles(self):
+        if self._handles is None:
+            self._handles = Handles(self.dut, self.assert_level == "full")
+        return self._handles
+
+    def reset(self):
+        assert not self.lock.locked(), "Reset while another coroutine is sending instructions to the core"
+        self.nops_started = False
+        self._handles = None
+        self.invalidate()
+
+        if self.monitor is not None:
+            self.monitor.stop()
+            self.monitor = None
+        if self.assert_level == "sampled":
+            self.monitor = QspiMonitor(self.dut, ASSERT_SAMPLE)
+            self.monitor.start()
+
+    # Forget what is known about the core's state, after reset or running
+    # code that the harness didn't send itself.
+    def invalidate(self):
+        self.consts.invalidate()
+        self.bus_writes = None
+
+    # The NOP feeder in tb.v answers instruction fetches with NOPs until stop_nops,
+    # so idle time costs nothing in Python.
+    async def start_nops(self):
+        self.nops_started = True
+        self.handles.nop_feed_en.value = 1
+
+        # This ensures that the feeder sees the enable, so that it can be instantly stopped.
+        await Timer(2, "ps")
+
+    async def stop_nops(self):
+        if not self.nops_started:
+            return
+        h = self.handles
+        h.nop_feed_en.value = 0
+        await Timer(1, "ps")
+        if h.nop_feed_busy.value == 1:
+            await FallingEdge(h.nop_feed_busy)
+
+def harness(dut):
+    try:
+        return dut._harness
+    except AttributeError:
+        dut._harness = Harness(dut)
+        return dut._harness
 
 async def start_nops(dut):
-    global send_nops, nop_task
-    send_nops = True
-    nop_task = cocotb.start_soon(nops_loop(dut))
-
-    # This ensures that the nop task is actually started, so that it can be instantly stopped.
-    await Timer(2, "ps")
+    await harness(dut).start_nops()
 
-async def stop_nops():
-    global send_nops, nop_task
-    send_nops = False
-    if nop_task is not None:
-        await nop_task
-    nop_task = None
+async def stop_nops(dut):
+    await harness(dut).stop_nops()
 
 async def read_byte(dut, reg, expected_val):
-  await send_instr(dut, InstructionSW(tp, reg, 0x18).encode())
+  h = handles(dut)
+  await send_instr(dut, encode(InstructionSW, tp, reg, 0x18))
 
   await start_nops(dut)
   for i in range(80):
-      if dut.debug_uart_tx.value == 0:
+      if h.debug_uart_tx.value == 0:
           break
       else:
           await Timer(5, "ns")
-  assert dut.debug_uart_tx.value == 0
+  assert h.debug_uart_tx.value == 0
   bit_time = 250
   await Timer(bit_time / 2, "ns")
-  assert dut.debug_uart_tx.value == 0
+  assert h.debug_uart_tx.value == 0
   for i in range(8):
       await Timer(bit_time, "ns")
-      assert dut.debug_uart_tx.value == (expected_val & 1)
+      assert h.debug_uart_tx.value == (expected_val & 1)
       expected_val >>= 1
   await Timer(bit_time, "ns")
-  assert dut.debug_uart_tx.value == 1
+  assert h.debug_uart_tx.value == 1
 
-  await stop_nops()
+  await stop_nops(dut)
 
+# Capture a store of bytes to PSRAM at addr, and return the value stored
 async def expect_store(dut, addr, bytes=4, allow_long_delay=False):
+    return int.from_bytes(await expect_store_burst(dut, addr, bytes, allow_long_delay), "little")
+
+# Capture a store of count 32-bit words to sequential PSRAM addresses from addr,
+# and return them as a NumPy array.
+async def expect_store_words(dut, addr, count, allow_long_delay=False):
+    data = await expect_store_burst(dut, addr, count * 4, allow_long_delay)
+    return np.frombuffer(data, dtype="<u4").astype(np.uint32)
+
+# Capture a store of any length to PSRAM, and return the bytes stored.  The simulated
+# PMOD always captures writes into its RAM, so the data is read back from there once
+# the transaction ends, with no Python calls per word or nibble.  At the full
+# assertion level the data phase is still checked nibble by nibble, including the
+# extra QSPI clock the core takes between the words of a multi-word store.
+async def expect_store_burst(dut, addr, bytes, allow_long_delay=False):
+    h = handles(dut)
     if addr >= 0x1800000:
-        select = dut.qspi_ram_b_select
+        select = h.ram_b_select
     elif addr >= 0x1000000:
-        select = dut.qspi_ram_a_select
+        select = h.ram_a_select
     else:
         assert False
 
-    val = 0
     for i in range(12):
         if select.value == 0:
             await start_write(dut, addr)
+            if not h.check:
+                await _wait_deselect(h, select)
+                await h.clk_fall
+                break
             for j in range(bytes*2):
-                await ClockCycles(dut.clk, 1, False)
+                await h.clk_fall
                 assert select.value == 0
                 if j > 0 and (j % 8) == 0:
-                    await ClockCycles(dut.clk, 1, False)
+                    await h.clk_fall
                     assert select.value == 0
-                    assert dut.qspi_clk_out.value == 0
-                    await ClockCycles(dut.clk, 1, False)
-                assert dut.qspi_clk_out.value == 1
-                assert dut.qspi_data_oe.value == 0xF
-                val |= dut.qspi_data_out.value << (nibble_shift_order[j % 8])
-                await ClockCycles(dut.clk, 1, False)
+                    assert h.clk_out.value == 0
+                    await h.clk_fall
+                assert h.clk_out.value == 1
+                assert h.data_oe.value == 0xF
+                await h.clk_fall
                 assert select.value == (1 if j == bytes*2-1 else 0)
-                assert dut.qspi_clk_out.value == 0
-            await ClockCycles(dut.clk, 1, False)
+                assert h.clk_out.value == 0
+            await h.clk_fall
             assert select.value == 1
             break
-        elif dut.qspi_flash_select.value == 0:
+        elif h.flash_select.value == 0:
             await send_instr(dut, 0x0001, True, allow_long_delay)
         else:
-            await ClockCycles(dut.clk, 1, False)
+            await h.clk_fall
     else:
         assert False
 
-    for i in range(8):
-        await ClockCycles(dut.clk, 1)
-        if dut.qspi_flash_select.value == 0:
-            if hasattr(dut.user_project, "i_tinyqv"):
-                await start_read(dut, dut.user_project.i_tinyqv.instr_addr.value.integer * 2)
-            else:
-                await start_read(dut, None)
-            break
-    else:
-        assert False
-
-    return val
+    await _resume_flash(dut)
+    return read_sim_ram(dut, addr, bytes)
 
 async def read_reg(dut, reg, allow_long_delay=False):
     offset = random.randint(-0x400, 0x3FF)
-    instr = InstructionSW(gp, reg, offset).encode()
+    instr = encode(InstructionSW, gp, reg, offset)
     await send_instr(dut, instr)
 
     return await expect_store(dut, 0x1000400 + offset, 4, allow_long_delay)
 
 async def set_all_outputs_to_peripheral(dut, peripheral_num):
-    await send_instr(dut, InstructionADDI(a0, x0, 0xc0).encode())
-    await send_instr(dut, InstructionSW(tp, a0, 0xc).encode())
-    await send_instr(dut, InstructionADDI(a0, x0, peripheral_num).encode())
+    await send_instr(dut, encode(InstructionADDI, a0, x0, 0xc0))
+    await send_instr(dut, encode(InstructionSW, tp, a0, 0xc))
+    await send_instr(dut, encode(InstructionADDI, a0, x0, peripheral_num))
     for func_sel in range(0x60, 0x80, 4):
-        await send_instr(dut, InstructionSW(tp, a0, func_sel).encode())
+        await send_instr(dut, encode(InstructionSW, tp, a0, func_sel))
+
+
+### Simulated QSPI PMOD in tb.v ###
+
+SIM_FLASH_SIZE = 1 << 15
+SIM_RAM_SIZE = 1 << 13
+
+def write_sim_flash(dut, addr, data):
+    rom = handles(dut).sim_rom
+    for i, b in enumerate(data):
+        rom[(addr + i) % SIM_FLASH_SIZE].value = b
+
+def write_sim_ram(dut, addr, data):
+    h = handles(dut)
+    ram = h.sim_ram_b if addr >= 0x1800000 else h.sim_ram_a
+    for i, b in enumerate(data):
+        ram[(addr + i) % SIM_RAM_SIZE].value = b
+
+def read_sim_ram(dut, addr, length):
+    h = handles(dut)
+    ram = h.sim_ram_b if addr >= 0x1800000 else h.sim_ram_a
+    return bytes(ram[(addr + i) % SIM_RAM_SIZE].value.integer for i in range(length))
+
+# Jump to code at addr in the simulated flash and let the core run it from the
+# simulated QSPI PMOD.  The code must finish with a "j ." at end_addr, once the core
+# reaches it the harness takes over the flash again and this returns with the core
+# ready to execute instructions sent with send_instr.
+# Returns the number of clock cycles the core ran from the simulated flash.
+# t0 is clobbered by the jump.
+async def run_sim_flash(dut, addr, end_addr):
+    h = handles(dut)
+    addr_upper = ((addr + 0x800) >> 12) & 0xfffff
+    addr_lower = addr & 0xfff
+    if addr_lower >= 0x800:
+        addr_lower -= 0x1000
+    await send_instr(dut, encode(InstructionLUI, t0, addr_upper))
+    await send_instr(dut, encode(InstructionJALR, x0, t0, addr_lower))
+
+    # Feed NOPs until the jump is taken, then hand the flash to the simulated PMOD
+    while h.flash_select.value == 0:
+        await send_instr(dut, 0x0001, True)
+    h.sim_qspi_enable.value = 1
+    start_time = get_sim_time()
+
+    # A flash read starting at the end address means the core is spinning on the final jump
+    while True:
+        await RisingEdge(h.flash_select)
+        if h.flash_read_addr.value.integer == end_addr:
+            break
+    h.sim_qspi_enable.value = 0
+    cycles = (get_sim_time() - start_time) // dut._clk_period
+
+    for i in range(8):
+        await h.clk_rise
+        if h.flash_select.value == 0:
+            await start_read(dut, end_addr)
+            break
+    else:
+        assert False
+
+    return cycles
+
+# Register values for preload_regs are placed here in PSRAM A, and the code to load them here in flash
+PRELOAD_DATA_ADDR = 0x1000500
+PRELOAD_ADDR = 0x7000
+
+def encode_clwsp(reg, imm):
+    scrambled = (((imm << (12 - 5)) & 0b1000000000000) |
+                 ((imm << ( 4 - 2)) & 0b0000001110000) |
+                 ((imm >> ( 6 - 2)) & 0b0000000001100))
+    return 0x4002 | scrambled | (reg << 7)
+
+# Set x1, x2 and x5-x15 to values[1], values[2] and values[5:16] in one run from the
+# simulated QSPI PMOD, instead of a load transaction for each register.
+# The values are placed in the simulated PSRAM and loaded with c.lwsp, so the
+# setup costs the same small number of Python wakeups however the values change.
+# gp and tp keep their fixed values, and the core is left ready for send_instr.
+async def preload_regs(dut, values):
+    image = b"".join((value & 0xFFFFFFFF).to_bytes(4, "little") for value in values[:16])
+    write_sim_ram(dut, PRELOAD_DATA_ADDR, image)
+
+    code = list(load_imm(sp, PRELOAD_DATA_ADDR))
+    code += [encode_clwsp(reg, reg * 4) for reg in range(1, 16) if reg not in (sp, gp, tp)]
+    code.append(encode_clwsp(sp, sp * 4))
+    data = b"".join(instr.to_bytes(4 if instr & 3 == 3 else 2, "little") for instr in code)
+    if len(data) & 3:
+        data += (0x0001).to_bytes(2, "little")
+    end_addr = PRELOAD_ADDR + len(data)
+
+    # Finish with "j .", padded with NOPs so the core's prefetch reads defined data
+    data += b"".join(instr.to_bytes(4, "little") for instr in [encode(InstructionJAL, x0, 0)] + [NOP] * 4)
+    write_sim_flash(dut, PRELOAD_ADDR, data)
+
+    await run_sim_flash(dut, PRELOAD_ADDR, end_addr)
+    harness(dut).invalidate()
+
+# Selecting debug signal 13 on ui_in[6:3] makes uo_out[7] go high as an instruction
+# writing a register completes, see test_debug_reg.
+DEBUG_SIGNAL_SELECT = 0b1101 << 3
+
+# The debug signal is output on uo_out[7] unless a peripheral claims it, which it does
+# from reset if ui_in[0] was low.  Where the selection can be seen, check it is clear.
+def assert_debug_signal_output(h):
+    if h.gpio_out_sel is not None:
+        assert not (h.gpio_out_sel.value.integer >> 1) & 1, \
+            "uo_out[7] is claimed by a peripheral, reset with ui_in[0] high for the debug signal"
+
+# Read all 16 registers in one pass over the debug register port, instead of a store
+# and an expect_store for each.  This needs debug register data enabled, by ui_in[1]
+# being high at reset, so that the value written to a register is output on
+# uo_out[5:2] a nibble per cycle, and the debug signal on uo_out[7], by ui_in[0]
+# being high at reset and uo_out[7] not claimed by a peripheral since.
+# Each register is rewritten with its own value by "addi xN, xN, 0" and the value
+# captured as it goes past.  ui_in[6:3] is changed while this runs.
+# Returns the 16 values, with the core left ready for send_instr.
+async def dump_regs(dut):
+    h = handles(dut)
+    assert_debug_signal_output(h)
+    ui_in = h.ui_in_base.value.integer
+    h.ui_in_base.value = (ui_in & 0x87) | DEBUG_SIGNAL_SELECT
+
+    values = [0]
+    for reg in range(1, 16):
+        await send_instr(dut, encode(InstructionADDI, reg, reg, 0))
+        await start_nops(dut)
+        for i in range(24):
+            if h.debug_signal.value == 1:
+                break
+            await h.clk_rise
+        else:
+            assert False, f"No debug output for x{reg}"
+
+        await h.clk_rise
+        val = 0
+        for j in range(8):
+            val |= ((h.uo_out.value.integer >> 2) & 0xF) << (4 * j)
+            await h.clk_rise
+        await stop_nops(dut)
+        values.append(val)
+
+    h.ui_in_base.value = ui_in
+    return values
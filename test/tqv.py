@@ -1,10 +1,60 @@
-from cocotb.triggers import ClockCycles
+import os
+
+import cocotb
+from cocotb.triggers import ClockCycles, FallingEdge, Edge, First, Timer, Trigger
+from cocotb.handle import Force, Release
+from cocotb.utils import get_sim_time
 
 from riscvmodel.insn import *
 from riscvmodel.regnames import x0, tp, a0, a1
 from riscvmodel import csrnames
 
 import test_util
+import insn_cache
+from insn_cache import encode
+from tqv_program import Program
+
+# Set TQV_FRONT_DOOR=1 to make every register access go through the CPU, even
+# where a test asks for the backdoor, for sign-off runs.
+FRONT_DOOR_ONLY = os.environ.get("TQV_FRONT_DOOR", "0") != "0"
+
+# Synced writes wait for the peripheral bus write count in tb.v where it is available.
+# Set TQV_SYNC_FENCE=readback to always read the value written back through the core
+# instead, the slower but more paranoid check used in gate level simulations.
+SYNC_FENCE = os.environ.get("TQV_SYNC_FENCE", "bus")
+
+# Clock cycles to wait for outstanding stores to complete before failing
+FENCE_TIMEOUT_CYCLES = 400
+
+# data_write_n / data_read_n encoding of the access width
+ACCESS_WIDTH = {8: 0b00, 16: 0b01, 32: 0b10}
+
+# A trigger that never fires.  cocotb has no hook for the end of a test, but it kills
+# the tasks still running, which unprimes the trigger each is waiting on, so a task
+# waiting on this calls on_end as the test ends.
+class _TestEnd(Trigger):
+    def __init__(self, on_end):
+        super().__init__()
+        self.on_end = on_end
+
+    def prime(self, callback):
+        super().prime(callback)
+
+    def unprime(self):
+        if self.primed:
+            self.on_end()
+        super().unprime()
+
+# The instance of a full peripheral in tinyQV_peripherals, named for its number as
+# i_user_peri05 and i_rejunity_vga12 are, or None.  Byte peripherals and the built in
+# ones aren't found, and are accessed through the core even if the backdoor is asked for.
+def _find_peripheral_instance(peripherals, peripheral_num):
+    if not 3 <= peripheral_num < 16:
+        return None
+    for child in peripherals:
+        if child._name.endswith(f"{peripheral_num:02d}") and hasattr(child, "data_write_n"):
+            return child
+    return None
 
 # This class provides access to the peripheral's registers.
 class TinyQV:
@@ -19,12 +69,46 @@ class TinyQV:
             self.base_address = peripheral_num * 0x40 - 0x200
         else:
             self.base_address = 0x300 + peripheral_num * 0x10
+        insn_cache.add_register_window(self.base_address)
+
+        # Shared with any other TinyQV on the same dut, see test_util.Harness
+        self.harness = test_util.harness(dut)
+
+        # The backdoor drives the peripheral's bus ports directly, so it needs the RTL hierarchy.
+        self.backdoor_instance = None
+        if not FRONT_DOOR_ONLY and hasattr(dut.user_project, "i_peripherals"):
+            self.backdoor_instance = _find_peripheral_instance(dut.user_project.i_peripherals, peripheral_num)
+        self.backdoor_available = self.backdoor_instance is not None
+
+        # In RTL the interrupt line can be watched directly.  Simple peripherals have no interrupt.
+        self.rtl_interrupt = hasattr(dut.user_project, "peri_interrupts") and 2 <= peripheral_num < 16
+        self.interrupt_task = None
+        self.interrupt_time = None
+        self.stimulus_time = 0
+
+        # Sync fence, see _fence
+        self.fence_mode = "bus" if SYNC_FENCE != "readback" and hasattr(dut, "peri_write_count") else "readback"
+        self.fence_count = 0
+        self.fence_cycles = 0
+        self.fence_stats_task = None
+
+        # Write combining, see enable_write_combining
+        self.combine_widths = ()
+        self.pending = {}
+        self.pending_word = None
+        self.pending_sync = False
 
     # Reset the design, this reset will initialize TinyQV and connect
     # all inputs and outputs to your peripheral.
+    # When several TinyQV objects share the dut, only one of them should reset it,
+    # while none of the others are accessing their registers.
     async def reset(self, initial_ui_in=0):
         # Ensure any previously running test is cleaned up
-        await test_util.stop_nops()
+        await test_util.stop_nops(self.dut)
+        self.pending = {}
+        self.pending_sync = False
+        insn_cache.log_stats(self.dut._log)
+        self.log_fence_stats()
 
         await test_util.reset(self.dut, 1, initial_ui_in)
 
@@ -36,113 +120,394 @@ class TinyQV:
 
         await test_util.start_nops(self.dut)
 
+        if self.rtl_interrupt:
+            if self.interrupt_task is not None:
+                self.interrupt_task.kill()
+            self.interrupt_time = None
+            self.interrupt_task = cocotb.start_soon(self._watch_interrupt())
+        self.mark_stimulus()
+
+    # Send the instructions to write value to the register at reg, width is 8, 16 or 32.
+    # Returns the register the value was left in.
+    async def _send_write(self, width, reg, value):
+        src, instrs = self.harness.consts.materialize(value)
+        for instr in instrs:
+            await test_util.send_instr(self.dut, instr)
+        store = {8: InstructionSB, 16: InstructionSH, 32: InstructionSW}[width]
+        await test_util.send_instr(self.dut, encode(store, tp, src, self.base_address + reg))
+        if self.harness.bus_writes is not None:
+            self.harness.bus_writes += 1
+        self.mark_stimulus()
+        return src
+
+    # Send the instructions to read the register at reg, width is 8, 16 or 32,
+    # and return the value read.
+    async def _send_read(self, width, reg):
+        load = {8: InstructionLBU, 16: InstructionLHU, 32: InstructionLW}[width]
+        await test_util.send_instr(self.dut, encode(load, a1, tp, self.base_address + reg))
+        self.harness.consts.invalidate(a1)
+        val = await test_util.read_reg(self.dut, a1, True)
+
+        # The load completes after any earlier stores
+        self._bus_idle()
+        return val
+
+    # Called when all the stores sent are known to have completed
+    def _bus_idle(self):
+        if self.fence_mode == "bus":
+            self.harness.bus_writes = self.harness.handles.peri_write_count.value.integer
+
+    # Ensure all the stores sent have completed, src holds the last value written.
+    # Called with the NOP feeder stopped, returns with it running again.
+    # The bus fence lets the core run on and waits for the peripheral bus write count
+    # to reach the harness's bus_writes.  The readback fence, used when that isn't
+    # available or the count isn't known, stores src to RAM and checks the value,
+    # which can only happen once the earlier stores have completed.
+    async def _fence(self, src, value):
+        start = get_sim_time()
+        bus_writes = self.harness.bus_writes
+        if self.fence_mode == "bus" and bus_writes is not None:
+            await test_util.start_nops(self.dut)
+            count = self.harness.handles.peri_write_count
+            timeout = Timer(FENCE_TIMEOUT_CYCLES * self.dut._clk_period, "step")
+            while count.value.integer < bus_writes:
+                assert await First(Edge(count), timeout) is not timeout, "Timed out waiting for stores to complete"
+        else:
+            assert await test_util.read_reg(self.dut, src) == value
+            self._bus_idle()
+            await test_util.start_nops(self.dut)
+        self.fence_count += 1
+        self.fence_cycles += (get_sim_time() - start) // self.dut._clk_period
+        if self.fence_stats_task is None:
+            self.fence_stats_task = cocotb.start_soon(self._log_fence_stats_at_end())
+
+    # Log the fence stats when the test ends, including those of a TinyQV that is never reset
+    async def _log_fence_stats_at_end(self):
+        await _TestEnd(self._test_ended)
+
+    def _test_ended(self):
+        self.fence_stats_task = None
+        self.log_fence_stats()
+
+    # Log the number of sync fences since they were last logged and the clock cycles
+    # they took, so the cost of synced writes shows up alongside the test timings.
+    def log_fence_stats(self):
+        if self.fence_count:
+            self.dut._log.info(f"Sync fences ({self.fence_mode}, peripheral {self.peripheral_num}): "
+                               f"{self.fence_count} taking {self.fence_cycles} cycles, "
+                               f"{self.fence_cycles / self.fence_count:.1f} cycles per fence")
+        self.fence_count = 0
+        self.fence_cycles = 0
+
+    async def _write(self, width, reg, value, sync, backdoor=False):
+        if self.combine_widths and width < 32 and not backdoor:
+            await self._combine_write(width, reg, value, sync)
+            return
+        await self.flush()
+
+        async with self.harness.lock:
+            if backdoor and self.backdoor_available:
+                await self._backdoor_write(width, reg, value)
+                return
+
+            await test_util.stop_nops(self.dut)
+            src = await self._send_write(width, reg, value)
+
+            if sync:
+                # Ensure the store is complete before returning
+                await self._fence(src, value)
+            else:
+                await test_util.start_nops(self.dut)
+
+    async def _read(self, width, reg, backdoor=False):
+        await self.flush()
+        async with self.harness.lock:
+            if backdoor and self.backdoor_available:
+                return await self._backdoor_read(width, reg)
+
+            await test_util.stop_nops(self.dut)
+            val = await self._send_read(width, reg)
+            await test_util.start_nops(self.dut)
+            return val
+
+    # Enable write combining for peripherals where a wide write has the same effect
+    # as narrow writes to each of its bytes.  widths are the wider accesses (16 and/or 32)
+    # the peripheral accepts, an empty list disables combining.
+    # While enabled, byte and half word writes are held back as long as they fill
+    # adjacent, not yet written bytes of one aligned word, and are then written using
+    # the widest accesses allowed that cover them, lowest address first.  The writes are
+    # made when the word is complete, on flush(), or before any other access, which is
+    # always ordered after them.  If any of the combined writes asked for sync, the
+    # flush is synced.
+    def enable_write_combining(self, widths=(16, 32)):
+        assert all(width in (16, 32) for width in widths)
+        self.combine_widths = tuple(widths)
+
+    async def _combine_write(self, width, reg, value, sync):
+        offsets = range(reg, reg + width // 8)
+        word = reg & ~3
+        if self.pending and (word != self.pending_word or any(offset in self.pending for offset in offsets)):
+            await self.flush()
+        if (reg + width // 8 - 1) & ~3 != word:
+            # Crosses a word boundary, don't combine
+            await self.access_regs([(width, reg, value)], sync)
+            return
+
+        for i, offset in enumerate(offsets):
+            self.pending[offset] = (value >> (8 * i)) & 0xFF
+        self.pending_word = word
+        self.pending_sync |= sync
+        if len(self.pending) == 4:
+            await self.flush()
+
+    # Make any writes held back by write combining
+    async def flush(self):
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, {}
+        sync, self.pending_sync = self.pending_sync, False
+        word = self.pending_word
+
+        ops = []
+        if len(pending) == 4 and 32 in self.combine_widths:
+            ops.append((32, word, int.from_bytes(bytes(pending[word + i] for i in range(4)), "little")))
+        else:
+            for half in (word, word + 2):
+                if half in pending and half + 1 in pending and 16 in self.combine_widths:
+                    ops.append((16, half, pending[half] | (pending[half + 1] << 8)))
+                else:
+                    ops += [(8, offset, pending[offset]) for offset in (half, half + 1) if offset in pending]
+        await self.access_regs(ops, sync)
+
+    # Backdoor accesses force the bus ports of the peripheral's own instance for as
+    # long as the core would drive them.  Icarus merges a port connected straight to a
+    # net with that net, so forcing the ports of tinyQV_peripherals would drive the core's
+    # write_n, read_n and addr too, and be seen by the peripheral bus write count and the
+    # decoding in project.v.  The instance's data_write_n and data_read_n are gated per
+    # peripheral and address is a part of addr_in, so forcing those reaches that
+    # peripheral alone.  Its data_in is the core's data_to_write net, which nothing uses
+    # without a write strobe.  The core is left running the NOP feeder, which doesn't use
+    # the bus.
+    async def _backdoor_write(self, width, reg, value):
+        peri = self.backdoor_instance
+        await FallingEdge(self.dut.clk)
+        peri.address.value = Force(reg)
+        peri.data_in.value = Force(value & 0xFFFFFFFF)
+        peri.data_write_n.value = Force(ACCESS_WIDTH[width])
+        await FallingEdge(self.dut.clk)
+        peri.address.value = Release()
+        peri.data_in.value = Release()
+        peri.data_write_n.value = Release()
+        self.mark_stimulus()
+
+    async def _backdoor_read(self, width, reg):
+        peri = self.backdoor_instance
+        await FallingEdge(self.dut.clk)
+        peri.address.value = Force(reg)
+        peri.data_read_n.value = Force(ACCESS_WIDTH[width])
+        for _ in range(64):
+            await FallingEdge(self.dut.clk)
+            if peri.data_ready.value == 1:
+                break
+        else:
+            assert False, "Timed out waiting for backdoor read"
+        val = peri.data_out.value.integer & ((1 << width) - 1)
+        peri.address.value = Release()
+        peri.data_read_n.value = Release()
+        return val
+
     # Write a value to a byte register in your design
     # reg is the address of the register in the range 0-15
     # value is the value to be written, in the range 0-255
     # If sync is false this function will return before the store is completed.
-    async def write_reg(self, reg, value, sync=True):
-        await test_util.stop_nops()
-        await test_util.send_instr(self.dut, InstructionADDI(a1, x0, value).encode())
-        await test_util.send_instr(self.dut, InstructionSB(tp, a1, self.base_address + reg).encode())
-
-        if sync:
-            # Read a register in order to ensure the store is complete before returning
-            assert await test_util.read_reg(self.dut, a1) == value
-
-        await test_util.start_nops(self.dut)
+    # If backdoor is true the register is written directly in RTL simulations, see _backdoor_write.
+    async def write_reg(self, reg, value, sync=True, backdoor=False):
+        await self._write(8, reg, value, sync, backdoor)
 
     # Read the value of a byte register from your design
     # reg is the address of the register in the range 0-15
     # The returned value is the data read from the register, in the range 0-255
-    async def read_reg(self, reg):
-        await test_util.stop_nops()
-        await test_util.send_instr(self.dut, InstructionLBU(a1, tp, self.base_address + reg).encode())
-        val = await test_util.read_reg(self.dut, a1, True)
-        await test_util.start_nops(self.dut)
-        return val
+    # If backdoor is true the register is read directly in RTL simulations, see _backdoor_read.
+    async def read_reg(self, reg, backdoor=False):
+        return await self._read(8, reg, backdoor)
 
     # Write a value to a byte register in your design
     # reg is the address of the register in the range 0-15
     # value is the value to be written, in the range 0-255
     # If sync is false this function will return before the store is completed.
-    async def write_byte_reg(self, reg, value, sync=True):
-        await self.write_reg(reg, value, sync)
+    async def write_byte_reg(self, reg, value, sync=True, backdoor=False):
+        await self.write_reg(reg, value, sync, backdoor)
 
     # Read the value of a byte register from your design
     # reg is the address of the register in the range 0-15
     # The returned value is the data read from the register, in the range 0-255
-    async def read_byte_reg(self, reg):
-        return await self.read_reg(reg)
+    async def read_byte_reg(self, reg, backdoor=False):
+        return await self.read_reg(reg, backdoor)
 
     # Write a value to a half word register in your design
     # reg is the address of the register in the range 0-15
     # value is the value to be written, in the range 0-65535
     # If sync is false this function will return before the store is completed.
-    async def write_hword_reg(self, reg, value, sync=True):
-        await test_util.stop_nops()
-        # Prepare value for LUI + ADDI
-        value_upper = (value + 0x800) >> 12
-        value_lower = value & 0xfff
-        if value_lower >= 0x800:
-            value_lower -= 0x1000
-
-        await test_util.send_instr(self.dut, InstructionLUI(a1, value_upper).encode())
-        await test_util.send_instr(self.dut, InstructionADDI(a1, a1, value_lower).encode())
-        await test_util.send_instr(self.dut, InstructionSH(tp, a1, self.base_address + reg).encode())
-
-        if sync:
-            # Read a register in order to ensure the store is complete before returning
-            assert await test_util.read_reg(self.dut, a1) == value
-
-        await test_util.start_nops(self.dut)
+    async def write_hword_reg(self, reg, value, sync=True, backdoor=False):
+        await self._write(16, reg, value, sync, backdoor)
 
     # Read the value of a half word register from your design
     # reg is the address of the register in the range 0-15
     # The returned value is the data read from the register, in the range 0-65535
-    async def read_hword_reg(self, reg):
-        await test_util.stop_nops()
-        await test_util.send_instr(self.dut, InstructionLHU(a1, tp, self.base_address + reg).encode())
-        val = await test_util.read_reg(self.dut, a1, True)
-        await test_util.start_nops(self.dut)
-        return val
+    async def read_hword_reg(self, reg, backdoor=False):
+        return await self._read(16, reg, backdoor)
 
     # Write a value to a word register in your design
     # reg is the address of the register in the range 0-15
     # value is the value to be written
     # If sync is false this function will return before the store is completed.
-    async def write_word_reg(self, reg, value, sync=True):
-        await test_util.stop_nops()
+    async def write_word_reg(self, reg, value, sync=True, backdoor=False):
+        await self._write(32, reg, value, sync, backdoor)
 
-        # Prepare value for LUI + ADDI
-        value_upper = ((value + 0x800) >> 12) & 0xfffff
-        value_lower = value & 0xfff
-        if value_lower >= 0x800:
-            value_lower -= 0x1000
+    # Read the value of a word register from your design
+    # reg is the address of the register in the range 0-15
+    # The returned value is the data read from the register
+    async def read_word_reg(self, reg, backdoor=False):
+        return await self._read(32, reg, backdoor)
 
-        await test_util.send_instr(self.dut, InstructionLUI(a1, value_upper).encode())
-        await test_util.send_instr(self.dut, InstructionADDI(a1, a1, value_lower).encode())
-        await test_util.send_instr(self.dut, InstructionSW(tp, a1, self.base_address + reg).encode())
+    # Perform a batch of register accesses as a single instruction stream.
+    # ops is a list of (width, reg, value) tuples, where width is 8, 16 or 32.
+    # A value of None reads the register, any other value is written to it.
+    # The NOP loop is only stopped once for the whole batch, and writes are not
+    # individually synced - if sync is true a single readback at the end of the
+    # batch ensures all the stores have completed.
+    # Returns a list with one entry per op, in order: the value read for reads
+    # and None for writes.
+    # If backdoor is true the accesses are made directly in RTL simulations.
+    async def access_regs(self, ops, sync=True, backdoor=False):
+        await self.flush()
+        async with self.harness.lock:
+            return await self._access_regs(ops, sync, backdoor)
 
-        if sync:
-            # Read a register in order to ensure the store is complete before returning
-            assert await test_util.read_reg(self.dut, a1) == value
+    async def _access_regs(self, ops, sync, backdoor):
+        results = []
+        if backdoor and self.backdoor_available:
+            for width, reg, value in ops:
+                assert width in (8, 16, 32)
+                if value is None:
+                    results.append(await self._backdoor_read(width, reg))
+                else:
+                    await self._backdoor_write(width, reg, value)
+                    results.append(None)
+            return results
 
-        await test_util.start_nops(self.dut)
+        await test_util.stop_nops(self.dut)
 
-    # Read the value of a word register from your design
-    # reg is the address of the register in the range 0-15
-    # The returned value is the data read from the register
-    async def read_word_reg(self, reg):
-        await test_util.stop_nops()
-        await test_util.send_instr(self.dut, InstructionLW(a1, tp, self.base_address + reg).encode())
-        val = await test_util.read_reg(self.dut, a1, True)
-        await test_util.start_nops(self.dut)
-        return val
+        last_write = None
+        for width, reg, value in ops:
+            assert width in (8, 16, 32)
+            if value is None:
+                results.append(await self._send_read(width, reg))
+                last_write = None
+            else:
+                src = await self._send_write(width, reg, value)
+                results.append(None)
+                last_write = value
+
+        if sync and last_write is not None:
+            # Stores complete in order, so one fence after the last
+            # ensures the whole batch is complete.
+            await self._fence(src, last_write)
+        else:
+            await test_util.start_nops(self.dut)
+        return results
+
+    # Write a list of (width, reg, value) tuples as one batch, see access_regs.
+    async def write_regs(self, writes, sync=True, backdoor=False):
+        await self.access_regs(writes, sync, backdoor)
+
+    # Read a list of (width, reg) tuples as one batch, see access_regs.
+    # Returns the values read, in order.
+    async def read_regs(self, reads, backdoor=False):
+        return await self.access_regs([(width, reg, None) for width, reg in reads], backdoor=backdoor)
+
+    # Record a sequence of register accesses to run on the core at full speed
+    # from the simulated flash, see tqv_program.Program:
+    #   async with tqv.program() as prog:
+    #       prog.write_byte_reg(0, 0x12)
+    #       result = prog.read_word_reg(4)
+    #   value = result.value
+    def program(self):
+        return Program(self.dut, self.base_address, self.flush)
+
+    # Wait until (reg & mask) == value, with the core polling the register on its own
+    # for at least timeout clock cycles, see Program.wait_for_reg.
+    # Returns (matched, cycles): whether the condition was met before the timeout, and
+    # the cycles the core spent running the poll loop, including a few to set it up.
+    async def wait_for_reg(self, reg, mask, value, timeout, width=8):
+        async with self.program() as prog:
+            result = prog.wait_for_reg(reg, mask, value, timeout, width)
+        return result.matched, prog.cycles
+
+    # Write each value in data to the register at reg in turn, width is 8, 16 or 32,
+    # with at least min_gap_cycles between writes.  The data is placed in the
+    # simulated PSRAM and copied to the register by the core, see Program.write_stream.
+    async def write_stream(self, reg, data, width=8, min_gap_cycles=0):
+        chunk = test_util.SIM_RAM_SIZE // (width // 8)
+        for i in range(0, len(data), chunk):
+            async with self.program() as prog:
+                prog.write_stream(reg, data[i:i + chunk], width, min_gap_cycles)
+
+    # Record the current time as the stimulus that interrupt latency is measured
+    # from.  Register writes do this automatically, call it when a test provides
+    # the stimulus itself, for example by changing an input.
+    def mark_stimulus(self):
+        self.stimulus_time = get_sim_time()
+
+    def _interrupt_level(self):
+        # peri_interrupts is [15:2]
+        return self.harness.handles.peri_interrupts.value.binstr[15 - self.peripheral_num] == "1"
+
+    # Records the time of each rising edge of the interrupt in RTL
+    async def _watch_interrupt(self):
+        irq_edge = Edge(self.harness.handles.peri_interrupts)
+        level = self._interrupt_level()
+        while True:
+            await irq_edge
+            new_level = self._interrupt_level()
+            if new_level and not level:
+                self.interrupt_time = get_sim_time()
+            level = new_level
+
+    # Wait up to timeout_cycles for the user interrupt to be asserted.
+    # Returns the latency in clock cycles from the last stimulus (see mark_stimulus)
+    # to the interrupt, 0 if it was already asserted at the stimulus, or None if it
+    # wasn't asserted before the timeout.
+    # In RTL this waits on the peripheral's interrupt line, in gate level simulations
+    # the core polls mip, so the latency includes the time for the core to see it.
+    async def wait_interrupt(self, timeout_cycles):
+        await self.flush()
+        if self.rtl_interrupt:
+            if self._interrupt_level():
+                irq_time = self.interrupt_time if self.interrupt_time is not None else get_sim_time()
+            else:
+                irq_edge = Edge(self.harness.handles.peri_interrupts)
+                timeout = Timer(timeout_cycles * self.dut._clk_period, "step")
+                while not self._interrupt_level():
+                    if await First(irq_edge, timeout) is timeout:
+                        return None
+                irq_time = get_sim_time()
+        else:
+            mask = 1 << (16 + self.peripheral_num)
+            async with self.program() as prog:
+                result = prog.wait_for_csr(csrnames.mip, mask, mask, timeout_cycles)
+            if not result.matched:
+                return None
+            irq_time = get_sim_time()
+        return max(0, irq_time - self.stimulus_time) // self.dut._clk_period
 
     # Check whether the user interrupt is asserted
     async def is_interrupt_asserted(self):
-        await test_util.stop_nops()
-        await test_util.send_instr(self.dut, InstructionCSRRS(a1, x0, csrnames.mip).encode())
-        val = await test_util.read_reg(self.dut, a1)
-        await test_util.start_nops(self.dut)
+        await self.flush()
+        async with self.harness.lock:
+            await test_util.stop_nops(self.dut)
+            await test_util.send_instr(self.dut, encode(InstructionCSRRS, a1, x0, csrnames.mip))
+            self.harness.consts.invalidate(a1)
+            val = await test_util.read_reg(self.dut, a1)
+            await test_util.start_nops(self.dut)
         return (val & (1 << (16 + self.peripheral_num))) != 0
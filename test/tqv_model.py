@@ -0,0 +1,916 @@
+# SPDX-FileCopyrightText: © 2025 Tiny Tapeout
+# SPDX-License-Identifier: Apache-2.0
+
+# Instruction set simulator for TinyQV, the reference model for the tests.
+#
+# It implements RV32E, the C extension, Zcb, Zicond (czero) and TinyQV's own
+# instructions: mul16 and c.mul16, c.lwtp and c.swtp, the multi-word lw2, lw4, sw2
+# and sw4, and the interrupt context save and restore.  The encodings of the custom
+# instructions follow the firmware images in this directory, which all run on the
+# model.  The CSRs the core exposes are modelled, as are the core's quirks:
+# gp and tp are hardwired, addresses are 28 bits and program addresses 24 bits.
+#
+# Instructions are decoded from the tables below once and cached, by address for
+# code run from flash and by encoding for instructions executed directly, so each
+# instruction executed is a dict lookup and a call.  Registers are an array, and
+# memory is allocated in pages as it is written, like QspiMemory.
+#
+#   model = TinyQVModel()
+#   model.write(0, program)
+#   model.run(10000)
+#
+# or, executing the instructions the harness sends to the core:
+#
+#   model.execute(InstructionADDI(a0, a0, 1).encode())
+#   assert model.regs[a0] == ...
+#
+# The model has no notion of clock cycles.  The cycle CSR counts instructions
+# executed, and time only changes when advance_time is called, MTIME is written or
+# the core waits for the timer in a "j ." loop.
+
+from array import array
+
+PAGE_BITS = 12
+PAGE_SIZE = 1 << PAGE_BITS
+
+ADDR_MASK = 0xFFFFFFF
+PC_MASK = 0xFFFFFF
+RAM_A_ADDR = 0x1000000
+IO_ADDR = 0x8000000
+UART_TX_ADDR = 0x8000080
+MTIME_ADDR = 0xFFFFF00
+MTIMECMP_ADDR = 0xFFFFF04
+
+GP_VALUE = 0x1000400
+CONTEXT_OFFSET = -0x200
+TP_VALUE = 0x8000000
+
+# Writes to x0, gp and tp go to this extra register, which is never read
+SINK = 16
+
+# Exceptions trap to EXCEPTION_ADDR and interrupts to INTERRUPT_ADDR
+EXCEPTION_ADDR = 0x4
+INTERRUPT_ADDR = 0x8
+
+CAUSE_ILLEGAL_INSTRUCTION = 2
+CAUSE_BREAKPOINT = 3
+CAUSE_ECALL = 11
+CAUSE_INTERRUPT = 0x80000000
+
+MSTATUS = 0x300
+MIE = 0x304
+MEPC = 0x341
+MCAUSE = 0x342
+MIP = 0x344
+CYCLE = 0xC00
+TIME = 0xC01
+INSTRET = 0xC02
+
+# mstatus bit 2 always reads as 1, MIE (bit 3) is set at reset
+MSTATUS_FIXED = 0x4
+MSTATUS_MIE = 0x8
+MSTATUS_MPIE = 0x80
+MSTATUS_RESET = MSTATUS_FIXED | MSTATUS_MIE
+
+# The timer interrupt is bit 7 of mie and mip, peripheral interrupts are bits 16 and up
+TIMER_IRQ = 7
+UART_TX_IRQ = 19
+MIE_MASK = 0xFFFF0080
+
+M = 0xFFFFFFFF
+
+class IllegalInstruction(Exception):
+    pass
+
+def _signed(value, bits=32):
+    sign = 1 << (bits - 1)
+    return (value & (sign - 1)) - (value & sign)
+
+### Instruction handlers ###
+# Each is called as handler(model, a, b, c) with the operands from decoding.
+# Register results are written to regs[rd], where rd is SINK for x0, gp and tp,
+# branches and jumps set model.next_pc.
+
+def _add(m, rd, rs1, rs2):
+    r = m.regs
+    r[rd] = (r[rs1] + r[rs2]) & M
+
+def _sub(m, rd, rs1, rs2):
+    r = m.regs
+    r[rd] = (r[rs1] - r[rs2]) & M
+
+def _sll(m, rd, rs1, rs2):
+    r = m.regs
+    r[rd] = (r[rs1] << (r[rs2] & 31)) & M
+
+def _slt(m, rd, rs1, rs2):
+    r = m.regs
+    r[rd] = 1 if _signed(r[rs1]) < _signed(r[rs2]) else 0
+
+def _sltu(m, rd, rs1, rs2):
+    r = m.regs
+    r[rd] = 1 if r[rs1] < r[rs2] else 0
+
+def _xor(m, rd, rs1, rs2):
+    r = m.regs
+    r[rd] = r[rs1] ^ r[rs2]
+
+def _srl(m, rd, rs1, rs2):
+    r = m.regs
+    r[rd] = r[rs1] >> (r[rs2] & 31)
+
+def _sra(m, rd, rs1, rs2):
+    r = m.regs
+    r[rd] = (_signed(r[rs1]) >> (r[rs2] & 31)) & M
+
+def _or(m, rd, rs1, rs2):
+    r = m.regs
+    r[rd] = r[rs1] | r[rs2]
+
+def _and(m, rd, rs1, rs2):
+    r = m.regs
+    r[rd] = r[rs1] & r[rs2]
+
+def _czero_eqz(m, rd, rs1, rs2):
+    r = m.regs
+    r[rd] = r[rs1] if r[rs2] != 0 else 0
+
+def _czero_nez(m, rd, rs1, rs2):
+    r = m.regs
+    r[rd] = r[rs1] if r[rs2] == 0 else 0
+
+def _mul16(m, rd, rs1, rs2):
+    r = m.regs
+    r[rd] = (r[rs1] * (r[rs2] & 0xFFFF)) & M
+
+def _addi(m, rd, rs1, imm):
+    r = m.regs
+    r[rd] = (r[rs1] + imm) & M
+
+def _slti(m, rd, rs1, imm):
+    r = m.regs
+    r[rd] = 1 if _signed(r[rs1]) < imm else 0
+
+def _sltiu(m, rd, rs1, imm):
+    r = m.regs
+    r[rd] = 1 if r[rs1] < (imm & M) else 0
+
+def _xori(m, rd, rs1, imm):
+    r = m.regs
+    r[rd] = (r[rs1] ^ imm) & M
+
+def _ori(m, rd, rs1, imm):
+    r = m.regs
+    r[rd] = (r[rs1] | imm) & M
+
+def _andi(m, rd, rs1, imm):
+    r = m.regs
+    r[rd] = r[rs1] & imm & M
+
+def _slli(m, rd, rs1, shamt):
+    r = m.regs
+    r[rd] = (r[rs1] << shamt) & M
+
+def _srli(m, rd, rs1, shamt):
+    r = m.regs
+    r[rd] = r[rs1] >> shamt
+
+def _srai(m, rd, rs1, shamt):
+    r = m.regs
+    r[rd] = (_signed(r[rs1]) >> shamt) & M
+
+def _sext_b(m, rd, rs1, _):
+    r = m.regs
+    r[rd] = _signed(r[rs1], 8) & M
+
+def _sext_h(m, rd, rs1, _):
+    r = m.regs
+    r[rd] = _signed(r[rs1], 16) & M
+
+def _lui(m, rd, value, _):
+    m.regs[rd] = value
+
+def _auipc(m, rd, value, _):
+    m.regs[rd] = (m.pc + value) & M
+
+def _lb(m, rd, rs1, imm):
+    m.regs[rd] = _signed(m.load((m.regs[rs1] + imm) & ADDR_MASK, 1), 8) & M
+
+def _lh(m, rd, rs1, imm):
+    m.regs[rd] = _signed(m.load((m.regs[rs1] + imm) & ADDR_MASK, 2), 16) & M
+
+def _lw(m, rd, rs1, imm):
+    m.regs[rd] = m.load((m.regs[rs1] + imm) & ADDR_MASK, 4)
+
+def _lbu(m, rd, rs1, imm):
+    m.regs[rd] = m.load((m.regs[rs1] + imm) & ADDR_MASK, 1)
+
+def _lhu(m, rd, rs1, imm):
+    m.regs[rd] = m.load((m.regs[rs1] + imm) & ADDR_MASK, 2)
+
+def _sb(m, rs1, rs2, imm):
+    m.store((m.regs[rs1] + imm) & ADDR_MASK, 1, m.regs[rs2] & 0xFF)
+
+def _sh(m, rs1, rs2, imm):
+    m.store((m.regs[rs1] + imm) & ADDR_MASK, 2, m.regs[rs2] & 0xFFFF)
+
+def _sw(m, rs1, rs2, imm):
+    m.store((m.regs[rs1] + imm) & ADDR_MASK, 4, m.regs[rs2])
+
+# Load rd and the registers after it from consecutive words
+def _load_multi(m, rd, rs1, imm, count):
+    addr = m.regs[rs1] + imm
+    for i in range(count):
+        value = m.load((addr + i * 4) & ADDR_MASK, 4)
+        m.regs[_dest((rd + i) & 15)] = value
+
+def _lw2(m, rd, rs1, imm):
+    _load_multi(m, rd, rs1, imm, 2)
+
+def _lw4(m, rd, rs1, imm):
+    _load_multi(m, rd, rs1, imm, 4)
+
+# Store rs2 and the registers after it to consecutive words
+def _store_multi(m, rs1, rs2, imm, count):
+    addr = m.regs[rs1] + imm
+    for i in range(count):
+        m.store((addr + i * 4) & ADDR_MASK, 4, m.regs[(rs2 + i) & 15])
+
+def _sw2(m, rs1, rs2, imm):
+    _store_multi(m, rs1, rs2, imm, 2)
+
+def _sw4(m, rs1, rs2, imm):
+    _store_multi(m, rs1, rs2, imm, 4)
+
+# Store rs2 to four consecutive words, used with x0 to clear memory
+def _sw4_same(m, rs1, rs2, imm):
+    addr = m.regs[rs1] + imm
+    value = m.regs[rs2]
+    for i in range(4):
+        m.store((addr + i * 4) & ADDR_MASK, 4, value)
+
+# The interrupt handlers' context save and restore.  c.scxt stores s1 and the
+# registers after it to the context area at gp - 0x200, and c.lcxt loads them back.
+# The register field gives the last register less one, so the handlers that only
+# use s1 and a0 save two registers, and a full restore also loads a2-a5, which the
+# handler saves after them with sw4.
+def _scxt(m, count, b, c):
+    _store_multi(m, 3, 9, CONTEXT_OFFSET, count)
+
+def _lcxt(m, count, b, c):
+    _load_multi(m, 9, 3, CONTEXT_OFFSET, count)
+
+def _beq(m, rs1, rs2, imm):
+    if m.regs[rs1] == m.regs[rs2]:
+        m.next_pc = m.pc + imm
+
+def _bne(m, rs1, rs2, imm):
+    if m.regs[rs1] != m.regs[rs2]:
+        m.next_pc = m.pc + imm
+
+def _blt(m, rs1, rs2, imm):
+    if _signed(m.regs[rs1]) < _signed(m.regs[rs2]):
+        m.next_pc = m.pc + imm
+
+def _bge(m, rs1, rs2, imm):
+    if _signed(m.regs[rs1]) >= _signed(m.regs[rs2]):
+        m.next_pc = m.pc + imm
+
+def _bltu(m, rs1, rs2, imm):
+    if m.regs[rs1] < m.regs[rs2]:
+        m.next_pc = m.pc + imm
+
+def _bgeu(m, rs1, rs2, imm):
+    if m.regs[rs1] >= m.regs[rs2]:
+        m.next_pc = m.pc + imm
+
+def _jal(m, rd, imm, _):
+    m.regs[rd] = m.next_pc & PC_MASK
+    m.next_pc = m.pc + imm
+
+def _jalr(m, rd, rs1, imm):
+    target = (m.regs[rs1] + imm) & ~1
+    m.regs[rd] = m.next_pc & PC_MASK
+    m.next_pc = target
+
+def _csrrw(m, rd, rs1, csr):
+    value = m.regs[rs1]
+    if rd != SINK:
+        m.regs[rd] = m.read_csr(csr)
+    m.write_csr(csr, value)
+
+def _csrrs(m, rd, rs1, csr):
+    value = m.read_csr(csr)
+    m.regs[rd] = value
+    if rs1 != 0:
+        m.write_csr(csr, value | m.regs[rs1])
+
+def _csrrc(m, rd, rs1, csr):
+    value = m.read_csr(csr)
+    m.regs[rd] = value
+    if rs1 != 0:
+        m.write_csr(csr, value & ~m.regs[rs1])
+
+def _csrrwi(m, rd, uimm, csr):
+    if rd != SINK:
+        m.regs[rd] = m.read_csr(csr)
+    m.write_csr(csr, uimm)
+
+def _csrrsi(m, rd, uimm, csr):
+    value = m.read_csr(csr)
+    m.regs[rd] = value
+    if uimm != 0:
+        m.write_csr(csr, value | uimm)
+
+def _csrrci(m, rd, uimm, csr):
+    value = m.read_csr(csr)
+    m.regs[rd] = value
+    if uimm != 0:
+        m.write_csr(csr, value & ~uimm)
+
+def _nop(m, a, b, c):
+    pass
+
+def _ecall(m, a, b, c):
+    m.trap(CAUSE_ECALL)
+
+def _ebreak(m, a, b, c):
+    m.trap(CAUSE_BREAKPOINT)
+
+def _mret(m, a, b, c):
+    mstatus = m.mstatus
+    m.mstatus = MSTATUS_FIXED | MSTATUS_MPIE | (MSTATUS_MIE if mstatus & MSTATUS_MPIE else 0)
+    m.next_pc = m.mepc
+    m._update_irq()
+
+def _illegal(m, a, b, c):
+    m.trap(CAUSE_ILLEGAL_INSTRUCTION)
+
+### Decode tables ###
+
+# Operand formats of the 32-bit instructions, each returns (a, b, c) for the handler
+def _dest(rd):
+    return SINK if rd in (0, 3, 4) else rd
+
+def _fmt_r(w):
+    return _dest((w >> 7) & 31), (w >> 15) & 31, (w >> 20) & 31
+
+def _fmt_i(w):
+    return _dest((w >> 7) & 31), (w >> 15) & 31, _signed(w >> 20, 12)
+
+# lw2 and lw4 write rd and the registers after it, so keep rd as it is
+def _fmt_multi(w):
+    return (w >> 7) & 31, (w >> 15) & 31, _signed(w >> 20, 12)
+
+def _fmt_shift(w):
+    return _dest((w >> 7) & 31), (w >> 15) & 31, (w >> 20) & 31
+
+def _fmt_s(w):
+    return (w >> 15) & 31, (w >> 20) & 31, _signed(((w >> 20) & 0xFE0) | ((w >> 7) & 31), 12)
+
+def _fmt_b(w):
+    imm = ((w >> 19) & 0x1000) | ((w << 4) & 0x800) | ((w >> 20) & 0x7E0) | ((w >> 7) & 0x1E)
+    return (w >> 15) & 31, (w >> 20) & 31, _signed(imm, 13)
+
+def _fmt_u(w):
+    return _dest((w >> 7) & 31), w & 0xFFFFF000, 0
+
+def _fmt_j(w):
+    imm = (w & 0xFF000) | ((w >> 9) & 0x800) | ((w >> 20) & 0x7FE) | ((w >> 11) & 0x100000)
+    return _dest((w >> 7) & 31), _signed(imm, 21), 0
+
+def _fmt_csr(w):
+    return _dest((w >> 7) & 31), (w >> 15) & 31, w >> 20
+
+def _fmt_none(w):
+    return 0, 0, 0
+
+# (opcode, funct3, funct7) -> (handler, format).  funct3 or funct7 of None matches any
+# value, a key of the whole instruction is looked up first for the system instructions.
+_TABLE32 = {
+    (0x33, 0, 0x00): (_add, _fmt_r),
+    (0x33, 0, 0x20): (_sub, _fmt_r),
+    (0x33, 1, 0x00): (_sll, _fmt_r),
+    (0x33, 2, 0x00): (_slt, _fmt_r),
+    (0x33, 3, 0x00): (_sltu, _fmt_r),
+    (0x33, 4, 0x00): (_xor, _fmt_r),
+    (0x33, 5, 0x00): (_srl, _fmt_r),
+    (0x33, 5, 0x20): (_sra, _fmt_r),
+    (0x33, 6, 0x00): (_or, _fmt_r),
+    (0x33, 7, 0x00): (_and, _fmt_r),
+    (0x33, 5, 0x07): (_czero_eqz, _fmt_r),
+    (0x33, 7, 0x07): (_czero_nez, _fmt_r),
+    (0x33, 0, 0x02): (_mul16, _fmt_r),
+    (0x13, 0, None): (_addi, _fmt_i),
+    (0x13, 2, None): (_slti, _fmt_i),
+    (0x13, 3, None): (_sltiu, _fmt_i),
+    (0x13, 4, None): (_xori, _fmt_i),
+    (0x13, 6, None): (_ori, _fmt_i),
+    (0x13, 7, None): (_andi, _fmt_i),
+    (0x13, 1, 0x00): (_slli, _fmt_shift),
+    (0x13, 5, 0x00): (_srli, _fmt_shift),
+    (0x13, 5, 0x20): (_srai, _fmt_shift),
+    (0x03, 0, None): (_lb, _fmt_i),
+    (0x03, 1, None): (_lh, _fmt_i),
+    (0x03, 2, None): (_lw, _fmt_i),
+    (0x03, 4, None): (_lbu, _fmt_i),
+    (0x03, 5, None): (_lhu, _fmt_i),
+    (0x03, 3, None): (_lw2, _fmt_multi),
+    (0x03, 7, None): (_lw4, _fmt_multi),
+    (0x23, 0, None): (_sb, _fmt_s),
+    (0x23, 1, None): (_sh, _fmt_s),
+    (0x23, 2, None): (_sw, _fmt_s),
+    (0x23, 3, None): (_sw2, _fmt_s),
+    (0x23, 6, None): (_sw4_same, _fmt_s),
+    (0x23, 7, None): (_sw4, _fmt_s),
+    (0x63, 0, None): (_beq, _fmt_b),
+    (0x63, 1, None): (_bne, _fmt_b),
+    (0x63, 4, None): (_blt, _fmt_b),
+    (0x63, 5, None): (_bge, _fmt_b),
+    (0x63, 6, None): (_bltu, _fmt_b),
+    (0x63, 7, None): (_bgeu, _fmt_b),
+    (0x37, None, None): (_lui, _fmt_u),
+    (0x17, None, None): (_auipc, _fmt_u),
+    (0x6F, None, None): (_jal, _fmt_j),
+    (0x67, 0, None): (_jalr, _fmt_i),
+    (0x0F, None, None): (_nop, _fmt_none),
+    (0x73, 1, None): (_csrrw, _fmt_csr),
+    (0x73, 2, None): (_csrrs, _fmt_csr),
+    (0x73, 3, None): (_csrrc, _fmt_csr),
+    (0x73, 5, None): (_csrrwi, _fmt_csr),
+    (0x73, 6, None): (_csrrsi, _fmt_csr),
+    (0x73, 7, None): (_csrrci, _fmt_csr),
+    0x00000073: (_ecall, _fmt_none),
+    0x00100073: (_ebreak, _fmt_none),
+    0x30200073: (_mret, _fmt_none),
+    0x10500073: (_nop, _fmt_none),     # wfi
+}
+
+def _decode32(w):
+    entry = _TABLE32.get(w)
+    if entry is None:
+        opcode, funct3, funct7 = w & 0x7F, (w >> 12) & 7, w >> 25
+        entry = (_TABLE32.get((opcode, funct3, funct7)) or _TABLE32.get((opcode, funct3, None)) or
+                 _TABLE32.get((opcode, None, None)))
+    if entry is None:
+        raise IllegalInstruction
+    handler, fmt = entry
+
+    # RV32E only has 16 registers
+    if fmt in (_fmt_r, _fmt_i, _fmt_multi, _fmt_shift, _fmt_u, _fmt_j, _fmt_csr) and (w >> 7) & 16:
+        raise IllegalInstruction
+    if fmt in (_fmt_r, _fmt_i, _fmt_multi, _fmt_shift, _fmt_s, _fmt_b) and (w >> 15) & 16:
+        raise IllegalInstruction
+    if fmt in (_fmt_r, _fmt_s, _fmt_b) and (w >> 20) & 16:
+        raise IllegalInstruction
+    # The register forms of the CSR instructions, the others take an immediate there
+    if fmt is _fmt_csr and (w >> 12) & 4 == 0 and (w >> 15) & 16:
+        raise IllegalInstruction
+    return (handler, *fmt(w))
+
+# The compressed instructions expand to the handlers above, by quadrant and funct3
+def _ci_imm(h):
+    return _signed(((h >> 7) & 0x20) | ((h >> 2) & 0x1F), 6)
+
+def _cj_imm(h):
+    imm = (((h >> 1) & 0x800) | ((h >> 7) & 0x10) | ((h >> 1) & 0x300) | ((h << 2) & 0x400) |
+           ((h >> 1) & 0x40) | ((h << 1) & 0x80) | ((h >> 2) & 0xE) | ((h << 3) & 0x20))
+    return _signed(imm, 12)
+
+def _cb_imm(h):
+    imm = (((h >> 4) & 0x100) | ((h >> 7) & 0x18) | ((h << 1) & 0xC0) | ((h >> 2) & 6) | ((h << 3) & 0x20))
+    return _signed(imm, 9)
+
+def _cl_imm(h):
+    return ((h >> 7) & 0x38) | ((h >> 4) & 4) | ((h << 1) & 0x40)
+
+def _c0(h, rd_, rs1_):
+    funct3 = h >> 13
+    if funct3 == 0:
+        imm = ((h >> 7) & 0x30) | ((h >> 1) & 0x3C0) | ((h >> 4) & 4) | ((h >> 2) & 8)
+        if imm == 0:
+            raise IllegalInstruction
+        return _addi, rd_, 2, imm
+    if funct3 == 2:
+        return _lw, rd_, rs1_, _cl_imm(h)
+    if funct3 == 6:
+        return _sw, rs1_, rd_, _cl_imm(h)
+    if funct3 == 4:
+        # Zcb loads and stores
+        funct6 = h >> 10
+        uimm_b = ((h >> 6) & 1) | ((h >> 4) & 2)
+        uimm_h = (h >> 4) & 2
+        if funct6 == 0x20:
+            return _lbu, rd_, rs1_, uimm_b
+        if funct6 == 0x21:
+            return (_lh if h & 0x40 else _lhu), rd_, rs1_, uimm_h
+        if funct6 == 0x22:
+            return _sb, rs1_, rd_, uimm_b
+        if funct6 == 0x23 and not h & 0x40:
+            return _sh, rs1_, rd_, uimm_h
+    if h & 0xFFE3 == 0xF020 and rd_ >= 9:
+        return _scxt, rd_ - 7, 0, 0
+    raise IllegalInstruction
+
+_CA_OPS = (_sub, _xor, _or, _and)
+_CU_OPS = {0: (_andi, 0xFF), 1: (_sext_b, 0), 2: (_andi, 0xFFFF), 3: (_sext_h, 0), 5: (_xori, -1)}
+
+def _c1(h, rd_, rs1_):
+    funct3 = h >> 13
+    rd = (h >> 7) & 31
+    if funct3 in (0, 2, 3) and rd & 16:
+        raise IllegalInstruction
+    if funct3 == 0:
+        return _addi, _dest(rd), rd, _ci_imm(h)
+    if funct3 == 1:
+        return _jal, 1, _cj_imm(h), 0
+    if funct3 == 2:
+        return _addi, _dest(rd), 0, _ci_imm(h)
+    if funct3 == 3:
+        if rd == 2:
+            imm = (((h >> 3) & 0x200) | ((h >> 2) & 0x10) | ((h << 1) & 0x40) | ((h << 4) & 0x180) |
+                   ((h << 3) & 0x20))
+            return _addi, 2, 2, _signed(imm, 10)
+        return _lui, _dest(rd), (_ci_imm(h) << 12) & M, 0
+    if funct3 == 4:
+        funct2 = (h >> 10) & 3
+        if funct2 == 0 and not h & 0x1000:
+            return _srli, rs1_, rs1_, (h >> 2) & 0x1F
+        if funct2 == 1 and not h & 0x1000:
+            return _srai, rs1_, rs1_, (h >> 2) & 0x1F
+        if funct2 == 2:
+            return _andi, rs1_, rs1_, _ci_imm(h)
+        if funct2 == 3 and not h & 0x1000:
+            return _CA_OPS[(h >> 5) & 3], rs1_, rs1_, rd_
+        if funct2 == 3 and (h >> 5) & 3 == 3 and (h >> 2) & 7 in _CU_OPS:
+            handler, imm = _CU_OPS[(h >> 2) & 7]
+            return handler, rs1_, rs1_, imm
+        raise IllegalInstruction
+    if funct3 == 5:
+        return _jal, SINK, _cj_imm(h), 0
+    return (_beq if funct3 == 6 else _bne), rs1_, 0, _cb_imm(h)
+
+def _c2(h, rd_, rs1_):
+    funct3 = h >> 13
+    rd = (h >> 7) & 31
+    rs2 = (h >> 2) & 31
+    if (funct3 < 6 and rd & 16) or (funct3 >= 4 and rs2 & 16):
+        raise IllegalInstruction
+    if funct3 == 0 and not h & 0x1000:
+        return _slli, _dest(rd), rd, rs2
+    if h & 0xF07F == 0x3002 and 9 <= rd <= 14:
+        return _lcxt, rd - 7, 0, 0
+    # c.lwsp and c.swsp, and TinyQV's c.lwtp and c.swtp, the same relative to tp
+    if funct3 in (2, 3) and rd != 0:
+        return _lw, _dest(rd), (2 if funct3 == 2 else 4), ((h >> 7) & 0x20) | ((h >> 2) & 0x1C) | ((h << 4) & 0xC0)
+    if funct3 == 4:
+        if not h & 0x1000:
+            if rs2 == 0 and rd != 0:
+                return _jalr, SINK, rd, 0
+            return _add, _dest(rd), 0, rs2
+        if rs2 == 0:
+            if rd == 0:
+                return _ebreak, 0, 0, 0
+            return _jalr, 1, rd, 0
+        return _add, _dest(rd), rd, rs2
+    if funct3 == 5:
+        return _mul16, _dest(rd), rd, rs2
+    if funct3 >= 6:
+        return _sw, (2 if funct3 == 6 else 4), rs2, ((h >> 7) & 0x3C) | ((h >> 1) & 0xC0)
+    raise IllegalInstruction
+
+_TABLE16 = (_c0, _c1, _c2)
+
+def _decode16(h):
+    return _TABLE16[h & 3](h, ((h >> 2) & 7) + 8, ((h >> 7) & 7) + 8)
+
+# Returns (handler, a, b, c, size) for the instruction, or the illegal instruction
+# handler if it isn't one TinyQV implements.
+def decode(instr):
+    try:
+        if instr & 3 == 3:
+            return (*_decode32(instr & M), 4)
+        return (*_decode16(instr & 0xFFFF), 2)
+    except IllegalInstruction:
+        return (_illegal, 0, 0, 0, 4 if instr & 3 == 3 else 2)
+
+_NO_DEST = {_sb, _sh, _sw, _sw2, _sw4, _sw4_same, _scxt, _beq, _bne, _blt, _bge, _bltu, _bgeu,
+            _nop, _ecall, _ebreak, _mret, _illegal}
+
+# The registers the instruction writes, in the order the core writes them back.
+# x0, gp and tp are left out, the core has no storage for them.
+def written_regs(instr):
+    handler, a, _, _, _ = decode(instr)
+    if handler in _NO_DEST:
+        return ()
+    if handler is _lw2 or handler is _lw4:
+        regs = [(a + i) & 15 for i in range(2 if handler is _lw2 else 4)]
+    elif handler is _lcxt:
+        regs = range(9, 9 + a)
+    else:
+        regs = (a,)
+    return tuple(reg for reg in regs if reg not in (0, 3, 4, SINK))
+
+_LOADS = {_lb: 1, _lh: 2, _lw: 4, _lbu: 1, _lhu: 2}
+_STORES = {_sb: 1, _sh: 2, _sw: 4}
+
+# The memory access of a single load or store as (is_store, nbytes, base_reg, imm),
+# or None for any other instruction.  The address is regs[base_reg] + imm.
+def memory_access(instr):
+    handler, a, b, c, _ = decode(instr)
+    if handler in _LOADS:
+        return (False, _LOADS[handler], b, c)
+    if handler in _STORES:
+        return (True, _STORES[handler], a, c)
+    return None
+
+_ALU_R = {_add, _sub, _slt, _sltu, _xor, _or, _and, _czero_eqz, _czero_nez, _mul16}
+_ALU_I = {_addi, _slti, _sltiu, _xori, _ori, _andi}
+_SHIFT_R = {_sll, _srl, _sra}
+_SHIFT_I = {_slli, _srli, _srai}
+
+# The operands of an ALU instruction, load or store as (kind, sources, imm): kind is
+# "alu", "shift", "load" or "store", sources the registers it reads, the base register
+# first for loads and stores, and imm its immediate or shift amount, None if it has none.
+# Returns None for any other instruction.
+def operands(instr):
+    handler, a, b, c, _ = decode(instr)
+    if handler in _ALU_R:
+        return ("alu", (b, c), None)
+    if handler in _ALU_I:
+        return ("alu", (b,), c)
+    if handler is _sext_b or handler is _sext_h:
+        return ("alu", (b,), None)
+    if handler is _lui:
+        return ("alu", (), _signed(b))
+    if handler in _SHIFT_R:
+        return ("shift", (b, c), None)
+    if handler in _SHIFT_I:
+        return ("shift", (b,), c)
+    if handler in _LOADS:
+        return ("load", (b,), c)
+    if handler in _STORES:
+        return ("store", (a, b), c)
+    return None
+
+class TinyQVModel:
+
+    def __init__(self):
+        self.pages = {}
+        self.io = {}
+        self._icache = {}
+        self._ecache = {}
+        self.on_execute = None
+        self.reset()
+
+    # Reset the core, memory is kept
+    def reset(self):
+        self.regs = array("L", [0] * 17)
+        self.regs[3] = GP_VALUE
+        self.regs[4] = TP_VALUE
+        self.pc = 0
+        self.next_pc = 0
+        self.mstatus = MSTATUS_RESET
+        self.mie = 0
+        self.mepc = 0
+        self.mcause = 0
+        self.interrupts = 1 << UART_TX_IRQ
+        self.uart_tx = bytearray()
+        self.mtime = 0
+        self.mtimecmp = 0
+        self.instret = 0
+        self._irq = False
+
+    ### Memory ###
+
+    def _page(self, addr):
+        page = self.pages.get(addr >> PAGE_BITS)
+        if page is None:
+            page = self.pages[addr >> PAGE_BITS] = bytearray(PAGE_SIZE)
+        return page
+
+    # Write bytes to memory at addr, used to load programs and data
+    def write(self, addr, data):
+        data = memoryview(bytes(data))
+        if addr < RAM_A_ADDR:
+            self._icache.clear()
+        i = 0
+        while i < len(data):
+            offset = (addr + i) & (PAGE_SIZE - 1)
+            n = min(PAGE_SIZE - offset, len(data) - i)
+            self._page(addr + i)[offset:offset + n] = data[i:i + n]
+            i += n
+
+    # Read length bytes from addr, memory that has never been written reads as zero
+    def read(self, addr, length):
+        data = bytearray(length)
+        i = 0
+        while i < length:
+            offset = (addr + i) & (PAGE_SIZE - 1)
+            n = min(PAGE_SIZE - offset, length - i)
+            page = self.pages.get((addr + i) >> PAGE_BITS)
+            if page is not None:
+                data[i:i + n] = page[offset:offset + n]
+            i += n
+        return bytes(data)
+
+    # Load a hex file in the $readmemh format used for the simulated flash
+    def load_hex(self, filename, addr=0):
+        data = bytearray()
+        with open(filename) as f:
+            for line in f:
+                for word in line.split():
+                    if word.startswith("@"):
+                        self.write(addr, data)
+                        addr, data = int(word[1:], 16), bytearray()
+                    else:
+                        data.append(int(word, 16))
+        self.write(addr, data)
+
+    # Load and store as the core does, nbytes is 1, 2 or 4
+    def load(self, addr, nbytes):
+        if addr >= IO_ADDR:
+            return self.load_io(addr, nbytes)
+        offset = addr & (PAGE_SIZE - 1)
+        page = self.pages.get(addr >> PAGE_BITS)
+        if page is not None and offset + nbytes <= PAGE_SIZE:
+            return int.from_bytes(page[offset:offset + nbytes], "little")
+        return int.from_bytes(self.read(addr, nbytes), "little")
+
+    def store(self, addr, nbytes, value):
+        if addr >= IO_ADDR:
+            self.store_io(addr, nbytes, value)
+        elif addr >= RAM_A_ADDR:
+            offset = addr & (PAGE_SIZE - 1)
+            if offset + nbytes <= PAGE_SIZE:
+                self._page(addr)[offset:offset + nbytes] = value.to_bytes(nbytes, "little")
+            else:
+                self.write(addr, value.to_bytes(nbytes, "little"))
+
+    # Peripheral accesses.  Only the timer and UART transmit are modelled, other registers
+    # read back the last value written to them.  Override these to model other peripherals.
+    # The UART sends instantly, so it is never busy and its transmit interrupt is always
+    # raised, and the bytes sent are collected in uart_tx.
+    def load_io(self, addr, nbytes):
+        if addr == MTIME_ADDR:
+            return self.mtime
+        if addr == MTIMECMP_ADDR:
+            return self.mtimecmp
+        return self.io.get(addr, 0) & ((1 << (nbytes * 8)) - 1)
+
+    def store_io(self, addr, nbytes, value):
+        if addr == MTIME_ADDR:
+            self.mtime = value
+            self._update_irq()
+        elif addr == MTIMECMP_ADDR:
+            self.mtimecmp = value
+            self._update_irq()
+        else:
+            if addr == UART_TX_ADDR:
+                self.uart_tx.append(value & 0xFF)
+            self.io[addr] = value
+
+    ### CSRs and traps ###
+
+    def read_csr(self, csr):
+        if csr == MSTATUS:
+            return self.mstatus
+        if csr == MIE:
+            return self.mie
+        if csr == MIP:
+            return self.pending_interrupts()
+        if csr == MEPC:
+            return self.mepc
+        if csr == MCAUSE:
+            return self.mcause
+        if csr == CYCLE or csr == INSTRET:
+            return self.instret & M
+        if csr == TIME:
+            return self.mtime
+        raise IllegalInstruction
+
+    def write_csr(self, csr, value):
+        value &= M
+        if csr == MSTATUS:
+            self.mstatus = MSTATUS_FIXED | (value & (MSTATUS_MIE | MSTATUS_MPIE))
+        elif csr == MIE:
+            self.mie = value & MIE_MASK
+        elif csr == MEPC:
+            self.mepc = value & PC_MASK & ~1
+        elif csr == MCAUSE:
+            self.mcause = value
+        elif csr not in (MIP, CYCLE, INSTRET, TIME):
+            raise IllegalInstruction
+        self._update_irq()
+
+    # The interrupts asserted: the timer and the peripheral lines in interrupts
+    def pending_interrupts(self):
+        pending = self.interrupts & ~(1 << TIMER_IRQ)
+        if (self.mtime - self.mtimecmp) & M < 0x40000000:
+            pending |= 1 << TIMER_IRQ
+        return pending
+
+    # Set the peripheral interrupt lines, bit n is mip bit n.  Keep UART_TX_IRQ set
+    # for firmware that sends from its interrupt handler.
+    def set_interrupts(self, interrupts):
+        self.interrupts = interrupts
+        self._update_irq()
+
+    def advance_time(self, ticks):
+        self.mtime = (self.mtime + ticks) & M
+        self._update_irq()
+
+    def _update_irq(self):
+        self._irq = bool(self.mstatus & MSTATUS_MIE) and bool(self.mie & self.pending_interrupts())
+
+    def trap(self, cause):
+        self.mepc = self.pc
+        self.mcause = cause
+        self.mstatus = MSTATUS_FIXED | (MSTATUS_MPIE if self.mstatus & MSTATUS_MIE else 0)
+        self.next_pc = INTERRUPT_ADDR if cause & CAUSE_INTERRUPT else EXCEPTION_ADDR
+        self._irq = False
+
+    def _take_interrupt(self):
+        pending = self.mie & self.pending_interrupts()
+        irq = pending.bit_length() - 1
+        self.next_pc = self.pc
+        self.trap(CAUSE_INTERRUPT | irq)
+        self.pc = self.next_pc
+
+    ### Execution ###
+
+    def _decode_at(self, pc):
+        instr = self.load(pc, 4 if self.load(pc, 1) & 3 == 3 else 2)
+        d = self._icache[pc] = decode(instr)
+        return d
+
+    # Execute up to count instructions from the pc.  Stops early if the core
+    # reaches a jump to itself ("j .") that no interrupt can leave, or stop_pc if given.
+    # While waiting in a "j ." for the timer, time skips ahead to MTIMECMP.
+    # Returns the number of instructions executed.
+    def run(self, count, stop_pc=None):
+        icache = self._icache
+        for n in range(count):
+            if self._irq:
+                self._take_interrupt()
+            pc = self.pc
+            if pc == stop_pc:
+                return n
+            d = icache.get(pc)
+            if d is None:
+                d = self._decode_at(pc)
+            handler, a, b, c, size = d
+            self.next_pc = pc + size
+            try:
+                handler(self, a, b, c)
+            except IllegalInstruction:
+                self.trap(CAUSE_ILLEGAL_INSTRUCTION)
+            self.instret += 1
+            self.pc = self.next_pc & PC_MASK
+            if self.pc == pc and not self._irq:
+                if not self._wait_for_timer():
+                    return n + 1
+        return count
+
+    def _wait_for_timer(self):
+        if not (self.mstatus & MSTATUS_MIE and self.mie & (1 << TIMER_IRQ)):
+            return False
+        self.mtime = self.mtimecmp
+        self._update_irq()
+        return True
+
+    # Execute one instruction given as its encoding, as if fetched from the pc.
+    # This is how the tests follow the instructions send_instr feeds to the core.
+    # on_execute, if set, is called with the instruction after it executes.
+    def execute(self, instr):
+        d = self._ecache.get(instr)
+        if d is None:
+            d = self._ecache[instr] = decode(instr)
+        handler, a, b, c, size = d
+        self.next_pc = self.pc + size
+        try:
+            handler(self, a, b, c)
+        except IllegalInstruction:
+            self.trap(CAUSE_ILLEGAL_INSTRUCTION)
+        self.instret += 1
+        self.pc = self.next_pc & PC_MASK
+        if self.on_execute is not None:
+            self.on_execute(instr)
+
+    # Set x1-x15 from a list of 16 values, gp and tp are hardwired so keep their values
+    def set_regs(self, values):
+        for i in range(1, 16):
+            if i not in (3, 4):
+                self.regs[i] = values[i] & 0xFFFFFFFF
+
+    # The register values as signed integers, in the form the tests keep them
+    def signed_regs(self):
+        return [_signed(value) for value in self.regs[:16]]
+
+# Run a firmware image for the simulated flash from reset, and return the bytes it sends
+# on the UART.  The firmware tests use this to check an image before simulating it.
+def firmware_uart_output(filename, max_instructions=1000000):
+    model = TinyQVModel()
+    model.load_hex(filename)
+    model.run(max_instructions)
+    return bytes(model.uart_tx)
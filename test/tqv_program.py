@@ -0,0 +1,283 @@
+# SPDX-FileCopyrightText: © 2025 Tiny Tapeout
+# SPDX-License-Identifier: Apache-2.0
+
+from contextlib import contextmanager
+
+from riscvmodel.insn import *
+from riscvmodel.regnames import x0, ra, tp, t0, t1, t2, s0, s1, a0, a1, a2, a3, a4, a5
+
+import test_util
+from insn_cache import encode, load_imm, NOP
+from tqv_model import TinyQVModel
+
+# Programs are placed here in the simulated flash, results are stored from here in PSRAM A
+# and stream payloads are placed from here in PSRAM B
+PROGRAM_ADDR = 0x4000
+RESULT_ADDR = 0x1000000
+STREAM_ADDR = 0x1800000
+
+# A taken branch makes the core restart its flash read, which takes at least
+# 12 QSPI clocks, so each iteration of a delay loop takes at least this many cycles.
+DELAY_LOOP_CYCLES = 24
+
+# A poll loop also loads the register, so takes at least this many cycles per iteration.
+POLL_LOOP_CYCLES = 32
+
+# A stream loop also loads from PSRAM, which takes at least 14 QSPI clocks.
+STREAM_LOOP_CYCLES = DELAY_LOOP_CYCLES + 28
+
+# The most instructions a program may take on the reference model before it is
+# assumed to be stuck.  The model runs each wait once, see assemble.
+MODEL_MAX_INSTRUCTIONS = 10000000
+
+# Register usage: a1 holds values, s0 points to the next result slot,
+# a0 counts delay and poll loop iterations, t0 and ra hold the poll mask and value
+# or the stream pointer and end, and loops use one counter register per nesting level.
+LOOP_REGS = [t1, t2, s1, a2, a3, a4, a5]
+
+# The values read by one read in a program.
+# values has one entry for each time the read was executed, value is the last of them.
+class ProgramRead:
+    def __init__(self):
+        self.values = []
+
+    @property
+    def value(self):
+        return self.values[-1]
+
+# The result of a wait_for_reg in a program.  values are the poll iterations
+# left each time the wait was executed, which is 0 if it timed out.
+class ProgramWait(ProgramRead):
+    @property
+    def matched(self):
+        return self.values[-1] != 0
+
+# Records a sequence of register accesses, delays and loops for a peripheral,
+# and runs it on the core from the simulated QSPI PMOD.
+# Use through TinyQV.program(), the program runs when the async with block exits:
+#
+#   async with tqv.program() as prog:
+#       prog.write_byte_reg(0, 0x12)
+#       prog.delay(100)
+#       with prog.loop(4):
+#           result = prog.read_word_reg(4)
+#   assert result.values == [...]
+class Program:
+
+    # before_run, if given, is awaited before the program runs, TinyQV uses it to
+    # flush any combined writes.
+    def __init__(self, dut, base_address, before_run=None):
+        self.dut = dut
+        self.base_address = base_address
+        self.before_run = before_run
+        self.ops = []
+        self.body = self.ops
+        self.depth = 0
+        self.cycles = None
+        self.stream_data = bytearray()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            await self.run()
+
+    def write_byte_reg(self, reg, value):
+        self.body.append(("write", 8, reg, value))
+
+    def write_hword_reg(self, reg, value):
+        self.body.append(("write", 16, reg, value))
+
+    def write_word_reg(self, reg, value):
+        self.body.append(("write", 32, reg, value))
+
+    def read_byte_reg(self, reg):
+        return self._read(8, reg)
+
+    def read_hword_reg(self, reg):
+        return self._read(16, reg)
+
+    def read_word_reg(self, reg):
+        return self._read(32, reg)
+
+    def _read(self, width, reg):
+        result = ProgramRead()
+        self.body.append(("read", width, reg, result))
+        return result
+
+    # Wait until (reg & mask) == value, polling the register for at least timeout cycles.
+    # Returns a ProgramWait, whose matched property is false if the wait timed out.
+    def wait_for_reg(self, reg, mask, value, timeout, width=8):
+        load = {8: InstructionLBU, 16: InstructionLHU, 32: InstructionLW}[width]
+        return self._poll(encode(load, a1, tp, self.base_address + reg), mask, value, timeout)
+
+    # Wait until (csr & mask) == value, in the same way as wait_for_reg.
+    def wait_for_csr(self, csr, mask, value, timeout):
+        return self._poll(encode(InstructionCSRRS, a1, x0, csr), mask, value, timeout)
+
+    def _poll(self, load, mask, value, timeout):
+        iterations = max(1, (timeout + POLL_LOOP_CYCLES - 1) // POLL_LOOP_CYCLES)
+        result = ProgramWait()
+        self.body.append(("poll", load, mask, value & mask, iterations, result))
+        return result
+
+    # Write each value in data to reg in turn, with at least min_gap_cycles between
+    # the writes.  The data is copied from PSRAM by the core, width is 8, 16 or 32.
+    def write_stream(self, reg, data, width=8, min_gap_cycles=0):
+        nbytes = width // 8
+        addr = STREAM_ADDR + len(self.stream_data)
+        for value in data:
+            self.stream_data += (value & ((1 << width) - 1)).to_bytes(nbytes, "little")
+        if len(self.stream_data) & 3:
+            self.stream_data += bytes(4 - (len(self.stream_data) & 3))
+        gap = 0
+        if min_gap_cycles > STREAM_LOOP_CYCLES:
+            gap = (min_gap_cycles - STREAM_LOOP_CYCLES + DELAY_LOOP_CYCLES - 1) // DELAY_LOOP_CYCLES
+        if len(data) > 0:
+            self.body.append(("stream", width, reg, addr, len(data) * nbytes, gap))
+
+    # Wait for at least the given number of clock cycles
+    def delay(self, cycles):
+        iterations = max(1, (cycles + DELAY_LOOP_CYCLES - 1) // DELAY_LOOP_CYCLES)
+        self.body.append(("delay", iterations))
+
+    # Repeat the operations recorded inside the with block count times
+    @contextmanager
+    def loop(self, count):
+        assert count >= 1
+        assert self.depth < len(LOOP_REGS)
+        outer = self.body
+        self.body = []
+        self.depth += 1
+        try:
+            yield
+        finally:
+            outer.append(("loop", count, self.body))
+            self.body = outer
+            self.depth -= 1
+
+    def _assemble(self, ops, depth, code, short_waits):
+        for op in ops:
+            if op[0] == "write":
+                _, width, reg, value = op
+                code += load_imm(a1, value)
+                store = {8: InstructionSB, 16: InstructionSH, 32: InstructionSW}[width]
+                code.append(encode(store, tp, a1, self.base_address + reg))
+            elif op[0] == "read":
+                _, width, reg, _ = op
+                load = {8: InstructionLBU, 16: InstructionLHU, 32: InstructionLW}[width]
+                code.append(encode(load, a1, tp, self.base_address + reg))
+                code.append(encode(InstructionSW, s0, a1, 0))
+                code.append(encode(InstructionADDI, s0, s0, 4))
+            elif op[0] == "poll":
+                _, load, mask, value, iterations, _ = op
+                code += load_imm(a0, 1 if short_waits else iterations)
+                code += load_imm(t0, mask)
+                code += load_imm(ra, value)
+                start = len(code)
+                code.append(load)
+                code.append(encode(InstructionAND, a1, a1, t0))
+                code.append(encode(InstructionBEQ, a1, ra, 12))
+                code.append(encode(InstructionADDI, a0, a0, -1))
+                code.append(encode(InstructionBNE, a0, x0, (start - len(code)) * 4))
+                code.append(encode(InstructionSW, s0, a0, 0))
+                code.append(encode(InstructionADDI, s0, s0, 4))
+            elif op[0] == "stream":
+                _, width, reg, addr, length, gap = op
+                code += load_imm(t0, addr)
+                code += load_imm(ra, addr + length)
+                load = {8: InstructionLBU, 16: InstructionLHU, 32: InstructionLW}[width]
+                store = {8: InstructionSB, 16: InstructionSH, 32: InstructionSW}[width]
+                start = len(code)
+                code.append(encode(load, a1, t0, 0))
+                code.append(encode(store, tp, a1, self.base_address + reg))
+                code.append(encode(InstructionADDI, t0, t0, width // 8))
+                if gap:
+                    code += load_imm(a0, 1 if short_waits else gap)
+                    code.append(encode(InstructionADDI, a0, a0, -1))
+                    code.append(encode(InstructionBNE, a0, x0, -4))
+                code.append(encode(InstructionBNE, t0, ra, (start - len(code)) * 4))
+            elif op[0] == "delay":
+                code += load_imm(a0, 1 if short_waits else op[1])
+                code.append(encode(InstructionADDI, a0, a0, -1))
+                code.append(encode(InstructionBNE, a0, x0, -4))
+            elif op[0] == "loop":
+                _, count, body = op
+                counter = LOOP_REGS[depth]
+                code += load_imm(counter, count)
+                start = len(code)
+                self._assemble(body, depth + 1, code, short_waits)
+                code.append(encode(InstructionADDI, counter, counter, -1))
+                code.append(encode(InstructionBNE, counter, x0, (start - len(code)) * 4))
+
+    # The reads in the order the program executes them
+    def _read_order(self, ops):
+        order = []
+        for op in ops:
+            if op[0] in ("read", "poll"):
+                order.append(op[-1])
+            elif op[0] == "loop":
+                order += self._read_order(op[2]) * op[1]
+        return order
+
+    # With short_waits, delays, stream gaps and polls go round their loop once, which
+    # changes nothing but the time taken, as far as the model can tell: its peripheral
+    # registers never change by themselves, so a poll that doesn't match at once never will.
+    def assemble(self, short_waits=False):
+        code = list(load_imm(s0, RESULT_ADDR))
+        self._assemble(self.ops, 0, code, short_waits)
+        return code
+
+    # Run the program with short waits on the reference model, where peripheral registers
+    # read back the last value written.  It must reach the end having stored a result
+    # for each read.
+    def _check_on_model(self, nreads):
+        code = self.assemble(short_waits=True)
+        end_addr = PROGRAM_ADDR + len(code) * 4
+        code += [encode(InstructionJAL, x0, 0)]
+        program = b"".join(instr.to_bytes(4, "little") for instr in code)
+
+        model = TinyQVModel()
+        model.write(PROGRAM_ADDR, program)
+        model.write(STREAM_ADDR, self.stream_data)
+        model.pc = PROGRAM_ADDR
+        model.run(MODEL_MAX_INSTRUCTIONS, stop_pc=end_addr)
+        assert model.pc == end_addr, f"Program stopped at {model.pc:x} on the model, expected {end_addr:x}"
+        assert model.regs[s0] == RESULT_ADDR + nreads * 4
+
+    async def run(self):
+        if self.before_run is not None:
+            await self.before_run()
+
+        code = self.assemble()
+        end_addr = PROGRAM_ADDR + len(code) * 4
+
+        # Finish with "j .", padded with NOPs so the core's prefetch reads defined data
+        code += [encode(InstructionJAL, x0, 0)] + [NOP] * 4
+        assert PROGRAM_ADDR + len(code) * 4 <= test_util.SIM_FLASH_SIZE
+
+        reads = self._read_order(self.ops)
+        assert len(reads) * 4 <= test_util.SIM_RAM_SIZE
+        assert len(self.stream_data) <= test_util.SIM_RAM_SIZE
+
+        program = b"".join(instr.to_bytes(4, "little") for instr in code)
+        self._check_on_model(len(reads))
+
+        # The simulated flash and RAM are shared with any other program on the core
+        harness = test_util.harness(self.dut)
+        async with harness.lock:
+            test_util.write_sim_flash(self.dut, PROGRAM_ADDR, program)
+            test_util.write_sim_ram(self.dut, STREAM_ADDR, self.stream_data)
+
+            await test_util.stop_nops(self.dut)
+            self.cycles = await test_util.run_sim_flash(self.dut, PROGRAM_ADDR, end_addr)
+
+            # The program uses the registers freely and makes any number of stores
+            harness.invalidate()
+            await test_util.start_nops(self.dut)
+
+            data = test_util.read_sim_ram(self.dut, RESULT_ADDR, len(reads) * 4)
+
+        for i, result in enumerate(reads):
+            result.values.append(int.from_bytes(data[i*4:i*4+4], "little"))
@@ -26,9 +26,7 @@ async def crc32_test(tqv, dut, data, poly, ref, xor, init):
 
     # Step 2: Enable peripheral input and start sending data
     await tqv.write_byte_reg(0x0, 0xFF)
-    for byte in data:
-        await tqv.write_byte_reg(0x8, int(byte))
-        await ClockCycles(dut.clk, 10)
+    await tqv.write_stream(0x8, data, 8, 10)
     return await tqv.read_word_reg(0xC)
 
 @cocotb.test()
@@ -130,3 +128,9 @@ async def test_random_inputs(dut):
         out = await crc32_test(tqv, dut, data, 0x04C11DB7, 1, 1, 1)
         crc_cmp = binascii.crc32(data)
         assert crc_cmp == out, f"Failed assertion on iteration {i}, data {data}"
+
+    dut._log.info("Test ISO-HDLC protocol with a long input")
+
+    data = randbytes(4096)
+    out = await crc32_test(tqv, dut, data, 0x04C11DB7, 1, 1, 1)
+    assert binascii.crc32(data) == out
@@ -53,11 +53,14 @@ async def test_project(dut):
 
     # Test the interrupt, generated when ui_in[6] goes high
     dut.ui_in[6].value = 1
+    tqv.mark_stimulus()
     await ClockCycles(dut.clk, 1)
     dut.ui_in[6].value = 0
 
     # Interrupt asserted
-    await ClockCycles(dut.clk, 3)
+    latency = await tqv.wait_interrupt(100)
+    assert latency is not None
+    dut._log.info(f"Interrupt latency {latency} cycles")
     assert await tqv.is_interrupt_asserted()
 
     # Interrupt doesn't clear
@@ -45,11 +45,11 @@ def remap_addr(addr):
 
 reg_bits = [13, 6, 8, 8, 8, 13, 13, 13, 12]
 
-async def reg_write(tqv, addr, value):
+async def reg_write(tqv, addr, value, backdoor=False):
 	if reg_bits[addr>>2] + INTERFACE_REGISTER_SHIFT > 16:
-		await tqv.write_word_reg(remap_addr(addr), value << INTERFACE_REGISTER_SHIFT)
+		await tqv.write_word_reg(remap_addr(addr), value << INTERFACE_REGISTER_SHIFT, backdoor=backdoor)
 	else:
-		await tqv.write_hword_reg(remap_addr(addr), value << INTERFACE_REGISTER_SHIFT)
+		await tqv.write_hword_reg(remap_addr(addr), value << INTERFACE_REGISTER_SHIFT, backdoor=backdoor)
 
 async def reg_read(tqv, addr):
 	if reg_bits[addr>>2] + INTERFACE_REGISTER_SHIFT > 16:
@@ -145,7 +145,7 @@ async def test_project(dut):
 		 1,  1,  0, -1
 	]
 	for (i, sweep) in enumerate(sweeps):
-		await reg_write(tqv, 24+i, sweep)
+		await reg_write(tqv, 24+i, sweep, backdoor=True)
 
 	# Check that not all PWM output samples remain at the zero level now that the amp registers are nonzero
 	dut._log.info("Check PWM output again and wait for sweeps to take effect")
@@ -168,7 +168,7 @@ async def test_project(dut):
 
 	# restore sweeps to zero
 	for (i, sweep) in enumerate(sweeps):
-		await reg_write(tqv, 24+i, 0)
+		await reg_write(tqv, 24+i, 0, backdoor=True)
 
 	dut._log.info("Check PWM output when all amplitudes are zero")
 
@@ -34,18 +34,20 @@ async def test_project(dut):
 
     # Test register write and read back
     # await tqv.write_word_reg(0,  0) #x82345678)
-    await tqv.write_word_reg(0,  0)
-    await tqv.write_word_reg(4,  0x01010101)
-    await tqv.write_word_reg(8,  0x08080808)
-    await tqv.write_word_reg(12, 0x0A0A0A0A) # 128
-    await tqv.write_word_reg(16, 0x0F0F0F0F)
-    await tqv.write_word_reg(20, 0x10101010)
-    await tqv.write_word_reg(24, 0x80808080)
-    await tqv.write_word_reg(28, 0xFFFFFFFF) # 256
-    await tqv.write_word_reg(32, 0x1AAAAAAA)
-    await tqv.write_word_reg(36, 0x2A1A1A1A)
-    await tqv.write_word_reg(40, 0x3A8A8A8A)
-    await tqv.write_word_reg(44, 0x4AFAFAFA) # 320
+    await tqv.write_regs([
+        (32, 0,  0),
+        (32, 4,  0x01010101),
+        (32, 8,  0x08080808),
+        (32, 12, 0x0A0A0A0A), # 128
+        (32, 16, 0x0F0F0F0F),
+        (32, 20, 0x10101010),
+        (32, 24, 0x80808080),
+        (32, 28, 0xFFFFFFFF), # 256
+        (32, 32, 0x1AAAAAAA),
+        (32, 36, 0x2A1A1A1A),
+        (32, 40, 0x3A8A8A8A),
+        (32, 44, 0x4AFAFAFA), # 320
+    ])
     # await ClockCycles(dut.clk, 1)
 
     async def measure_hsync():
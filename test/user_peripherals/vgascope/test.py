@@ -48,21 +48,16 @@ async def test_project(dut):
     await tqv.write_byte_reg(0x01, 0b010000)  # background color: dark blue
     await tqv.write_byte_reg(0x02, 0b001100)  # text color: green
 
-    for i in range(16):
-        while await tqv.read_byte_reg(0x3F) & 0x01 == 0:
-            await ClockCycles(dut.clk, 1)
-        await tqv.write_byte_reg(0x00, 24)
-
-    for i in range(32):
-        val = int( 24 + 20 * math.sin(i * 2 * math.pi / 32) )
-        while await tqv.read_byte_reg(0x3F) & 0x01 == 0:
-            await ClockCycles(dut.clk, 1)
-        await tqv.write_byte_reg(0x00, val)
-
-    for i in range(16):
-        while await tqv.read_byte_reg(0x3F) & 0x01 == 0:
-            await ClockCycles(dut.clk, 1)
-        await tqv.write_byte_reg(0x00, 24 + (i & 1))
+    # Each sample is written once the scope is ready for it, polled by the core
+    samples = [24] * 16
+    samples += [int( 24 + 20 * math.sin(i * 2 * math.pi / 32) ) for i in range(32)]
+    samples += [24 + (i & 1) for i in range(16)]
+    waits = []
+    async with tqv.program() as prog:
+        for val in samples:
+            waits.append(prog.wait_for_reg(0x3F, 0x01, 0x01, 2000000))
+            prog.write_byte_reg(0x00, val)
+    assert all(wait.matched for wait in waits)
 
     # grab next VGA frame and compare with reference image
     vgaframe = await grab_vga(dut, hsync, vsync, R1, R0, B1, B0, G1, G0)